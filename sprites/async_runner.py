@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import functools
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+import weakref
+
+import multiple_sprites as ms
+
+###################################################
+"""
+ asyncio front end for multiple_sprites: run_async(task) runs the same pipeline stages as multiple_sprites.run,
+ but drives ffmpeg/ImageMagick through asyncio subprocesses, so one event loop can work through many queued
+ videos without a thread per job. A per event loop semaphore bounds the number of running children (including
+ those of blocking work in worker threads), every stage can have a timeout, and cancelling a job kills its running
+ children. The limits are settings of the job's config: MAX_CONCURRENT_PROCS, STAGE_TIMEOUT and STAGE_TIMEOUTS.
+
+ Sample Usage:
+    python3 async_runner.py /path/to/queue.txt /path/to/outdir --max-procs 16
+"""
+###################################################
+
+procSemaphores = weakref.WeakKeyDictionary()
+
+
+def get_semaphore():
+    """the child process semaphore of the running event loop, sized by the max_concurrent_procs of the first job"""
+    loop = asyncio.get_running_loop()
+    if loop not in procSemaphores:
+        procSemaphores[loop] = asyncio.Semaphore(ms.get_config().max_concurrent_procs)
+    return procSemaphores[loop]
+
+
+class BlockingChildren:
+    """
+    process gate of one piece of blocking work (multiple_sprites.processGate): each child it starts from a worker
+        thread takes a slot of the loop's semaphore, and kill() stops the running ones and refuses new ones
+    """
+
+    def __init__(self, loop, semaphore):
+        self.loop = loop
+        self.semaphore = semaphore
+        self.procs = set()
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    @contextlib.contextmanager
+    def slot(self):
+        if self.cancelled:
+            raise asyncio.CancelledError()
+        asyncio.run_coroutine_threadsafe(self.semaphore.acquire(), self.loop).result()
+        procs = []
+        try:
+            if self.cancelled:
+                raise asyncio.CancelledError()
+            yield lambda proc: self.track(proc, procs)
+        finally:
+            with self.lock:
+                self.procs.difference_update(procs)
+            self.loop.call_soon_threadsafe(self.semaphore.release)
+
+    def track(self, proc, procs):
+        with self.lock:
+            procs.append(proc)
+            self.procs.add(proc)
+            if self.cancelled:
+                proc.kill()
+
+    def kill(self):
+        with self.lock:
+            self.cancelled = True
+            for proc in self.procs:
+                if proc.poll() is None:
+                    proc.kill()
+
+
+async def wait_child(proc):
+    """
+    reap a Popen child without blocking the loop: wait for its pidfd to become readable, then
+        multiple_sprites.wait_process (os.wait4) returns at once with its resource usage; where there are no
+        pidfds, wait in a thread without usage. Returns (returncode, rusage)
+    """
+    loop = asyncio.get_running_loop()
+    if not hasattr(os, "pidfd_open"):
+        return await loop.run_in_executor(None, proc.wait), None
+    pidfd = os.pidfd_open(proc.pid)
+    exited = asyncio.Event()
+    loop.add_reader(pidfd, exited.set)
+    try:
+        await exited.wait()
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return ms.wait_process(proc)
+
+
+async def read_output(proc):
+    """everything the child writes to its stdout pipe, read on the loop"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, unused = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), proc.stdout)
+    try:
+        return await reader.read()
+    finally:
+        transport.close()
+
+
+async def communicate(proc):
+    """(output, returncode, rusage) of a Popen child with stderr merged into stdout"""
+    output = await read_output(proc)
+    returncode, rusage = await wait_child(proc)
+    return output, returncode, rusage
+
+
+async def do_cmd_async(cmd, timeout=None, def_logger=ms.logger):
+    """
+    asyncio version of multiple_sprites.do_cmd, reporting the child's CPU time and max RSS like it; the child is
+        killed on timeout or cancellation
+    """
+    def_logger.info("START [%s] : %s " % (datetime.datetime.now(), cmd))
+    args = shlex.split(cmd)
+    async with get_semaphore():
+        start = time.monotonic()
+        """a plain Popen, reaped here with os.wait4 (asyncio's own subprocesses are reaped without their usage)"""
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            output, returncode, rusage = await asyncio.wait_for(communicate(proc), timeout)
+        except BaseException as e:
+            """timed out or cancelled: don't leave the child running"""
+            if proc.returncode is None:
+                proc.kill()
+            if proc.returncode is None:
+                await wait_child(proc)
+            def_logger.error("ERROR   [%s] An exception occurred\n%s\n%r" % (datetime.datetime.now(), cmd, e))
+            raise
+    ms.record_process(args, start, returncode, rusage)
+    if proc.returncode:
+        def_logger.error("ERROR   [%s] An exception occurred\n%s" % (datetime.datetime.now(), output))
+        raise subprocess.CalledProcessError(proc.returncode, args, output=output)
+    def_logger.info("END   [%s]\n%s" % (datetime.datetime.now(), output))
+    return output
+
+
+async def do_cmds_async(cmds):
+    """run several commands concurrently (still bounded by the semaphore); returns their outputs"""
+    return await asyncio.gather(*[do_cmd_async(cmd) for cmd in cmds])
+
+
+async def do_cmds_serial(cmds):
+    """run commands one after another (ImageMagick batches: one process of the job in memory at a time)"""
+    return [await do_cmd_async(cmd) for cmd in cmds]
+
+
+async def do_cmds_limited(cmds, jobs):
+    """run commands concurrently, at most jobs at a time (and still bounded by the semaphore)"""
+    limit = asyncio.Semaphore(jobs)
+
+    async def run_one(cmd):
+        async with limit:
+            return await do_cmd_async(cmd)
+
+    return await asyncio.gather(*[run_one(cmd) for cmd in cmds])
+
+
+async def run_blocking(fn, *args):
+    """
+    run blocking python work (pillow, file copies, whole blocking pipelines) in the default executor, keeping the
+        metrics context; every child process it starts (do_cmd, the stream engine) takes a slot of the semaphore,
+        and is killed when the call is cancelled or times out, so the worker thread ends soon after
+    """
+    loop = asyncio.get_running_loop()
+    children = BlockingChildren(loop, get_semaphore())
+    context = contextvars.copy_context()
+    context.run(ms.processGate.set, children.slot)
+    try:
+        return await loop.run_in_executor(None, functools.partial(context.run, fn, *args))
+    except asyncio.CancelledError:
+        children.kill()
+        raise
+
+
+async def stage(name, fn, *args):
+    """await fn(*args) as a timed pipeline stage, cancelled after its STAGE_TIMEOUTS/STAGE_TIMEOUT limit"""
+    config = ms.get_config()
+    with ms.stage_timer(name):
+        return await asyncio.wait_for(fn(*args), config.stage_timeouts.get(name, config.stage_timeout))
+
+
+async def probe_video_async(video_file):
+    """asyncio version of multiple_sprites.probe_video, sharing its PROBE_CACHE_DIR cache"""
+    entry = ms.read_probe_cache(video_file)
+    if "probe" not in entry:
+        entry["probe"] = ms.parse_probe(await do_cmd_async(ms.get_probe_cmd(video_file)))
+        await run_blocking(ms.write_probe_cache, video_file, entry)
+    return dict(entry["probe"])
+
+
+async def get_keyframes_async(video_file):
+    """asyncio version of multiple_sprites.get_keyframes"""
+    entry = ms.read_probe_cache(video_file)
+    if "keyframes" not in entry:
+        start_time = (await probe_video_async(video_file))["start_time"]
+        entry = ms.read_probe_cache(video_file)
+        entry["keyframes"] = ms.parse_keyframes(await do_cmd_async(ms.get_keyframes_cmd(video_file)), start_time)
+        await run_blocking(ms.write_probe_cache, video_file, entry)
+    return entry["keyframes"]
+
+
+async def take_snaps_async(video_file, new_out_dir, thumb_rate):
+    """
+    asyncio version of take_snaps / take_snaps_seek / take_snaps_segmented / take_snaps_scene / take_snaps_remote,
+        following SAMPLING, REMOTE_RANGE_READS and EXTRACT_MODE; returns (count, files, cue times), cue times is None unless scene sampling
+    """
+    config = ms.get_config()
+    if config.sampling == "scene":
+        duration = (await probe_video_async(video_file))["duration"]
+        max_thumbs = config.scene_max_thumbs or max(ms.get_thumb_count(duration, thumb_rate), 1)
+        scores = ms.parse_scene_scores(await do_cmd_async(ms.get_scene_scores_cmd(video_file)))
+        times = ms.pick_scene_times(scores, duration, max_thumbs)
+        await do_cmds_async(ms.get_times_snaps_cmds(video_file, new_out_dir, times, keyframes=False))
+        thumb_files = ms.get_thumb_images(new_out_dir)
+        return len(thumb_files), thumb_files, list(zip(times, times[1:] + [duration]))
+    if video_file.startswith("http") and config.remote_range_reads:
+        """range reads of the keyframes only, in a worker thread; its decode takes a child slot"""
+        count, thumb_files = await run_blocking(ms.take_snaps_remote, video_file, new_out_dir, thumb_rate)
+        return count, thumb_files, None
+    if config.extract_mode == "seek" or config.extract_segments > 1:
+        duration = (await probe_video_async(video_file))["duration"]
+        if config.extract_mode == "seek":
+            keyframe_times = await get_keyframes_async(video_file) if ms.use_keyframe_index() else None
+            cmds = ms.get_seek_snaps_cmds(video_file, new_out_dir, thumb_rate, duration, keyframe_times)
+        else:
+            cmds = ms.get_segmented_snaps_cmds(video_file, new_out_dir, thumb_rate, duration, config.extract_segments)
+        await do_cmds_async(cmds)
+    else:
+        frames = None
+        if ms.get_decode_settings().get("skip_frame"):
+            info = await probe_video_async(video_file)
+            frames = ms.get_thumb_count(info["duration"], thumb_rate)
+        await do_cmd_async(ms.get_snaps_cmd(video_file, new_out_dir, thumb_rate, frames))
+        if config.skip_first:
+            """remove the first image"""
+            os.unlink("%s/tv00001.jpg" % new_out_dir)
+    thumb_files = ms.get_thumb_images(new_out_dir)
+    ms.logger.info("%d thumbs written in %s" % (len(thumb_files), new_out_dir))
+    return len(thumb_files), thumb_files, None
+
+
+async def make_task_sprites_async(activity, thumb_rate):
+    """asyncio version of make_task_sprites; returns the number of thumbs (None when restored from the cache)"""
+    config = ms.get_config()
+    video_file = activity.get_video_file()
+    out_dir = activity.get_out_dir()
+    sprite_file = activity.get_sprite_file()
+
+    """reuse a previous result for the same video and settings"""
+    cache_key = None
+    if config.cache_dir and not activity.remote_file:
+        if not os.path.exists(config.cache_dir):
+            os.makedirs(config.cache_dir)
+        cache_key = await run_blocking(ms.get_cache_key, activity, thumb_rate)
+        if await run_blocking(ms.restore_from_cache, cache_key, out_dir):
+            return None
+
+    engine = ms.get_engine()
+    cue_times = None
+    cells = None
+    if engine == "ffmpeg":
+        """size the grid from the probed duration, then let ffmpeg write the sprite sheets directly"""
+        info = await stage("probe_video", probe_video_async, video_file)
+        num_files = ms.get_thumb_count(info["duration"], thumb_rate)
+        if config.skip_first:
+            num_files -= 1
+        coordinates = "%dx%d+0+0" % (config.thumb_width, ms.get_thumb_height(info["width"], info["height"]))
+        layout = ms.plan_layout(num_files, *ms.get_cell_size(coordinates))
+        thumb_files = []
+        await stage("make_sprites_ffmpeg", do_cmd_async,
+                    ms.get_sprites_ffmpeg_cmd(video_file, sprite_file, num_files, layout, thumb_rate))
+    else:
+        num_files, thumb_files, cue_times = await stage("take_snaps", take_snaps_async, video_file, out_dir,
+                                                        thumb_rate)
+        if config.dedup_tiles and ms.Image is not None:
+            thumb_files, cells = await stage("dedup_thumbs", run_blocking, ms.dedup_thumbs, thumb_files)
+        if config.image_backend == "pillow" and ms.Image is not None:
+            coordinates, layout = await stage("make_sprites_pillow", run_blocking, ms.make_sprites_pillow,
+                                              thumb_files, sprite_file)
+        else:
+            await stage("resize", do_cmds_serial, ms.get_resize_cmds(thumb_files))
+            coordinates = ms.parse_geometry(await stage("get_geometry", do_cmd_async,
+                                                        ms.get_geometry_cmd(thumb_files[0])))
+            layout = ms.plan_layout(len(thumb_files), *ms.get_cell_size(coordinates))
+            cmds = ms.get_makesprite_cmds(thumb_files, sprite_file, coordinates, layout)
+            await stage("makesprite", do_cmds_limited, cmds, ms.get_sheet_jobs(len(cmds)))
+
+    sprites_array = [sheet.file for sheet in ms.plan_sheets(sprite_file, layout, len(thumb_files) or num_files)]
+    if ms.needs_optimize_pass():
+        await stage("optimize_sprites_jpegoptim", do_cmds_async, ms.get_jpegoptim_cmds(sprites_array, False))
+    if config.sprite_format != "jpeg":
+        sprites_array = await stage("encode_sprites", run_blocking, ms.encode_sprites, sprites_array)
+    ms.remove_old_thumb_files(thumb_files)
+    with ms.stage_timer("make_vtt"):
+        vtt_files = ms.make_vtt(sprites_array, num_files, coordinates, layout, activity.get_vtt_file(),
+                                thumb_rate=thumb_rate, times=cue_times, cells=cells)
+
+    if cache_key:
+        await run_blocking(ms.store_in_cache, cache_key, sprites_array + vtt_files)
+    return num_files
+
+
+async def run_async(activity, thumb_rate=None):
+    """asyncio version of multiple_sprites.run"""
+    config = activity.config
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+
+    """the task runs in its own context, so this config stays with this job only"""
+    with ms.use_config(config), ms.stage_timer("run", video=activity.get_video_file(), engine=config.engine,
+                                               append=activity.append) as record:
+        if activity.append or ms.get_engine() == "stream" or config.ladder_widths:
+            """
+            no command pipeline to drive: run the blocking version in a worker thread as one stage, its children
+                gated by slots and killed on cancellation or timeout
+            """
+            if activity.append:
+                await stage("run_append", run_blocking, ms.run_append, activity, thumb_rate)
+                return
+            num_files = await stage("make_task_sprites", run_blocking, ms.make_task_sprites, activity, thumb_rate)
+        else:
+            num_files = await make_task_sprites_async(activity, thumb_rate)
+        record["thumbs"] = num_files
+        record["video_seconds"] = (num_files or 0) * thumb_rate
+
+
+async def run_queue_async(video_files, config=None):
+    """
+    run every video concurrently on this event loop (children bounded by max_concurrent_procs) with one config
+        (default multiple_sprites.get_config()); returns a list of (video_file, error) tuples like
+        multiple_sprites.run_batch, error is None on success
+    """
+    async def run_one(video_file):
+        try:
+            await run_async(ms.SpriteTask(video_file, config=config))
+        except (Exception, SystemExit) as e:
+            ms.logger.error("FAILED %s: %s" % (video_file, e))
+            return video_file, str(e) or e.__class__.__name__
+        return video_file, None
+
+    return await asyncio.gather(*[run_one(video_file) for video_file in video_files])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate sprites and WebVTT files for a queue of videos on one "
+                                                 "asyncio event loop")
+    parser.add_argument("video", help="full path or url to the video file, or a .txt file with one video per line")
+    parser.add_argument("out_dir", nargs="?", help="output directory (default: %s)" % ms.THUMB_OUT_DIR)
+    parser.add_argument("--config", help="JSON file of settings (default: $%sCONFIG)" % ms.CONFIG_ENV_PREFIX)
+    parser.add_argument("--max-procs", type=int,
+                        help="max ffmpeg/ImageMagick children running at once (default: %s)" % ms.MAX_CONCURRENT_PROCS)
+    parser.add_argument("--stage-timeout", type=float, help="seconds allowed for each stage")
+    args = parser.parse_args()
+    overrides = {}
+    if args.out_dir:
+        overrides["thumb_out_dir"] = args.out_dir
+    if args.max_procs:
+        overrides["max_concurrent_procs"] = args.max_procs
+    if args.stage_timeout:
+        overrides["stage_timeout"] = args.stage_timeout
+    try:
+        job_config = ms.load_config(args.config, overrides=overrides)
+    except ValueError as e:
+        parser.error(str(e))
+    videos = ms.read_queue(args.video) if args.video.endswith('.txt') else [args.video]
+    results = asyncio.run(run_queue_async(videos, job_config))
+    ms.print_batch_summary(results)
+    if any(error for video_file, error in results):
+        sys.exit(1)
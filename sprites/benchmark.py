@@ -0,0 +1,295 @@
+import argparse
+import datetime
+import http.server
+import json
+import multiprocessing
+import os
+import pipes
+import platform
+import resource
+import re
+import shutil
+import sys
+import threading
+import time
+
+import multiple_sprites as ms
+
+###################################################
+"""
+ Benchmark the sprite pipeline stage by stage on deterministic synthetic videos (ffmpeg testsrc).
+ For every video and pipeline, each stage reports wall time, CPU time (python + child processes),
+ peak RSS of the stage's processes and bytes written to the output dir; results are printed as JSON.
+
+ Sample Usage:
+    python3 benchmark.py --sizes 640x360,1920x1080 --durations 60,600 --pipelines imagemagick,ffmpeg -o bench.json
+    python3 benchmark.py --pipelines pillow --remote   # read the videos over HTTP range requests
+"""
+###################################################
+
+"""Where synthetic videos are generated (reused between runs) and where pipeline output goes"""
+WORK_DIR = "bench"
+
+SIZES = "640x360,1280x720,1920x1080"
+DURATIONS = "60,600"
+PIPELINES = "imagemagick,pillow,ffmpeg,stream"
+
+
+def make_test_video(work_dir, size, duration):
+    """generate (once) a bit-exact testsrc video of the given size and duration"""
+    video_file = os.path.join(work_dir, "testsrc_%s_%ds.mp4" % (size, duration))
+    if not os.path.exists(video_file):
+        ms.do_cmd("ffmpeg -y -f lavfi -i testsrc=size=%s:rate=25:duration=%d -c:v libx264 -preset ultrafast -g 50 "
+                  "-pix_fmt yuv420p -threads 1 -flags +bitexact -fflags +bitexact %s" % (
+                      size, duration, pipes.quote(video_file)))
+    return video_file
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """keep-alive static file handler answering single "Range: bytes=a-b" requests, counting the bytes it sends"""
+    protocol_version = "HTTP/1.1"
+
+    def send_head(self):
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return http.server.SimpleHTTPRequestHandler.send_head(self)
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.range_left = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        left = getattr(self, "range_left", None)
+        while left is None or left > 0:
+            data = source.read(64 * 1024 if left is None else min(left, 64 * 1024))
+            if not data:
+                break
+            outputfile.write(data)
+            self.server.bytes_sent += len(data)
+            if left is not None:
+                left -= len(data)
+        self.range_left = None
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(directory):
+    """serve directory on a free localhost port in a background thread; returns the server"""
+    handler = lambda *args: RangeRequestHandler(*args, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.bytes_sent = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_dir_state(out_dir):
+    """file name -> (size, mtime) of everything in out_dir"""
+    state = {}
+    for name in os.listdir(out_dir):
+        stat = os.stat(os.path.join(out_dir, name))
+        state[name] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+
+class StageError(Exception):
+    """a stage failed; carries the metrics recorded up to the failure"""
+
+    def __init__(self, metrics):
+        Exception.__init__(self, metrics["error"])
+        self.metrics = metrics
+
+
+def stage_worker(conn, fn, args):
+    """run one stage in a fresh process so its rusage (and its children's) covers that stage alone"""
+    try:
+        result = fn(*args)
+        error = None
+    except Exception as e:
+        result = None
+        error = "%s: %s" % (e.__class__.__name__, e)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    conn.send({
+        "result": result,
+        "error": error,
+        "cpu_s": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        "peak_rss_kb": max(own.ru_maxrss, children.ru_maxrss),
+    })
+    conn.close()
+
+
+def measure(stage, out_dir, fn, *args):
+    """run fn(*args) as a benchmark stage; returns (result, metrics)"""
+    before = get_dir_state(out_dir)
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    proc = multiprocessing.get_context("fork").Process(target=stage_worker, args=(child_conn, fn, args))
+    start = time.perf_counter()
+    proc.start()
+    report = parent_conn.recv()
+    proc.join()
+    wall = time.perf_counter() - start
+    after = get_dir_state(out_dir)
+    metrics = {
+        "stage": stage,
+        "wall_s": round(wall, 4),
+        "cpu_s": round(report["cpu_s"], 4),
+        "peak_rss_kb": report["peak_rss_kb"],
+        "bytes_written": sum(size for name, (size, mtime) in after.items() if before.get(name) != (size, mtime)),
+    }
+    if report["error"]:
+        metrics["error"] = report["error"]
+        raise StageError(metrics)
+    return report["result"], metrics
+
+
+def run_pipeline(pipeline, video_file, out_dir, server=None):
+    """
+    run one pipeline stage by stage, yielding the metrics of each stage; with a server, the imagemagick/pillow
+        pipelines take their snapshots from its URL with range requests and report the bytes it sent
+    """
+    sprite_file = os.path.join(out_dir, "bench_%s" % ms.SPRITE_NAME)
+    vtt_file = os.path.join(out_dir, "bench_%s" % ms.VTT_FILE_NAME)
+    thumb_rate = ms.THUMB_RATE_SECONDS
+    if pipeline in ("imagemagick", "pillow"):
+        take_snaps = {"seek": ms.take_snaps_seek, "segmented": ms.take_snaps_segmented}.get(
+            ms.EXTRACT_MODE, ms.take_snaps)
+        if server:
+            take_snaps = ms.take_snaps_remote
+            video_file = "http://127.0.0.1:%d/%s" % (server.server_address[1], os.path.basename(video_file))
+            sent = server.bytes_sent
+        (num_files, thumb_files), metrics = measure("take_snaps", out_dir, take_snaps, video_file, out_dir)
+        if server:
+            metrics["bytes_transferred"] = server.bytes_sent - sent
+        yield metrics
+        if pipeline == "imagemagick":
+            result, metrics = measure("resize", out_dir, ms.resize, thumb_files)
+            yield metrics
+            coordinates, metrics = measure("get_geometry", out_dir, ms.get_geometry, thumb_files[0])
+            yield metrics
+            layout = ms.plan_layout(num_files, *ms.get_cell_size(coordinates))
+            result, metrics = measure("makesprite", out_dir, ms.makesprite, thumb_files, sprite_file, coordinates,
+                                      layout)
+            yield metrics
+        else:
+            (coordinates, layout), metrics = measure("make_sprites_pillow", out_dir, ms.make_sprites_pillow,
+                                                     thumb_files, sprite_file)
+            yield metrics
+        ms.remove_old_thumb_files(thumb_files)
+    elif pipeline == "ffmpeg":
+        info, metrics = measure("probe_video", out_dir, ms.probe_video, video_file)
+        yield metrics
+        num_files = ms.get_thumb_count(info["duration"], thumb_rate)
+        coordinates = "%dx%d+0+0" % (ms.THUMB_WIDTH, ms.get_thumb_height(info["width"], info["height"]))
+        layout = ms.plan_layout(num_files, *ms.get_cell_size(coordinates))
+        result, metrics = measure("make_sprites_ffmpeg", out_dir, ms.make_sprites_ffmpeg, video_file, sprite_file,
+                                  num_files, layout)
+        yield metrics
+    elif pipeline == "stream":
+        (num_files, layout, coordinates), metrics = measure("make_sprites_stream", out_dir,
+                                                            ms.make_sprites_stream, video_file, sprite_file)
+        yield metrics
+    else:
+        raise ValueError("Unknown pipeline: %s" % pipeline)
+
+    sprites_array = [sheet.file for sheet in ms.plan_sheets(sprite_file, layout, num_files)]
+    if ms.needs_optimize_pass("ffmpeg" if pipeline == "ffmpeg" else "imagemagick"):
+        result, metrics = measure("optimize_sprites_jpegoptim", out_dir, ms.optimize_sprites_jpegoptim,
+                                  sprites_array, False)
+        yield metrics
+    result, metrics = measure("make_vtt", out_dir, ms.make_vtt, sprites_array, num_files, coordinates, layout,
+                              vtt_file)
+    yield metrics
+
+
+def benchmark(sizes, durations, pipelines, work_dir, remote=False):
+    """benchmark every pipeline on every synthetic video; returns the JSON-ready report"""
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    server = start_http_server(work_dir) if remote else None
+    results = []
+    for size in sizes:
+        for duration in durations:
+            video_file = make_test_video(work_dir, size, duration)
+            for pipeline in pipelines:
+                out_dir = os.path.join(work_dir, "out_%s" % pipeline)
+                shutil.rmtree(out_dir, ignore_errors=True)
+                os.makedirs(out_dir)
+                stages = []
+                entry = {"video": {"size": size, "duration_s": duration, "bytes": os.path.getsize(video_file)},
+                         "pipeline": pipeline, "stages": stages}
+                try:
+                    for metrics in run_pipeline(pipeline, video_file, out_dir, server):
+                        stages.append(metrics)
+                except StageError as e:
+                    stages.append(e.metrics)
+                    entry["error"] = str(e)
+                entry["total"] = {
+                    "wall_s": round(sum(s["wall_s"] for s in stages), 4),
+                    "cpu_s": round(sum(s["cpu_s"] for s in stages), 4),
+                    "peak_rss_kb": max([s["peak_rss_kb"] for s in stages] or [0]),
+                    "bytes_written": sum(s["bytes_written"] for s in stages),
+                }
+                results.append(entry)
+                print("%-10s %-12s %5ds %8.2fs wall %8.2fs cpu%s" % (
+                    pipeline, size, duration, entry["total"]["wall_s"], entry["total"]["cpu_s"],
+                    "  FAILED: %s" % entry["error"] if "error" in entry else ""), file=sys.stderr)
+    if server:
+        server.shutdown()
+    return {
+        "generated": datetime.datetime.now().isoformat(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "settings": {"thumb_rate_seconds": ms.THUMB_RATE_SECONDS, "thumb_width": ms.THUMB_WIDTH,
+                     "max_grid_size": ms.MAX_GRID_SIZE, "sheet_columns": ms.SHEET_COLUMNS,
+                     "sheet_rows": ms.SHEET_ROWS, "max_sheet_pixels": ms.MAX_SHEET_PIXELS, "extract_mode": ms.EXTRACT_MODE,
+                     "extract_segments": ms.EXTRACT_SEGMENTS, "single_encode": ms.SINGLE_ENCODE,
+                     "optimize_jobs": ms.OPTIMIZE_JOBS, "decode": ms.get_decode_settings(), "remote": remote},
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each sprite pipeline stage on synthetic test videos")
+    parser.add_argument("--sizes", default=SIZES, help="comma separated WxH list (default: %s)" % SIZES)
+    parser.add_argument("--durations", default=DURATIONS, help="comma separated seconds (default: %s)" % DURATIONS)
+    parser.add_argument("--pipelines", default=PIPELINES,
+                        help="comma separated, from imagemagick,pillow,ffmpeg,stream (default: %s)" % PIPELINES)
+    parser.add_argument("--extract", default=ms.EXTRACT_MODE, choices=["fps", "seek", "segmented"],
+                        help="snapshot extraction for the imagemagick/pillow pipelines")
+    parser.add_argument("--segments", type=int, default=os.cpu_count() or 1,
+                        help="time segments for --extract segmented")
+    parser.add_argument("--single-encode", action="store_true",
+                        help="encode sprites once, optimized and progressive, instead of a jpegoptim pass")
+    parser.add_argument("--decode", default=ms.DECODE_PROFILE, choices=sorted(ms.DECODE_PROFILES),
+                        help="decoder tuning profile (DECODE_PROFILE)")
+    parser.add_argument("--remote", action="store_true",
+                        help="imagemagick/pillow pipelines read the videos from a local HTTP server with range requests")
+    parser.add_argument("--work-dir", default=WORK_DIR, help="where videos and output are written")
+    parser.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    ms.EXTRACT_MODE = args.extract
+    ms.EXTRACT_SEGMENTS = args.segments
+    ms.SINGLE_ENCODE = args.single_encode
+    ms.DECODE_PROFILE = args.decode
+    report = benchmark(args.sizes.split(","), [int(d) for d in args.durations.split(",")],
+                       args.pipelines.split(","), args.work_dir, args.remote)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
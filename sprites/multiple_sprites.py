@@ -1,3 +1,8 @@
+import argparse
+import bisect
+import collections
+import contextlib
+import contextvars
 import subprocess
 import shlex
 import sys
@@ -6,8 +11,24 @@ import os
 import datetime
 import math
 import glob
+import hashlib
+import itertools
+import json
 import pipes
-from dateutil import relativedelta
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import remote_input
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 ###################################################
 """
@@ -41,15 +62,171 @@ SKIP_FIRST = False
 """Single sprite max grid size"""
 MAX_GRID_SIZE = 6
 
+"""Max columns / rows of thumbs per sprite sheet, overriding MAX_GRID_SIZE for non-square sheets (None = MAX_GRID_SIZE)"""
+SHEET_COLUMNS = None
+SHEET_ROWS = None
+
+"""Max width and height of a sprite sheet in pixels, e.g. 4096 for mobile GPU texture limits (None = no limit)"""
+MAX_SHEET_PIXELS = None
+
+"""
+    Sprite sheets built at once (imagemagick montage processes / pillow threads), each from its own range of thumbs;
+    concurrent montages share the IMAGEMAGICK_LIMITS memory and map caps, pillow holds one sheet per job in memory
+"""
+SHEET_JOBS = min(os.cpu_count() or 1, 4)
+
+"""
+    Thumb widths of a sprite ladder, e.g. [120, 200, 320]: the video is decoded once and every width gets its own
+    sprites and VTT, named with a _<width> suffix (None = one set at THUMB_WIDTH; not used in append mode)
+"""
+LADDER_WIDTHS = None
+
+"""
+    "imagemagick" takes full size snapshots with ffmpeg, then resizes and tiles them with mogrify/montage;
+    "ffmpeg" decodes, scales and tiles in a single ffmpeg process and writes the sprite sheets directly;
+    "stream" has ffmpeg pipe raw scaled frames to python, which pastes them into the sheets (needs Pillow)
+"""
+ENGINE = "imagemagick"
+
+"""
+    how the imagemagick engine extracts snapshots: "fps" decodes the whole video through the fps=1/N filter,
+    "seek" reads the duration up front and seeks straight to each snapshot time, decoding only the frames it needs
+"""
+EXTRACT_MODE = "fps"
+
+"""True to let seek extraction use the keyframe at or before each snapshot time instead of decoding up to it"""
+SEEK_SNAP_KEYFRAME = False
+
+"""Number of snapshots taken per ffmpeg process in seek extraction (each one is a separate seeked input)"""
+SEEK_BATCH_SIZE = 10
+
+"""Split fps extraction into this many time ranges, each decoded by its own ffmpeg process in parallel; 1 = off"""
+EXTRACT_SEGMENTS = 1
+
+"""
+    True to take snapshots of remote (http/https) MP4 files by fetching only the keyframes they need with HTTP range
+    requests (see remote_input.py); each thumb is then the keyframe at or before its time, not the exact frame.
+    Other remote inputs fall back to letting ffmpeg read the URL
+"""
+REMOTE_RANGE_READS = False
+
+"""
+    "interval" takes a snapshot every THUMB_RATE_SECONDS; "scene" takes one at the start of every shot, found with
+    ffmpeg's scene change score on downscaled frames, and writes variable-length cues (snapshot engines only,
+    not with SKIP_FIRST or append mode)
+"""
+SAMPLING = "interval"
+
+"""Scene change score (0-1) above which a frame starts a new shot in scene sampling"""
+SCENE_THRESHOLD = 0.3
+
+"""Max thumbs in scene sampling; None = as many as interval sampling would take (duration / THUMB_RATE_SECONDS)"""
+SCENE_MAX_THUMBS = None
+
+"""Scene sampling: shots shorter than this many seconds don't get their own thumb"""
+SCENE_MIN_GAP = 2
+
+"""Scene sampling: longer stretches without a cut get evenly spaced thumbs (seconds, None = never)"""
+SCENE_MAX_GAP = 60
+
+"""
+    True to collapse near-identical thumbs (slates, black frames, static screens) into one sprite cell shared by
+    their cues, compared by difference hash (needs Pillow; snapshot engines only)
+"""
+DEDUP_TILES = False
+
+"""Dedup: "consecutive" only merges a thumb into the cell of the one before it, "global" into any earlier cell"""
+DEDUP_SCOPE = "consecutive"
+
+"""Dedup: max differing bits (of 64) between two thumbs' difference hashes, and max mean brightness difference"""
+DEDUP_MAX_DISTANCE = 3
+DEDUP_MAX_LUMA_DIFF = 8
+
+"""
+    "imagemagick" resizes and tiles snapshots with mogrify/identify/montage subprocesses;
+    "pillow" resizes (with reduced-size JPEG decoding) and tiles them in memory, encoding each sprite once.
+    Falls back to imagemagick when Pillow is not installed
+"""
+IMAGE_BACKEND = "imagemagick"
+
+"""
+    -limit resource settings (e.g. memory, map, disk, area) passed to every mogrify/montage call, so a job's
+    ImageMagick processes stay under a memory cap and page pixel caches to disk beyond it; {} = ImageMagick's defaults.
+    The SHARED_LIMITS are a total: SHEET_JOBS concurrent montages get an equal share each. montage builds one sheet
+    per process from at most one sheet's worth of thumbs, so a share only has to fit a sheet
+"""
+IMAGEMAGICK_LIMITS = {"memory": "256MiB", "map": "512MiB"}
+
+"""IMAGEMAGICK_LIMITS resources that add up over concurrent processes, split between them"""
+SHARED_LIMITS = ("memory", "map")
+
+"""Max thumbs per mogrify call, keeping the command line under ARG_MAX for multi-hour videos"""
+RESIZE_BATCH_SIZE = 500
+
+"""JPEG quality of sprites written by the pillow backend (same as ImageMagick's default)"""
+SPRITE_QUALITY = 92
+
+"""
+    True to encode sprites once at SPRITE_QUALITY with optimized Huffman tables and progressive scan (pillow and
+    imagemagick backends), skipping the separate jpegoptim pass; the ffmpeg engine can't, so it keeps the pass
+"""
+SINGLE_ENCODE = False
+
+"""Parallel jpegoptim/optipng processes for the optimization pass; each one is given a share of the sprites"""
+OPTIMIZE_JOBS = os.cpu_count() or 1
+
+"""
+    Sprite file format: "jpeg", "webp" or "avif" (encoded from the JPEG sheets with ffmpeg's libwebp/libaom), or
+    "auto" to keep, per sheet, the smallest of the JPEG and the SPRITE_AUTO_FORMATS candidates whose SSIM against
+    the JPEG is at least SPRITE_MIN_SSIM (not used in append mode)
+"""
+SPRITE_FORMAT = "jpeg"
+SPRITE_AUTO_FORMATS = ("webp", "avif")
+SPRITE_MIN_SSIM = 0.95
+
+"""libwebp quality (0-100) and libaom-av1 crf (0-63, lower is better) of webp/avif sprites"""
+SPRITE_WEBP_QUALITY = 80
+SPRITE_AVIF_CRF = 32
+
+"""Decoder threads per ffmpeg process (-threads); 0 lets ffmpeg decide. Keep jobs x threads near the core count"""
+FFMPEG_THREADS = 0
+
+"""
+    Decoder tuning of every ffmpeg that decodes the video. "default" decodes every frame at full size; "fast"
+    decodes keyframes only (-skip_frame nokey: each thumb becomes the keyframe at or before its snapshot time),
+    allows the decoder's non-compliant speedups (-flags2 fast) and doesn't demux audio, subtitle or data streams.
+    "lowres": N decodes at 1/2**N size where the codec supports it (mjpeg, mpeg4, ...; others ignore it).
+    DECODE_OPTIONS overrides single settings of the profile, e.g. {"lowres": 1}
+"""
+DECODE_PROFILE = "default"
+DECODE_PROFILES = {
+    "default": {"skip_frame": None, "lowres": 0, "fast": False, "drop_streams": False},
+    "fast": {"skip_frame": "nokey", "lowres": 0, "fast": True, "drop_streams": True},
+}
+DECODE_OPTIONS = {}
+
 """jpg is much smaller than png, so using jpg"""
 SPRITE_NAME = "sprite.jpg"
 
 VTT_FILE_NAME = "thumbs.vtt"
+
+"""
+    Also write a seek index next to each VTT, for players that look up thumbs without parsing WebVTT (see SpriteIndex):
+    None, "json" (*_thumbs.json) or "binary" (*_thumbs.idx)
+"""
+VTT_INDEX_FORMAT = None
 THUMB_OUT_DIR = "thumbs"
 
 """True to make a unique timestamped output dir each time, else False to overwrite/replace existing outdir"""
 USE_UNIQUE_OUT_DIR = False
 
+"""
+    True to treat videos as growing (live/DVR recordings): the existing output dir is kept, only snapshots past
+    the last VTT cue are extracted, only the last sprite sheet(s) are rebuilt and new cues are appended to the VTT.
+    Append mode always uses MAX_GRID_SIZE grids and -0, -1, ... sheet names so earlier sheets never change
+"""
+APPEND_MODE = False
+
 """
     set to 1 to not adjust time (gets multiplied by thumbRate);
     On my machine,ffmpeg snapshots show earlier images than expected timestamp by about 1/2 the thumbRate
@@ -57,23 +234,263 @@ USE_UNIQUE_OUT_DIR = False
 """
 TIME_SYNC_ADJUST = -.5
 
+"""
+    Directory of the result cache, keyed on the source video (size, mtime, optional content hash) and the
+    settings that shape the output; a cached sprite/VTT set is copied into the out dir instead of reprocessing.
+    None disables the cache
+"""
+CACHE_DIR = None
+
+"""Cache size limit in bytes; least recently used entries are evicted beyond it"""
+CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+"""True to key the cache on a sha1 of the video contents instead of its path (slower, survives renames/copies)"""
+CACHE_HASH_CONTENT = False
+
+"""
+    Directory for the media probe cache: one JSON file per local video, keyed by its path, size and mtime, holding
+    the ffprobe results (duration, video stream info) and, once seek snapping has needed it, the keyframe index;
+    later runs over the same file (other widths, thumb rates or modes) skip ffprobe entirely. None = off
+"""
+PROBE_CACHE_DIR = None
+
+"""
+    Where metrics records (dicts) go: None (off), a path to a JSON-lines file, or a callable taking each record.
+    Every subprocess reports wall/CPU time and max RSS; every stage of run() (and the whole run) reports wall time
+    plus the CPU time and max RSS of the subprocesses it started
+"""
+METRICS_SINK = None
+
+"""
+    async_runner only: max ffmpeg/ImageMagick children running at once on one event loop, including those started by
+    blocking work in its worker threads (the first job on a loop sizes its semaphore)
+"""
+MAX_CONCURRENT_PROCS = os.cpu_count() or 4
+
+"""
+    async_runner only: timeout in seconds for each stage of a job (None = no limit); STAGE_TIMEOUTS overrides it per
+    stage name
+"""
+STAGE_TIMEOUT = None
+STAGE_TIMEOUTS = {}
+
+"""
+    Prefix of the environment variables load_config reads, one per setting above (e.g. SPRITES_THUMB_WIDTH=160,
+    see parse_setting); SPRITES_CONFIG names a JSON config file
+"""
+CONFIG_ENV_PREFIX = "SPRITES_"
+
+"""SpriteConfig fields left out of the result cache key: they don't change the sprites or VTT"""
+CACHE_KEY_IGNORED = frozenset([
+    "thumb_out_dir", "use_unique_out_dir", "append_mode", "cache_dir", "cache_max_bytes", "cache_hash_content",
+    "probe_cache_dir", "metrics_sink", "optimize_jobs", "sheet_jobs", "ffmpeg_threads", "imagemagick_limits",
+    "resize_batch_size", "seek_batch_size", "max_concurrent_procs", "stage_timeout", "stage_timeouts"])
+
+"""types of the settings that default to None (the others take their default's type), checked by load_config"""
+NONE_SETTING_TYPES = {
+    "sheet_columns": int, "sheet_rows": int, "max_sheet_pixels": int, "scene_max_thumbs": int, "ladder_widths": list,
+    "vtt_index_format": str, "cache_dir": str, "probe_cache_dir": str, "metrics_sink": object, "stage_timeout": float}
+
+"""allowed values of the choice settings (of every item, for lists), checked by load_config"""
+SETTING_CHOICES = {
+    "engine": ("imagemagick", "ffmpeg", "stream"),
+    "extract_mode": ("fps", "seek"),
+    "sampling": ("interval", "scene"),
+    "dedup_scope": ("consecutive", "global"),
+    "image_backend": ("imagemagick", "pillow"),
+    "sprite_format": ("jpeg", "webp", "avif", "auto"),
+    "sprite_auto_formats": ("webp", "avif"),
+    "decode_profile": DECODE_PROFILES,
+    "vtt_index_format": ("json", "binary"),
+}
+
 logger = logging.getLogger(sys.argv[0])
+metricsLock = threading.Lock()
+activeStages = contextvars.ContextVar("activeStages", default=())
+activeConfig = contextvars.ContextVar("activeConfig", default=None)
+"""context manager factory entered around every child process (see process_slot), None = no gate"""
+processGate = contextvars.ContextVar("processGate", default=None)
 logSetup = False
 
 
-class SpriteTask:
-    """small wrapper class as convenience accessor for external scripts"""
+class FrozenDict(dict):
+    """a read-only dict, for the mapping settings (e.g. decode_options) of a SpriteConfig"""
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("SpriteConfig settings are read-only, use _replace()")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+def freeze_setting(value):
+    """value with its lists turned into tuples and its dicts into FrozenDicts, copying any mutable container"""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze_setting(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_setting(item) for item in value)
+    return value
+
 
-    def __init__(self, video_file):
+class SpriteConfig(collections.namedtuple("SpriteConfig", [
+        "use_sips", "thumb_rate_seconds", "thumb_width", "skip_first", "max_grid_size", "sheet_columns",
+        "sheet_rows", "max_sheet_pixels", "sheet_jobs", "ladder_widths", "engine", "extract_mode",
+        "seek_snap_keyframe", "seek_batch_size", "extract_segments", "remote_range_reads", "sampling",
+        "scene_threshold", "scene_max_thumbs", "scene_min_gap", "scene_max_gap", "dedup_tiles", "dedup_scope",
+        "dedup_max_distance", "dedup_max_luma_diff", "image_backend", "imagemagick_limits", "resize_batch_size",
+        "sprite_quality", "single_encode", "optimize_jobs", "sprite_format", "sprite_auto_formats",
+        "sprite_min_ssim", "sprite_webp_quality", "sprite_avif_crf", "ffmpeg_threads", "decode_profile",
+        "decode_options", "sprite_name", "vtt_file_name", "vtt_index_format", "thumb_out_dir",
+        "use_unique_out_dir", "append_mode", "time_sync_adjust", "cache_dir", "cache_max_bytes",
+        "cache_hash_content", "probe_cache_dir", "metrics_sink", "max_concurrent_procs", "stage_timeout",
+        "stage_timeouts"])):
+    """
+    immutable settings of one job, a field per settings global above (lower case); every task carries its own
+        (SpriteTask.config), so jobs with different settings can run at once in one process. Use _replace()
+        for a variant. Lists are stored as tuples and dicts as FrozenDict copies, so a config never shares a
+        mutable value with the globals or with another config
+    """
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        config = super().__new__(cls, *args, **kwargs)
+        return tuple.__new__(cls, map(freeze_setting, config))
+
+    @classmethod
+    def _make(cls, iterable):
+        return tuple.__new__(cls, map(freeze_setting, iterable))
+
+    @classmethod
+    def from_globals(cls):
+        """a config holding the current values of the module globals"""
+        module = globals()
+        return cls(*[module[field.upper()] for field in cls._fields])
+
+
+def get_config():
+    """the config of the running job (see use_config), else the module globals"""
+    config = activeConfig.get()
+    if config is None:
+        return SpriteConfig.from_globals()
+    return config
+
+
+@contextlib.contextmanager
+def use_config(config):
+    """
+    make config the one get_config returns within the block; like the stage metrics, it follows the context into
+        worker threads that copy it and into asyncio tasks, so concurrent jobs never see each other's settings
+    """
+    token = activeConfig.set(config)
+    try:
+        yield config
+    finally:
+        activeConfig.reset(token)
+
+
+def get_setting_type(name):
+    """
+    the type a setting takes: bool, float (any number), int, str, list, dict, or object (anything, e.g. a
+        callable METRICS_SINK)
+    """
+    default = globals()[name.upper()] if name in SpriteConfig._fields else None
+    if default is None:
+        return NONE_SETTING_TYPES.get(name, object)
+    for kind in (bool, str, dict):
+        if isinstance(default, kind):
+            return kind
+    if isinstance(default, (int, float)):
+        return float
+    if isinstance(default, (list, tuple)):
+        return list
+    return object
+
+
+def parse_setting(name, value):
+    """
+    a setting from an environment variable or --set flag: kept as given for string settings ("null" is None where
+        the default is), else JSON (numbers, true/false, null, lists, objects), or the string if it isn't JSON
+    """
+    if get_setting_type(name) is str:
+        return None if value == "null" and name in NONE_SETTING_TYPES else value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def check_setting(name, value):
+    """raise ValueError unless value has the setting's type (or is None where it defaults to None) and choices"""
+    kind = get_setting_type(name)
+    if value is None and (name in NONE_SETTING_TYPES or kind is object):
+        return
+    if kind is float:
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif kind is int:
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    elif kind is list:
+        valid = isinstance(value, (list, tuple))
+    else:
+        valid = isinstance(value, kind)
+    if not valid:
+        raise ValueError("Bad setting %s: expected %s, got %r" % (
+            name, {float: "a number", list: "a list"}.get(kind, kind.__name__), value))
+    choices = SETTING_CHOICES.get(name)
+    if choices is not None:
+        for item in (value if kind is list else [value]):
+            if item not in choices:
+                raise ValueError("Bad setting %s: %r is not one of %s" % (name, item, ", ".join(sorted(choices))))
+
+
+def load_config(config_file=None, environ=None, overrides=None):
+    """
+    a SpriteConfig from the module globals, updated in turn by a JSON config file (setting names as keys, default
+        $SPRITES_CONFIG), the SPRITES_* environment variables and overrides (e.g. command line flags); raises
+        ValueError for unknown settings, values of the wrong type and values outside SETTING_CHOICES
+    """
+    if environ is None:
+        environ = os.environ
+    if config_file is None:
+        config_file = environ.get(CONFIG_ENV_PREFIX + "CONFIG")
+    settings = {}
+    if config_file:
+        with open(config_file, 'r') as f:
+            settings.update((name.lower(), value) for name, value in json.load(f).items())
+    for field in SpriteConfig._fields:
+        if CONFIG_ENV_PREFIX + field.upper() in environ:
+            settings[field] = parse_setting(field, environ[CONFIG_ENV_PREFIX + field.upper()])
+    settings.update((name.lower(), value) for name, value in (overrides or {}).items())
+    unknown = sorted(set(settings) - set(SpriteConfig._fields))
+    if unknown:
+        raise ValueError("Unknown settings: %s" % ", ".join(unknown))
+    for name in sorted(settings):
+        check_setting(name, settings[name])
+    return SpriteConfig.from_globals()._replace(**settings)
+
+
+class SpriteTask:
+    """small wrapper class as convenience accessor for external scripts; config defaults to get_config()"""
+
+    def __init__(self, video_file, append=None, config=None):
+        if config is None:
+            config = get_config()
+        if append is None:
+            append = config.append_mode
+        self.config = config
+        self.append = append
         self.remote_file = video_file.startswith("http")
         if not self.remote_file and not os.path.exists(video_file):
             sys.exit("File does not exist: %s" % video_file)
         base_file = os.path.basename(video_file)
         base_file_no_speed = remove_speed(base_file)  # strip trailing speed suffix from file/dir names, if present
-        new_out_dir = make_out_dir(base_file_no_speed)
+        with use_config(config):
+            new_out_dir = make_out_dir(base_file_no_speed, keep_existing=append)
         file_prefix, ext = os.path.splitext(base_file_no_speed)
-        sprite_file = os.path.join(new_out_dir, "%s_%s" % (file_prefix, SPRITE_NAME))
-        vtt_file = os.path.join(new_out_dir, "%s_%s" % (file_prefix, VTT_FILE_NAME))
+        sprite_file = os.path.join(new_out_dir, "%s_%s" % (file_prefix, config.sprite_name))
+        vtt_file = os.path.join(new_out_dir, "%s_%s" % (file_prefix, config.vtt_file_name))
         self.video_file = video_file
         self.vtt_file = vtt_file
         self.sprite_file = sprite_file
@@ -92,25 +509,26 @@ class SpriteTask:
         return self.vtt_file
 
 
-def make_out_dir(video_file):
+def make_out_dir(video_file, keep_existing=False):
     """create unique output dir based on video file name and current timestamp"""
+    config = get_config()
     base, ext = os.path.splitext(video_file)
     script = sys.argv[0]
     """make output dir always relative to this script regardless of shell directory"""
     base_path = os.path.dirname(
         os.path.abspath(script))
-    if len(THUMB_OUT_DIR) > 0 and THUMB_OUT_DIR[0] == '/':
-        output_dir = THUMB_OUT_DIR
+    if len(config.thumb_out_dir) > 0 and config.thumb_out_dir[0] == '/':
+        output_dir = config.thumb_out_dir
     else:
-        output_dir = os.path.join(base_path, THUMB_OUT_DIR)
-    if USE_UNIQUE_OUT_DIR:
+        output_dir = os.path.join(base_path, config.thumb_out_dir)
+    if config.use_unique_out_dir:
         new_out_dir = "%s.%s" % (os.path.join(output_dir, base), datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
     else:
         new_out_dir = "%s_%s" % (os.path.join(output_dir, base), "vtt")
     if not os.path.exists(new_out_dir):
         logger.info("Making dir: %s" % new_out_dir)
         os.makedirs(new_out_dir)
-    elif os.path.exists(new_out_dir) and not USE_UNIQUE_OUT_DIR:
+    elif os.path.exists(new_out_dir) and not config.use_unique_out_dir and not keep_existing:
         """remove previous contents if reusing out_dir"""
         files = os.listdir(new_out_dir)
         print("Removing previous contents of output directory: %s" % new_out_dir)
@@ -119,15 +537,105 @@ def make_out_dir(video_file):
     return new_out_dir
 
 
+def emit_metric(record):
+    """send one metrics record to METRICS_SINK, stamped with time and pid"""
+    config = get_config()
+    sink = config.metrics_sink
+    if not sink:
+        return
+    record = dict(record, time=time.time(), pid=os.getpid())
+    if callable(sink):
+        sink(record)
+    else:
+        with metricsLock:
+            with open(sink, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def stage_timer(stage, **fields):
+    """
+    time a stage with the monotonic clock and emit it as a metrics record; subprocesses started inside it
+        (also from worker threads that copy the context) add their CPU time and RSS to the record, which is
+        yielded so callers can attach their own fields; python_cpu_s is this process's own CPU time over the
+        stage (in-process work such as the pillow backend, shared with any other threads running meanwhile)
+    """
+    record = dict(fields, type="stage", stage=stage, cpu_s=0.0, max_rss_kb=0, processes=0)
+    token = activeStages.set(activeStages.get() + (record,))
+    start = time.monotonic()
+    start_cpu = time.process_time()
+    try:
+        yield record
+    finally:
+        activeStages.reset(token)
+        record["wall_s"] = round(time.monotonic() - start, 4)
+        record["python_cpu_s"] = round(time.process_time() - start_cpu, 4)
+        record["cpu_s"] = round(record["cpu_s"], 4)
+        emit_metric(record)
+
+
+def wait_process(proc):
+    """reap a child process, returning (returncode, rusage); rusage is None where os.wait4 is unavailable"""
+    if not hasattr(os, "wait4"):
+        return proc.wait(), None
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    return proc.returncode, rusage
+
+
+def record_process(args, start, returncode, rusage):
+    """emit a metrics record for a finished subprocess and add its usage to the active stages
+     (on Linux max RSS is at least the RSS of this process when the child was spawned)"""
+    record = {"type": "process", "cmd": os.path.basename(args[0]), "returncode": returncode,
+              "wall_s": round(time.monotonic() - start, 4)}
+    if rusage:
+        record["cpu_s"] = round(rusage.ru_utime + rusage.ru_stime, 4)
+        record["max_rss_kb"] = rusage.ru_maxrss
+    with metricsLock:
+        for stage in activeStages.get():
+            stage["processes"] += 1
+            if rusage:
+                stage["cpu_s"] += record["cpu_s"]
+                stage["max_rss_kb"] = max(stage["max_rss_kb"], rusage.ru_maxrss)
+    emit_metric(record)
+
+
+@contextlib.contextmanager
+def process_slot():
+    """
+    hold a slot of the active process gate while a child process runs, yielding a function to pass the child's
+        Popen to; async_runner sets a gate in its worker threads, so children of blocking work count against its
+        process limit like its own and are killed when the job is cancelled
+    """
+    gate = processGate.get()
+    if gate is None:
+        yield lambda proc: None
+        return
+    with gate() as track:
+        yield track
+
+
 def do_cmd(cmd, def_logger=logger):
     """execute a shell command and return/print its output"""
     def_logger.info("START [%s] : %s " % (datetime.datetime.now(), cmd))
     """tokenize args"""
     args = shlex.split(cmd)
     output = None
+    start = time.monotonic()
     try:
-        """pipe stderr into stdout"""
-        output = subprocess.check_output(args, stderr=subprocess.STDOUT)
+        with process_slot() as track:
+            """pipe stderr into stdout"""
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            track(proc)
+            output = proc.stdout.read()
+            proc.stdout.close()
+            returncode, rusage = wait_process(proc)
+        record_process(args, start, returncode, rusage)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args, output=output)
     except Exception as e:
         ret = "ERROR   [%s] An exception occurred\n%s\n%s" % (datetime.datetime.now(), output, str(e))
         def_logger.error(ret)
@@ -138,19 +646,85 @@ def do_cmd(cmd, def_logger=logger):
     return output
 
 
+def get_thread_args():
+    """ffmpeg input option limiting decoder threads, if a per-job thread budget is set"""
+    config = get_config()
+    if config.ffmpeg_threads:
+        return "-threads %d " % config.ffmpeg_threads
+    return ""
+
+
+def get_decode_settings():
+    """the DECODE_PROFILE settings with DECODE_OPTIONS applied"""
+    config = get_config()
+    settings = dict(DECODE_PROFILES[config.decode_profile])
+    settings.update(config.decode_options)
+    return settings
+
+
+def get_decode_args(keyframes=True):
+    """
+    ffmpeg input options for decoding the video: the thread budget plus the DECODE_PROFILE settings;
+        keyframes=False leaves out skip_frame for decodes that must see every frame (scene scores)
+    """
+    settings = get_decode_settings()
+    args = get_thread_args()
+    if keyframes and settings.get("skip_frame"):
+        args += "-skip_frame %s " % settings["skip_frame"]
+    if settings.get("lowres"):
+        args += "-lowres %d " % settings["lowres"]
+    if settings.get("fast"):
+        args += "-flags2 fast "
+    if settings.get("drop_streams"):
+        args += "-an -sn -dn "
+    return args
+
+
+def get_fps_filters(thumb_rate, frames):
+    """
+    filters taking a snapshot every thumb_rate seconds, frames being the number of fps slots of the video;
+        decoding keyframes only, the last keyframe is held for a slot so the final slots aren't lost, then cut to
+        frames, and slots are counted from 0 so a keyframe before a -noaccurate_seek point fills the first one
+    """
+    if not get_decode_settings().get("skip_frame"):
+        return ["fps=1/%d" % thumb_rate]
+    return ["tpad=stop_mode=clone:stop_duration=%d" % thumb_rate, "fps=1/%d:start_time=0" % thumb_rate,
+            "trim=end_frame=%d" % frames]
+
+
+def get_engine():
+    """
+    the engine a task really runs: stream needs Pillow, and scene sampling and tile dedup need the snapshot
+        (imagemagick) path, as does a ladder unless ffmpeg tiles it
+    """
+    config = get_config()
+    if config.sampling == "scene" or config.dedup_tiles or (
+            config.engine == "stream" and (Image is None or config.ladder_widths)):
+        return "imagemagick"
+    return config.engine
+
+
+def get_snaps_cmd(video_file, new_out_dir, thumb_rate, frames=None):
+    """ffmpeg command for take_snaps; frames (the fps slot count) is needed if DECODE_PROFILE decodes keyframes only"""
+    """1/60=1 per minute, 1/120=1 every 2 minutes"""
+    return "ffmpeg %s-i %s -f image2 -bt 20M -vf %s -aspect 16:9 %s/tv%%05d.jpg" % (
+        get_decode_args(), pipes.quote(video_file), ",".join(get_fps_filters(thumb_rate, frames)),
+        pipes.quote(new_out_dir))
+
+
 def take_snaps(video_file, new_out_dir, thumb_rate=None):
     """
     take snapshot image of video every Nth second and output to sequence file names and custom directory
         reference: https://trac.ffmpeg.org/wiki/Create%20a%20thumbnail%20image%20every%20X%20seconds%20of%20the%20video
     """
+    config = get_config()
     if not thumb_rate:
-        thumb_rate = THUMB_RATE_SECONDS
-    """1/60=1 per minute, 1/120=1 every 2 minutes"""
-    rate = "1/%d" % thumb_rate
-    cmd = "ffmpeg -i %s -f image2 -bt 20M -vf fps=%s -aspect 16:9 %s/tv%%05d.jpg" % (
-        pipes.quote(video_file), rate, pipes.quote(new_out_dir))
-    do_cmd(cmd)
-    if SKIP_FIRST:
+        thumb_rate = config.thumb_rate_seconds
+    frames = None
+    if get_decode_settings().get("skip_frame"):
+        frames = get_thumb_count(probe_video(video_file)["duration"], thumb_rate)
+    do_cmd(get_snaps_cmd(video_file, new_out_dir, thumb_rate, frames))
+    if config.skip_first:
         """remove the first image"""
         logger.info("Removing first image, unneeded")
         os.unlink("%s/tv00001.jpg" % new_out_dir)
@@ -160,42 +734,654 @@ def take_snaps(video_file, new_out_dir, thumb_rate=None):
     return count, get_thumb_images(new_out_dir)
 
 
+def get_seek_snaps_cmds(video_file, new_out_dir, thumb_rate, duration, keyframe_times=None):
+    """
+    ffmpeg commands for take_snaps_seek, each taking up to SEEK_BATCH_SIZE snapshots; with the keyframe index
+        (get_keyframes, when use_keyframe_index()) every time is snapped to its keyframe, so slots sharing one
+        decode it once
+    """
+    config = get_config()
+    count = get_thumb_count(duration, thumb_rate)
+    """
+        the fps filter emits, for slot k, the last frame before (k + 0.5) * thumb_rate; seek to the same spot
+        (kept half a second inside the end of the video) and write it as tv%05d (k + 1)
+    """
+    first = 1 if config.skip_first else 0
+    times = [max(min((k + 0.5) * thumb_rate, duration - 0.5), 0) for k in range(first, count)]
+    if keyframe_times:
+        times = snap_to_keyframes(times, keyframe_times)
+    return get_times_snaps_cmds(video_file, new_out_dir, times, first + 1)
+
+
+def use_keyframe_index():
+    """
+    True if seek extraction snaps its times with get_keyframes: the snapshots are keyframes anyway (SEEK_SNAP_KEYFRAME
+        or keyframes only decoding) and PROBE_CACHE_DIR keeps the index, which takes a pass over every packet
+    """
+    config = get_config()
+    return bool(config.probe_cache_dir and (config.seek_snap_keyframe or get_decode_settings().get("skip_frame")))
+
+
+def get_times_snaps_cmds(video_file, new_out_dir, times, first_number=1, keyframes=True):
+    """
+    ffmpeg commands seeking to each time in seconds, written as tv%05d from first_number, SEEK_BATCH_SIZE a command;
+        keyframes=False takes the exact frames even if DECODE_PROFILE decodes keyframes only. Runs of equal times
+        share one seeked input with an output per snapshot
+    """
+    config = get_config()
+    """decoding keyframes only, an accurate seek would skip to the keyframe after the time: take the one before"""
+    skip_frame = keyframes and get_decode_settings().get("skip_frame")
+    seek = "-noaccurate_seek " if config.seek_snap_keyframe or skip_frame else ""
+    """
+        the keyframe before the seek point has a negative timestamp: the default vsync would drop it (and with every
+        frame decoded, output the one at the seek point instead)
+    """
+    vsync = "-vsync 0 " if seek else ""
+    groups = [(time, [k for k, unused in group])
+              for time, group in itertools.groupby(enumerate(times), key=lambda item: item[1])]
+    cmds = []
+    for batch_start in range(0, len(groups), config.seek_batch_size):
+        batch = groups[batch_start:batch_start + config.seek_batch_size]
+        inputs = " ".join("-ss %.3f %s%s-i %s" % (time, seek, get_decode_args(keyframes), pipes.quote(video_file))
+                          for time, numbers in batch)
+        outputs = " ".join("-map %d:v:0 -frames:v 1 %s-f image2 -aspect 16:9 %s" % (
+            i, vsync, pipes.quote("%s/tv%05d.jpg" % (new_out_dir, first_number + k)))
+            for i, (time, numbers) in enumerate(batch) for k in numbers)
+        cmds.append("ffmpeg -y %s %s" % (inputs, outputs))
+    return cmds
+
+
+def take_snaps_seek(video_file, new_out_dir, thumb_rate=None):
+    """
+    take the same snapshots as take_snaps, but seek to every Nth second with input side -ss
+        instead of decoding the whole video, so the work grows with the number of thumbs, not the video length
+    """
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    keyframe_times = get_keyframes(video_file) if use_keyframe_index() else None
+    for cmd in get_seek_snaps_cmds(video_file, new_out_dir, thumb_rate, probe_video(video_file)["duration"],
+                                   keyframe_times):
+        do_cmd(cmd)
+    count = len(get_thumb_images(new_out_dir))
+    logger.info("%d thumbs written in %s" % (count, new_out_dir))
+    return count, get_thumb_images(new_out_dir)
+
+
+def get_snaps_range_cmd(video_file, new_out_dir, thumb_rate, start, frames):
+    """ffmpeg command taking the snapshots of slots start..start+frames-1, written as tv%05d from start + 1;
+     input side -ss resets timestamps to 0, so the fps slots line up with the global ones"""
+    """decoding keyframes only, an accurate seek would drop the keyframe before the start the first slot needs"""
+    seek = "-noaccurate_seek " if get_decode_settings().get("skip_frame") else ""
+    return "ffmpeg -y -ss %d %s%s-i %s -f image2 -bt 20M -vf %s -frames:v %d -start_number %d " \
+           "-aspect 16:9 %s/tv%%05d.jpg" % (start * thumb_rate, seek, get_decode_args(), pipes.quote(video_file),
+                                            ",".join(get_fps_filters(thumb_rate, frames)), frames, start + 1,
+                                            pipes.quote(new_out_dir))
+
+
+def get_segmented_snaps_cmds(video_file, new_out_dir, thumb_rate, duration, segments):
+    """ffmpeg commands for take_snaps_segmented, one per time range"""
+    config = get_config()
+    count = get_thumb_count(duration, thumb_rate)
+    first = 1 if config.skip_first else 0
+    per_segment = int(math.ceil((count - first) / float(segments)))
+    return [get_snaps_range_cmd(video_file, new_out_dir, thumb_rate, start, min(per_segment, count - start))
+            for start in range(first, count, per_segment)]
+
+
+def take_snaps_segmented(video_file, new_out_dir, thumb_rate=None, segments=None):
+    """
+    take the same snapshots as take_snaps, but split the timeline into time ranges that are extracted
+        by concurrent ffmpeg processes; every range starts on a snapshot slot boundary and numbers its
+        files from that slot, so the merged tv%05d sequence (and the VTT timestamps) stay unchanged
+    """
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    if not segments:
+        segments = config.extract_segments
+    cmds = get_segmented_snaps_cmds(video_file, new_out_dir, thumb_rate, probe_video(video_file)["duration"],
+                                    segments)
+    run_cmds_parallel(cmds)
+    count = len(get_thumb_images(new_out_dir))
+    logger.info("%d thumbs written in %s" % (count, new_out_dir))
+    return count, get_thumb_images(new_out_dir)
+
+
+def get_remote_snaps_cmd(stream_file, stream_format, new_out_dir, first):
+    """ffmpeg command decoding every keyframe of the fetched elementary stream into tv%05d from first + 1"""
+    return "ffmpeg -y %s-f %s -flags2 showall -i %s -vsync 0 -f image2 -start_number %d -aspect 16:9 %s/tv%%05d.jpg" % (
+        get_decode_args(keyframes=False), stream_format, pipes.quote(stream_file), first + 1, pipes.quote(new_out_dir))
+
+
+def take_snaps_remote(video_url, new_out_dir, thumb_rate=None):
+    """
+    take snapshots of a remote MP4 without downloading it: read the sample tables with range requests, fetch
+        the keyframe at or before each snapshot time and decode just those; falls back to take_snaps when the
+        server or file doesn't allow it
+    """
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    stream_file = os.path.join(new_out_dir, "keyframes.bin")
+    try:
+        with remote_input.RangeReader(video_url) as reader:
+            track = remote_input.read_video_track(reader)
+            count = get_thumb_count(track.duration, thumb_rate)
+            first = 1 if config.skip_first else 0
+            times = [(k + 0.5) * thumb_rate for k in range(first, count)]
+            remote_input.write_keyframe_stream(reader, track, times, stream_file)
+    except remote_input.RemoteInputError as e:
+        logger.warning("%s, falling back to ffmpeg reading the url" % e)
+        return take_snaps(video_url, new_out_dir, thumb_rate=thumb_rate)
+    try:
+        do_cmd(get_remote_snaps_cmd(stream_file, track.get_stream_format(), new_out_dir, first))
+    finally:
+        os.unlink(stream_file)
+    logger.info("%d of %d bytes fetched in %d requests" % (reader.bytes_transferred, reader.size, reader.requests))
+    emit_metric({"type": "remote_input", "video": video_url, "bytes_transferred": reader.bytes_transferred,
+                 "file_size": reader.size, "requests": reader.requests})
+    count = len(get_thumb_images(new_out_dir))
+    logger.info("%d thumbs written in %s" % (count, new_out_dir))
+    return count, get_thumb_images(new_out_dir)
+
+
+def get_scene_scores_cmd(video_file):
+    """ffmpeg command printing the scene change score of every frame, computed on 64px wide frames"""
+    return "ffmpeg -nostats %s-i %s -an -sn -vf \"scale=64:-2,select='gte(scene,0)',metadata=print:key=lavfi.scene_score\" " \
+           "-f null -" % (get_decode_args(keyframes=False), pipes.quote(video_file))
+
+
+def parse_scene_scores(output):
+    """[(seconds, score), ...] from the metadata=print output of get_scene_scores_cmd"""
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", "replace")
+    scores = []
+    seconds = None
+    for line in output.splitlines():
+        if "pts_time:" in line:
+            seconds = float(line.split("pts_time:")[1].split()[0])
+        elif "lavfi.scene_score=" in line and seconds is not None:
+            scores.append((seconds, float(line.split("lavfi.scene_score=")[1].split()[0])))
+            seconds = None
+    return scores
+
+
+def pick_scene_times(scores, duration, max_thumbs, min_gap=None, max_gap=None):
+    """
+    thumb times for scene sampling: 0, then the strongest cuts (score over SCENE_THRESHOLD, at least min_gap
+        apart) up to max_thumbs, then evenly spaced fill-ins for stretches longer than max_gap while budget remains
+    """
+    config = get_config()
+    if min_gap is None:
+        min_gap = config.scene_min_gap
+    if max_gap is None:
+        max_gap = config.scene_max_gap
+    times = [0.0]
+    for seconds, score in sorted(scores, key=lambda entry: -entry[1]):
+        if len(times) >= max_thumbs or score < config.scene_threshold:
+            break
+        if duration - seconds >= min_gap and all(abs(seconds - t) >= min_gap for t in times):
+            times.append(seconds)
+    times.sort()
+    if max_gap:
+        bounds = times + [duration]
+        for start, end in zip(bounds, bounds[1:]):
+            extra = min(int(math.ceil((end - start) / float(max_gap))) - 1, max_thumbs - len(times))
+            times.extend(start + (end - start) * (i + 1) / (extra + 1) for i in range(max(extra, 0)))
+        times.sort()
+    return times
+
+
+def take_snaps_scene(video_file, new_out_dir, thumb_rate=None):
+    """
+    take a snapshot at the start of every shot (see SAMPLING), within a budget of SCENE_MAX_THUMBS;
+        returns (count, files, cue times) where cue times are (start, end) seconds for make_vtt
+    """
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    duration = probe_video(video_file)["duration"]
+    max_thumbs = config.scene_max_thumbs or max(get_thumb_count(duration, thumb_rate), 1)
+    times = pick_scene_times(parse_scene_scores(do_cmd(get_scene_scores_cmd(video_file))), duration, max_thumbs)
+    """shots start on the cut frame itself, not on the keyframe before it"""
+    run_cmds_parallel(get_times_snaps_cmds(video_file, new_out_dir, times, keyframes=False))
+    count = len(get_thumb_images(new_out_dir))
+    logger.info("%d thumbs written in %s for %d shots" % (count, new_out_dir, len(times)))
+    return count, get_thumb_images(new_out_dir), list(zip(times, times[1:] + [duration]))
+
+
+def get_probe_cmd(video_file):
+    """ffprobe command for probe_video"""
+    return "ffprobe -v error -select_streams v:0 -show_entries " \
+           "stream=width,height,codec_name,avg_frame_rate,duration,nb_frames:format=duration,start_time -of json %s" % (
+               pipes.quote(video_file))
+
+
+def probe_video(video_file):
+    """read duration, start time and frame size (and codec, frame rate) of the first video stream with ffprobe,
+     or from PROBE_CACHE_DIR"""
+    entry = read_probe_cache(video_file)
+    if "probe" not in entry:
+        entry["probe"] = parse_probe(do_cmd(get_probe_cmd(video_file)))
+        write_probe_cache(video_file, entry)
+    return dict(entry["probe"])
+
+
+def parse_probe(output):
+    """
+    duration, start time, width, height, codec and frame rate from ffprobe's json output; the duration is the
+        video stream's (nb_frames / frame rate, or the container's, when it isn't stored), not the longest stream's
+    """
+    output = output.decode()
+    """do_cmd merges stderr into the output: skip any error lines of a damaged file before the json"""
+    info, unused = json.JSONDecoder().raw_decode(output, output.find("{"))
+    stream = info["streams"][0]
+    num, unused, den = stream.get("avg_frame_rate", "0/0").partition("/")
+    frame_rate = float(num) / float(den) if den and float(den) else None
+    if "duration" in stream:
+        duration = float(stream["duration"])
+    elif stream.get("nb_frames") and frame_rate:
+        duration = int(stream["nb_frames"]) / frame_rate
+    else:
+        duration = float(info["format"]["duration"])
+    return {
+        "duration": duration,
+        "start_time": float(info["format"].get("start_time", 0)),
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "codec": stream.get("codec_name"),
+        "frame_rate": frame_rate,
+    }
+
+
+def get_keyframes_cmd(video_file):
+    """ffprobe command listing the time and flags of every video packet (demux only, nothing is decoded)"""
+    return "ffprobe -v error -select_streams v:0 -show_entries packet=pts_time,flags -of compact=p=0 %s" % (
+        pipes.quote(video_file))
+
+
+def get_keyframes(video_file):
+    """sorted keyframe times in seconds from the start of the video (as -ss counts them), cached in PROBE_CACHE_DIR"""
+    entry = read_probe_cache(video_file)
+    if "keyframes" not in entry:
+        start_time = probe_video(video_file)["start_time"]
+        entry = read_probe_cache(video_file)
+        entry["keyframes"] = parse_keyframes(do_cmd(get_keyframes_cmd(video_file)), start_time)
+        write_probe_cache(video_file, entry)
+    return entry["keyframes"]
+
+
+def parse_keyframes(output, start_time=0):
+    """keyframe times from get_keyframes_cmd's output: packets flagged K, less the format start time"""
+    times = set()
+    for line in output.decode().splitlines():
+        fields = dict(field.split("=", 1) for field in line.strip().split("|") if "=" in field)
+        if "K" in fields.get("flags", "") and fields.get("pts_time", "N/A") != "N/A":
+            times.add(round(float(fields["pts_time"]) - start_time, 6))
+    return sorted(times)
+
+
+def snap_to_keyframes(times, keyframes):
+    """each time moved back to the keyframe at or before it (times before the first keyframe get the first one)"""
+    return [keyframes[max(bisect.bisect_right(keyframes, t + 0.0005) - 1, 0)] for t in times]
+
+
+def get_probe_cache_file(video_file):
+    """PROBE_CACHE_DIR file of a local video (keyed by path, size and mtime); None if the cache is off or remote"""
+    config = get_config()
+    if not config.probe_cache_dir or not os.path.isfile(video_file):
+        return None
+    stat = os.stat(video_file)
+    key = json.dumps([os.path.abspath(video_file), stat.st_size, stat.st_mtime])
+    return os.path.join(config.probe_cache_dir, "%s.json" % hashlib.sha1(key.encode()).hexdigest())
+
+
+def read_probe_cache(video_file):
+    """the probe cache entry of a video ({} on a miss): "probe" holds the probe_video result, "keyframes" the index"""
+    cache_file = get_probe_cache_file(video_file)
+    if not cache_file:
+        return {}
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_probe_cache(video_file, entry):
+    """store a probe cache entry atomically (concurrent jobs on one video each write a complete file)"""
+    cache_file = get_probe_cache_file(video_file)
+    if not cache_file:
+        return
+    if not os.path.exists(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = "%s.tmp%d-%d" % (cache_file, os.getpid(), threading.get_ident())
+    with open(tmp_file, "w") as f:
+        json.dump(dict(entry, path=os.path.abspath(video_file)), f)
+    os.replace(tmp_file, cache_file)
+
+
+def get_thumb_count(duration, thumb_rate):
+    """number of snapshots the fps=1/N filter emits for a video of the given duration"""
+    return max(int(math.floor(duration / thumb_rate + 0.5)), 1)
+
+
+def get_thumb_height(width, height, thumb_width=None):
+    """height of a thumbnail scaled with scale=THUMB_WIDTH:-2 (keeps aspect ratio, rounded to an even number)"""
+    config = get_config()
+    if not thumb_width:
+        thumb_width = config.thumb_width
+    return int(math.floor(thumb_width * height / (width * 2.0) + 0.5)) * 2
+
+
+class SheetLayout(collections.namedtuple("SheetLayout", "columns rows")):
+    """columns x rows of thumbs on every sprite sheet of a task"""
+
+    def get_cells(self):
+        return self.columns * self.rows
+
+    def get_sheet_count(self, num_files):
+        return max(int(math.ceil(num_files / float(self.get_cells()))), 1)
+
+    def locate(self, num):
+        """(sheet index, column, row) of thumb num (0 based)"""
+        sheet, cell = divmod(num, self.get_cells())
+        return sheet, cell % self.columns, cell // self.columns
+
+
+def get_layout_limits(w, h):
+    """max (columns, rows) for w x h thumbs: SHEET_COLUMNS/SHEET_ROWS (or MAX_GRID_SIZE), within MAX_SHEET_PIXELS"""
+    config = get_config()
+    max_columns = config.sheet_columns or config.max_grid_size
+    max_rows = config.sheet_rows or config.max_grid_size
+    if config.max_sheet_pixels:
+        max_columns = max(min(max_columns, config.max_sheet_pixels // w), 1)
+        max_rows = max(min(max_rows, config.max_sheet_pixels // h), 1)
+    return max_columns, max_rows
+
+
+def plan_layout(num_files, w, h):
+    """
+    layout for num_files thumbs of w x h pixels: the fewest sheets, then the fewest empty cells on the last
+        sheet, then the squarest sheet in pixels
+    """
+    max_columns, max_rows = get_layout_limits(w, h)
+    num_files = max(num_files, 1)
+    best = None
+    for columns in range(1, max_columns + 1):
+        for rows in range(1, max_rows + 1):
+            layout = SheetLayout(columns, rows)
+            sheets = layout.get_sheet_count(num_files)
+            score = (sheets, sheets * layout.get_cells() - num_files, abs(columns * w - rows * h), -columns)
+            if best is None or score < best[0]:
+                best = (score, layout)
+    return best[1]
+
+
+class SheetPlan(collections.namedtuple("SheetPlan", "index first last file")):
+    """one sprite sheet: thumbs first..last-1 (0 based, counted over all sheets) go on file, sheet number index"""
+    __slots__ = ()
+
+
+def plan_sheets(sprite_file, layout, num_files, first_sheet=0, numbered=False):
+    """
+    the SheetPlan of every sheet from first_sheet on holding num_files thumbs laid out by layout, named like
+        montage (get_sprite_sheet_file); numbered=True always suffixes -0, -1, ... (append mode, the count grows)
+    """
+    per_sheet = layout.get_cells()
+    sheets = layout.get_sheet_count(num_files)
+    return [SheetPlan(index, index * per_sheet, min((index + 1) * per_sheet, num_files),
+                      get_sprite_sheet_file(sprite_file, index, None if numbered else sheets))
+            for index in range(first_sheet, sheets)]
+
+
+def get_sheet_jobs(sheets):
+    """sheets built at once for a plan of that many sheets"""
+    return max(min(get_config().sheet_jobs, sheets), 1)
+
+
+def build_sheets(plan, files, build):
+    """
+    build(files of the sheet, sheet) for every sheet of plan, SHEET_JOBS at a time, each in a copy of this context;
+        files[0] is the first thumb of plan[0]; returns the results in plan order
+    """
+    offset = plan[0].first
+    with ThreadPoolExecutor(max_workers=get_sheet_jobs(len(plan))) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, build,
+                               files[sheet.first - offset:sheet.last - offset], sheet) for sheet in plan]
+        return [future.result() for future in futures]
+
+
+def get_max_layout(w, h):
+    """the layout with the most cells for w x h thumbs, for when the number of thumbs isn't known up front"""
+    max_columns, max_rows = get_layout_limits(w, h)
+    return SheetLayout(max_columns, max_rows)
+
+
+def make_sprites_ffmpeg(video_file, sprite_file, num_files, layout, thumb_rate=None):
+    """
+    decode, take a snapshot every Nth second, scale and tile in one ffmpeg process;
+        sprite sheets are named like montage does: one sheet keeps the sprite file name,
+        several sheets are suffixed -0, -1, ...
+    """
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    do_cmd(get_sprites_ffmpeg_cmd(video_file, sprite_file, num_files, layout, thumb_rate))
+
+
+def get_sprites_ffmpeg_cmd(video_file, sprite_file, num_files, layout, thumb_rate):
+    """ffmpeg command for make_sprites_ffmpeg"""
+    config = get_config()
+    filters = get_fps_filters(thumb_rate, num_files + 1 if config.skip_first else num_files)
+    if config.skip_first:
+        """drop the first snapshot"""
+        filters.append("trim=start_frame=1")
+    filters.append("scale=%d:-2" % config.thumb_width)
+    filters.append("tile=%dx%d" % layout)
+    return "ffmpeg -y %s-i %s -an -vf %s %s" % (get_decode_args(), pipes.quote(video_file), ",".join(filters),
+                                               get_ffmpeg_sheets_output(sprite_file, num_files, layout))
+
+
+def get_ffmpeg_sheets_output(sprite_file, num_files, layout):
+    """ffmpeg output options writing tiled sheets under montage's names (-0, -1, ... when there are several)"""
+    if layout.get_sheet_count(num_files) > 1:
+        files_base_name, extension = os.path.splitext(sprite_file.replace("%", "%%"))
+        output = "-start_number 0 %s" % pipes.quote("%s-%%d%s" % (files_base_name, extension))
+    else:
+        output = "-frames:v 1 %s" % pipes.quote(sprite_file)
+    return "-q:v 2 -f image2 %s" % output
+
+
+def get_ladder_ffmpeg_cmd(video_file, rungs, num_files, thumb_rate):
+    """
+    ffmpeg command for a ladder: the snapshot frames are split into one scale + tile branch per rung,
+        rungs being (sprite file, thumb width, layout) tuples
+    """
+    config = get_config()
+    filters = get_fps_filters(thumb_rate, num_files + 1 if config.skip_first else num_files)
+    if config.skip_first:
+        filters.append("trim=start_frame=1")
+    graph = ["[0:v]%s,split=%d%s" % (",".join(filters), len(rungs), "".join("[s%d]" % i for i in range(len(rungs))))]
+    outputs = []
+    for i, (sprite_file, width, layout) in enumerate(rungs):
+        graph.append("[s%d]scale=%d:-2,tile=%dx%d[o%d]" % (i, width, layout.columns, layout.rows, i))
+        outputs.append("-map '[o%d]' %s" % (i, get_ffmpeg_sheets_output(sprite_file, num_files, layout)))
+    return "ffmpeg -y %s-i %s -an -filter_complex %s %s" % (
+        get_decode_args(), pipes.quote(video_file), pipes.quote(";".join(graph)), " ".join(outputs))
+
+
 def get_thumb_images(new_dir):
     return glob.glob("%s/tv*.jpg" % new_dir)
 
 
+def split_files(files, jobs=None):
+    """split files into up to jobs (default OPTIMIZE_JOBS) interleaved shares for multi-file optimizer commands"""
+    config = get_config()
+    jobs = max(min(jobs or config.optimize_jobs, len(files)), 1)
+    return [files[i::jobs] for i in range(jobs) if files[i::jobs]]
+
+
+def run_cmds_parallel(cmds):
+    """run commands concurrently, each in a copy of this context so its usage is added to the active stages"""
+    with ThreadPoolExecutor(max_workers=len(cmds)) as pool:
+        for future in [pool.submit(contextvars.copy_context().run, do_cmd, cmd) for cmd in cmds]:
+            future.result()
+
+
 def optimize_sprites_optipng(files):
-    for file in files:
-        cmd = "optipng %s" % (pipes.quote(file))
-        do_cmd(cmd)
+    if files:
+        run_cmds_parallel(["optipng %s" % " ".join(map(pipes.quote, share)) for share in split_files(files)])
+
+
+def get_jpegoptim_cmds(files, factor, jobs=None):
+    """jpegoptim commands for optimize_sprites_jpegoptim, one multi-file command per share of the files"""
+    option = "-m %s " % factor if factor else ""
+    return ["jpegoptim %s%s" % (option, " ".join(map(pipes.quote, share))) for share in split_files(files, jobs)]
 
 
 def optimize_sprites_jpegoptim(files, factor):
-    if factor:
-        for file in files:
-            cmd = "jpegoptim -m %s %s" % (factor, pipes.quote(file))
-            do_cmd(cmd)
+    """optimize the sprites with OPTIMIZE_JOBS concurrent jpegoptim processes"""
+    if files:
+        run_cmds_parallel(get_jpegoptim_cmds(files, factor))
+
+
+def needs_optimize_pass(engine=None):
+    """
+    False when the JPEG sheets are replaced by webp/avif ones, or SINGLE_ENCODE already wrote them optimized
+        (every engine but ffmpeg)
+    """
+    config = get_config()
+    if config.sprite_format in ("webp", "avif"):
+        return False
+    return not config.single_encode or (engine or get_engine()) == "ffmpeg"
+
+
+def get_sprite_encode_cmd(sprite_file, out_file, sprite_format):
+    """ffmpeg command encoding a JPEG sprite sheet as webp or avif"""
+    config = get_config()
+    if sprite_format == "webp":
+        codec = "-c:v libwebp -quality %d -compression_level 6" % config.sprite_webp_quality
+    elif sprite_format == "avif":
+        codec = "-c:v libaom-av1 -still-picture 1 -crf %d -cpu-used 6 -pix_fmt yuv420p" % config.sprite_avif_crf
     else:
-        for file in files:
-            cmd = "jpegoptim %s" % (pipes.quote(file))
-            do_cmd(cmd)
+        raise ValueError("Unknown sprite format: %s" % sprite_format)
+    return "ffmpeg -y -loglevel error -i %s %s %s" % (pipes.quote(sprite_file), codec, pipes.quote(out_file))
+
+
+def get_ssim_cmd(reference_file, file):
+    """ffmpeg command comparing two images of the same size with the ssim filter"""
+    return "ffmpeg -nostats -i %s -i %s -lavfi ssim -f null -" % (pipes.quote(reference_file), pipes.quote(file))
 
 
-def get_sprite_images(sprite_file):
+def parse_ssim(output):
+    """the overall ("All:") SSIM printed by the ssim filter"""
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", "replace")
+    return float(output.rsplit("All:", 1)[1].split()[0])
+
+
+def encode_sprite(sprite_file, formats, min_ssim=None):
+    """
+    encode a JPEG sheet in each format and return the file to keep, deleting the others: with min_ssim, the
+        smallest candidate (the JPEG included) at least that close to the JPEG; without, the single format asked for
+    """
     files_base_name, extension = os.path.splitext(sprite_file)
-    return glob.glob("%s*%s" % (files_base_name, extension))
+    best = sprite_file
+    for sprite_format in formats:
+        out_file = "%s.%s" % (files_base_name, sprite_format)
+        if min_ssim is None:
+            do_cmd(get_sprite_encode_cmd(sprite_file, out_file, sprite_format))
+            best = out_file
+            continue
+        try:
+            do_cmd(get_sprite_encode_cmd(sprite_file, out_file, sprite_format))
+            ssim = parse_ssim(do_cmd(get_ssim_cmd(sprite_file, out_file)))
+        except subprocess.CalledProcessError:
+            logger.warning("Can't encode %s as %s, skipped" % (sprite_file, sprite_format))
+            continue
+        size = os.path.getsize(out_file)
+        logger.info("%s: %d bytes, SSIM %.4f" % (out_file, size, ssim))
+        if ssim >= min_ssim and size < os.path.getsize(best):
+            if best != sprite_file:
+                os.unlink(best)
+            best = out_file
+        else:
+            os.unlink(out_file)
+    if best != sprite_file:
+        os.unlink(sprite_file)
+    return best
+
+
+def encode_sprites(files):
+    """
+    re-encode JPEG sheets following SPRITE_FORMAT, OPTIMIZE_JOBS sheets at a time; returns the files kept,
+        in sheet order, for make_vtt to reference
+    """
+    config = get_config()
+    if config.sprite_format == "jpeg" or not files:
+        return files
+    if config.sprite_format == "auto":
+        formats, min_ssim = config.sprite_auto_formats, config.sprite_min_ssim
+    else:
+        formats, min_ssim = [config.sprite_format], None
+    with ThreadPoolExecutor(max_workers=min(config.optimize_jobs, len(files))) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, encode_sprite, file, formats, min_ssim)
+                   for file in files]
+        return [future.result() for future in futures]
+
+
+def get_encode_args():
+    """montage output options for SINGLE_ENCODE: target quality, optimized Huffman tables, progressive"""
+    config = get_config()
+    if config.single_encode:
+        return "-quality %d -define jpeg:optimize-coding=true -interlace Plane " % config.sprite_quality
+    return ""
 
 
 def resize(files):
     """change image output size to 100 width (originally matches size of video)
       - pass a list of files as string rather than use '*' with sips command because
         subprocess does not treat * as wildcard like shell does"""
-    if USE_SIPS:
+    for cmd in get_resize_cmds(files):
+        do_cmd(cmd)
+
+
+def get_resize_cmds(files):
+    """resize commands over RESIZE_BATCH_SIZE files each"""
+    batch_size = get_config().resize_batch_size
+    return [get_resize_cmd(files[start:start + batch_size]) for start in range(0, len(files), batch_size)]
+
+
+def get_resize_cmd(files):
+    """sips/mogrify command for resize"""
+    config = get_config()
+    if config.use_sips:
         # HERE IS MAC SPECIFIC PROGRAM THAT YIELDS SLIGHTLY SMALLER JPGs
-        do_cmd("sips --resampleWidth %d %s" % (THUMB_WIDTH, " ".join(map(pipes.quote, files))))
-    else:
-        # THIS COMMAND WORKS FINE TOO AND COMES WITH IMAGEMAGICK, IF NOT USING A MAC
-        do_cmd("mogrify -geometry %dx %s" % (THUMB_WIDTH, " ".join(map(pipes.quote, files))))
+        return "sips --resampleWidth %d %s" % (config.thumb_width, " ".join(map(pipes.quote, files)))
+    # THIS COMMAND WORKS FINE TOO AND COMES WITH IMAGEMAGICK, IF NOT USING A MAC
+    return "mogrify %s-geometry %dx %s" % (get_limit_args(), config.thumb_width, " ".join(map(pipes.quote, files)))
+
+
+def get_limit_args(jobs=1):
+    """ImageMagick -limit options for IMAGEMAGICK_LIMITS, for one of jobs concurrent processes"""
+    limits = get_config().imagemagick_limits or {}
+    return "".join("-limit %s %s " % (name, pipes.quote(split_limit(limits[name], jobs) if name in SHARED_LIMITS
+                                                        else str(limits[name]))) for name in sorted(limits))
+
+
+def split_limit(value, jobs):
+    """
+    one jobs-th of an ImageMagick size (a byte count or e.g. 256MiB, 1GB), in bytes; anything else (e.g.
+        "unlimited") is returned unchanged
+    """
+    match = re.match(r"(\d+(?:\.\d+)?)([KMGTP]?)(i?)B?$", str(value).strip(), re.IGNORECASE)
+    if not match or jobs <= 1:
+        return str(value)
+    number, prefix, binary = match.groups()
+    scale = (1024 if binary else 1000) ** ("KMGTP".index(prefix.upper()) + 1 if prefix else 0)
+    return str(int(float(number) * scale / jobs))
 
 
 def get_geometry(file):
@@ -206,104 +1392,487 @@ def get_geometry(file):
         100x66+0+0 - _tv001.jpg
         100x2772+0+0 - sprite2.jpg
         4200x66+0+0 - sprite2h.jpg"""
-    geom = do_cmd("""identify -format "%%g - %%f\n" %s""" % pipes.quote(file))
+    geom = do_cmd(get_geometry_cmd(file))
+    return parse_geometry(geom)
+
+
+def get_geometry_cmd(file):
+    """identify command for get_geometry"""
+    return """identify -format "%%g - %%f\n" %s""" % pipes.quote(file)
+
+
+def parse_geometry(geom):
     parts = geom.decode().split("-", 1)
     return parts[0].strip()  # return just the geometry prefix of the line, sans extra whitespace
 
 
-def make_vtt(sprite_files, num_segments, coords, grid_size, writefile, thumb_rate=None):
-    """generate & write vtt file mapping video time to each image's coordinates
-    in our spritemap"""
-    if not thumb_rate:
-        thumb_rate = THUMB_RATE_SECONDS
+def get_cell_size(coords):
+    """(w, h) of a WxH+X+Y geometry"""
     wh, xy = coords.split("+", 1)
     w, h = wh.split("x")
-    w = int(w)
-    h = int(h)
+    return int(w), int(h)
 
-    vtt = ["WEBVTT", ""]  # line buffer for file contents
-    if SKIP_FIRST:
-        clipstart = thumb_rate  # offset time to skip the first image
-    else:
-        clipstart = 0
-
-    clipend = clipstart + thumb_rate
-    adjust = thumb_rate * TIME_SYNC_ADJUST
-
-    sprites_count = len(sprite_files)
-
-    if sprites_count == 1:
-        base_file = os.path.basename(sprite_files[0])
-        for img_num in range(1, num_segments + 1):
-            xywh = get_grid_coordinates(img_num - 1, grid_size, w, h)
-            start = get_time_str(clipstart, adjust=adjust)
-            end = get_time_str(clipend, adjust=adjust)
-            clipstart = clipend
-            clipend += thumb_rate
-            # vtt.append("Img %d" % img_num)
-            vtt.append("%s --> %s" % (start, end))  # 00:00.000 --> 00:05.000
-            vtt.append("%s#xywh=%s" % (base_file, xywh))
-            vtt.append("")  # Linebreak
+
+def make_vtt(sprite_files, num_segments, coords, layout, writefile, thumb_rate=None, times=None, cells=None):
+    """generate & write vtt file mapping video time to each image's coordinates
+    in our spritemap (sprite_files in sheet order, cells placed by layout); times optionally gives the
+    (start, end) seconds of every cue instead of thumb_rate slots, cells the sprite cell of every cue when
+    several cues share one (see dedup_thumbs); returns the files written (the VTT and its VTT_INDEX_FORMAT index)"""
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    w, h = get_cell_size(coords)
+    if times:
+        cue_times = [(get_time_ms(start), get_time_ms(end)) for start, end in times[:num_segments]]
     else:
-        for img_num in range(1, num_segments + 1):
-            xywh = get_grid_coordinates(img_num - 1, grid_size, w, h)
-            start = get_time_str(clipstart, adjust=adjust)
-            end = get_time_str(clipend, adjust=adjust)
-            clipstart = clipend
-            clipend += thumb_rate
-            # vtt.append("Img %d" % img_num)
-            vtt.append("%s --> %s" % (start, end))  # 00:00.000 --> 00:05.000
-            file_index = math.floor(img_num / (grid_size ** 2))
-            base_file = os.path.basename(sprite_files[file_index])
-            vtt.append("%s#xywh=%s" % (base_file, xywh))
-            vtt.append("")  # Linebreak
-
-    vtt = "\n".join(vtt)
+        cue_times = get_cue_times(0, num_segments, thumb_rate)
+    cue_cells = cells[:num_segments] if cells else range(num_segments)
+    sprites = [os.path.basename(file) for file in sprite_files]
+    cues = [VttCue(start, end, sprites[layout.locate(cell)[0]], *get_grid_position(cell, layout, w, h), w, h)
+            for (start, end), cell in zip(cue_times, cue_cells)]
+
     # output to file
-    write_vtt(writefile, vtt)
+    write_vtt(writefile, format_vtt(cues, header=True))
+    files = [writefile]
+    if config.vtt_index_format:
+        files.append(write_vtt_index(writefile, SpriteIndex(cues), config.vtt_index_format))
+    return files
+
+
+class VttCue(collections.namedtuple("VttCue", "start_ms end_ms sprite x y w h")):
+    """one VTT cue: start/end in integer milliseconds, the sprite sheet file name and the thumb's xywh on it"""
+    __slots__ = ()
 
 
-def get_time_str(numseconds, adjust=None):
-    """ convert time in seconds to VTT format time (HH:)MM:SS.ddd"""
-    if adjust:  # offset the time by the adjust amount, if applicable
-        seconds = max(numseconds + adjust, 0)  # don't go below 0! can't have a negative timestamp
+def get_cue_times(first_num, last_num, thumb_rate):
+    """
+    (start, end) milliseconds of the thumb_rate cues first_num..last_num-1 (0 based), offset by SKIP_FIRST and
+        TIME_SYNC_ADJUST; integer arithmetic, so times never drift over thousands of cues
+    """
+    config = get_config()
+    rate = get_time_ms(thumb_rate)
+    offset = (rate if config.skip_first else 0) + int(round(thumb_rate * config.time_sync_adjust * 1000))
+    """don't go below 0! can't have a negative timestamp"""
+    return [(max(offset + num * rate, 0), max(offset + (num + 1) * rate, 0)) for num in range(first_num, last_num)]
+
+
+def format_vtt(cues, header=False):
+    """VTT text of cues, each followed by a blank line; header=True starts a new file"""
+    vtt = ["WEBVTT", ""] if header else []  # line buffer for file contents
+    for cue in cues:
+        vtt.append("%s --> %s" % (format_time_ms(cue.start_ms), format_time_ms(cue.end_ms)))
+        vtt.append("%s#xywh=%d,%d,%d,%d" % (cue.sprite, cue.x, cue.y, cue.w, cue.h))
+        vtt.append("")  # Linebreak
+    return "\n".join(vtt)
+
+
+def get_time_ms(seconds):
+    """time in seconds as integer milliseconds"""
+    return int(round(seconds * 1000))
+
+
+def format_time_ms(ms):
+    """integer milliseconds in VTT format HH:MM:SS.ddd (hours keep counting past 24)"""
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%02d:%02d:%02d.%03d" % (hours, minutes, seconds, ms)
+
+
+def parse_time_ms(time_str):
+    """VTT time (HH:)MM:SS.ddd as integer milliseconds"""
+    clock, sep, fraction = time_str.strip().partition(".")
+    seconds = 0
+    for part in clock.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds * 1000 + int(fraction.ljust(3, "0")[:3] or 0)
+
+
+def read_vtt_cues(vtt_file):
+    """the cues of a VTT file written by make_vtt/append_vtt, read line by line"""
+    with open(vtt_file, 'r') as f:
+        times = None
+        for line in f:
+            if " --> " in line:
+                times = line.split(" --> ")
+            elif times and "#xywh=" in line:
+                sprite, xywh = line.strip().rsplit("#xywh=", 1)
+                yield VttCue(parse_time_ms(times[0]), parse_time_ms(times[1].split()[0]), sprite,
+                             *map(int, xywh.split(",")))
+                times = None
+
+
+class SpriteIndex:
+    """
+    in-memory time -> sprite cell index over the cues of one VTT: lookup() bisects the cue start times
+        (O(log n)); to_json()/to_bytes() export it for player backends, from_json()/from_bytes() load it back
+    """
+
+    """binary format: magic, version, sprite count, cue count, sprite names (length prefixed utf-8), then per cue
+     start/end ms, sprite number, x, y, w, h; little endian"""
+    MAGIC = b"VTIX"
+    HEADER = struct.Struct("<4sHHI")
+    NAME_LENGTH = struct.Struct("<H")
+    CUE = struct.Struct("<IIHIIHH")
+
+    def __init__(self, cues):
+        self.cues = sorted(cues)
+        self.starts = [cue.start_ms for cue in self.cues]
+
+    def __len__(self):
+        return len(self.cues)
+
+    def lookup(self, seconds):
+        """the VttCue showing at a time in seconds, None outside every cue"""
+        ms = get_time_ms(seconds)
+        i = bisect.bisect_right(self.starts, ms) - 1
+        if i < 0 or ms >= self.cues[i].end_ms:
+            return None
+        return self.cues[i]
+
+    def get_sprites(self):
+        """sprite file names in order of first use"""
+        return list(collections.OrderedDict.fromkeys(cue.sprite for cue in self.cues))
+
+    def to_json(self):
+        sprites = self.get_sprites()
+        numbers = {sprite: num for num, sprite in enumerate(sprites)}
+        return json.dumps({"version": 1, "sprites": sprites,
+                           "cues": [[cue.start_ms, cue.end_ms, numbers[cue.sprite], cue.x, cue.y, cue.w, cue.h]
+                                    for cue in self.cues]}, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data):
+        index = json.loads(data)
+        sprites = index["sprites"]
+        return cls(VttCue(start, end, sprites[num], x, y, w, h) for start, end, num, x, y, w, h in index["cues"])
+
+    def to_bytes(self):
+        sprites = self.get_sprites()
+        numbers = {sprite: num for num, sprite in enumerate(sprites)}
+        data = [self.HEADER.pack(self.MAGIC, 1, len(sprites), len(self.cues))]
+        for sprite in sprites:
+            name = sprite.encode("utf-8")
+            data.append(self.NAME_LENGTH.pack(len(name)) + name)
+        data.extend(self.CUE.pack(cue.start_ms, cue.end_ms, numbers[cue.sprite], cue.x, cue.y, cue.w, cue.h)
+                    for cue in self.cues)
+        return b"".join(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, num_sprites, num_cues = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC:
+            raise ValueError("Not a sprite index")
+        offset = cls.HEADER.size
+        sprites = []
+        for unused in range(num_sprites):
+            length, = cls.NAME_LENGTH.unpack_from(data, offset)
+            offset += cls.NAME_LENGTH.size
+            sprites.append(data[offset:offset + length].decode("utf-8"))
+            offset += length
+        cues = []
+        for start, end, num, x, y, w, h in cls.CUE.iter_unpack(data[offset:offset + num_cues * cls.CUE.size]):
+            cues.append(VttCue(start, end, sprites[num], x, y, w, h))
+        return cls(cues)
+
+    @classmethod
+    def load(cls, index_file):
+        """read an index written by write_vtt_index, JSON or binary"""
+        with open(index_file, 'rb') as f:
+            data = f.read()
+        if data.startswith(cls.MAGIC):
+            return cls.from_bytes(data)
+        return cls.from_json(data.decode("utf-8"))
+
+
+def get_vtt_index_file(vtt_file, index_format):
+    """the index file written next to a VTT: *_thumbs.json or *_thumbs.idx"""
+    return "%s%s" % (os.path.splitext(vtt_file)[0], ".json" if index_format == "json" else ".idx")
+
+
+def write_vtt_index(vtt_file, index, index_format):
+    """write index next to vtt_file in index_format ("json" or "binary"); returns the index file"""
+    index_file = get_vtt_index_file(vtt_file, index_format)
+    if index_format == "json":
+        with open(index_file, 'w') as f:
+            f.write(index.to_json())
     else:
-        seconds = numseconds
-    delta = relativedelta.relativedelta(seconds=seconds)
-    return "%02d:%02d:%02d.000" % (delta.hours, delta.minutes, delta.seconds)
+        with open(index_file, 'wb') as f:
+            f.write(index.to_bytes())
+    logger.info("Wrote: %s" % index_file)
+    return index_file
+
 
+def get_grid_position(img_num, layout, w, h):
+    """pixel x, y of an image number (0 based, counted over all sheets) on its sheet"""
+    sheet, x, y = layout.locate(img_num)
+    return x * w, y * h
 
-# def get_grid_coordinates(imgnum, gridsize, w, h):
-#     """ given an image number in our sprite, map the coordinates to it in X,Y,W,H format"""
-#     y = (imgnum - 1) / gridsize
-#     x = (imgnum - 1) - (y * gridsize)
-#     imgx = x * w
-#     imgy = y * h
-#     return "%s,%s,%s,%s" % (imgx, imgy, w, h)
 
-def get_grid_coordinates(img_num, grid_size, w, h):
-    """ given an image number in our sprite, map the coordinates to it in X,Y,W,H format"""
-    y = int(img_num / grid_size)
-    x = int(img_num - (y * grid_size))
-    img_x = x * w
-    img_y = y * h
-    return "%s,%s,%s,%s" % (img_x, img_y, w, h)
+def makesprite_files(files, spritefile, coords, layout, jobs=1):
+    """montage an explicit list of (at most one layout's worth of) thumbs into one sheet, one of jobs at once"""
+    do_cmd(get_makesprite_files_cmd(files, spritefile, coords, layout, jobs))
 
 
-def makesprite(outdir, spritefile, coords, gridsize):
+def get_makesprite_files_cmd(files, spritefile, coords, layout, jobs=1):
+    """
+    montage command for makesprite_files, under its share of IMAGEMAGICK_LIMITS; JPEG thumbs are decoded at a
+        reduced size (jpeg:size hint) when they are much larger than the cell
+    """
+    grid = "%dx%d" % layout
+    w, h = get_cell_size(coords)
+    return "montage %s-define jpeg:size=%dx%d -background transparent %s -tile %s -geometry %s %s%s" % (
+        get_limit_args(jobs), w * 2, h * 2, " ".join(map(pipes.quote, files)), grid, coords, get_encode_args(),
+        pipes.quote(spritefile))
+
+
+def makesprite(files, spritefile, coords, layout):
     """montage _tv*.jpg -tile 8x8 -geometry 100x66+0+0 montage.jpg  #GRID of images
            NOT USING: convert tv*.jpg -append sprite.jpg     #SINGLE VERTICAL LINE of images
            NOT USING: convert tv*.jpg +append sprite.jpg     #SINGLE HORIZONTAL LINE of images
-     base the sprite size on the number of thumbs we need to make into a grid."""
-    grid = "%dx%d" % (gridsize, gridsize)
-    cmd = "montage -background transparent %s/tv*.jpg -tile %s -geometry %s %s" % (
-        pipes.quote(outdir), grid, coords, pipes.quote(spritefile))
-    do_cmd(cmd)
+     base the sprite size on the number of thumbs we need to make into a grid.
+     One montage per sheet of plan_sheets, SHEET_JOBS at a time, each given only its own thumbs; returns the
+     sheets in order"""
+    plan = plan_sheets(spritefile, layout, len(files))
+    jobs = get_sheet_jobs(len(plan))
+    build_sheets(plan, sort_thumbs(files), lambda sheet_files, sheet: makesprite_files(sheet_files, sheet.file,
+                                                                                       coords, layout, jobs))
+    return [sheet.file for sheet in plan]
+
+
+def get_makesprite_cmds(files, spritefile, coords, layout):
+    """
+    montage commands for makesprite, one per sheet of plan_sheets in sheet order, each with the IMAGEMAGICK_LIMITS
+        share of one of get_sheet_jobs concurrent commands
+    """
+    files = sort_thumbs(files)
+    plan = plan_sheets(spritefile, layout, len(files))
+    jobs = get_sheet_jobs(len(plan))
+    return [get_makesprite_files_cmd(files[sheet.first:sheet.last], sheet.file, coords, layout, jobs)
+            for sheet in plan]
+
+
+def sort_thumbs(files):
+    """thumbs in snapshot order (tv99999.jpg before tv100000.jpg)"""
+    return sorted(files, key=lambda file: (len(os.path.basename(file)), file))
+
+
+def get_sprite_sheet_file(sprite_file, index, sheets):
+    """name of sprite sheet #index, following montage: a single sheet keeps the name, several get -0, -1, ...
+     (sheets may be None when there is more than one sheet but the total is not known yet)"""
+    if sheets == 1:
+        return sprite_file
+    files_base_name, extension = os.path.splitext(sprite_file)
+    return "%s-%d%s" % (files_base_name, index, extension)
+
+
+def load_thumb(file, width):
+    """decode a snapshot at reduced size (JPEG draft mode) and resize it like mogrify -geometry Wx"""
+    img = Image.open(file)
+    height = max(int(width * img.height / float(img.width) + 0.5), 1)
+    img.draft("RGB", (width, height))
+    return img.convert("RGB").resize((width, height), Image.LANCZOS)
+
+
+def save_sheet(sheet, num, w, h, layout, sheet_file):
+    """write a sprite sheet holding num thumbs, trimmed to the columns/rows in use like montage does"""
+    config = get_config()
+    columns = min(layout.columns, num)
+    rows = int(math.ceil(num / float(layout.columns)))
+    sheet.crop((0, 0, columns * w, rows * h)).save(sheet_file, "JPEG", quality=config.sprite_quality,
+                                                   optimize=config.single_encode, progressive=config.single_encode)
+    logger.info("Wrote: %s" % sheet_file)
+
+
+def paste_sheets(thumbs, spritefile, layout, sheets):
+    """
+    paste thumbs (an iterable of same size images) into layout sized sheets, writing each sheet
+        as soon as it is full so only one sheet is held in memory; sheets is passed to get_sprite_sheet_file
+        (None when there is more than one sheet but the count is not known yet); returns (count, w, h)
+    """
+    per_sheet = layout.get_cells()
+    sheet = None
+    index = 0
+    num = count = w = h = 0
+    for thumb in thumbs:
+        if sheet is None:
+            w, h = thumb.size
+            sheet = Image.new("RGB", (layout.columns * w, layout.rows * h))
+        sheet.paste(thumb, ((num % layout.columns) * w, (num // layout.columns) * h))
+        num += 1
+        count += 1
+        if num == per_sheet:
+            save_sheet(sheet, num, w, h, layout, get_sprite_sheet_file(spritefile, index, sheets))
+            sheet = None
+            index += 1
+            num = 0
+    if sheet is not None:
+        save_sheet(sheet, num, w, h, layout, get_sprite_sheet_file(spritefile, index, sheets))
+    return count, w, h
+
+
+def make_sprites_pillow(files, spritefile, width=None):
+    """
+    in-process replacement for resize + get_geometry + makesprite: thumbs are resized in memory (to width,
+        default THUMB_WIDTH) and pasted into sheets laid out by plan_layout, each sheet built by its own thread
+        (see build_sheets) and encoded once; returns (the thumb geometry in identify's WxH+0+0 form, layout)
+    """
+    config = get_config()
+    width = width or config.thumb_width
+    files = sort_thumbs(files)
+    layout = plan_layout(len(files), *load_thumb(files[0], width).size)
+    sizes = build_sheets(plan_sheets(spritefile, layout, len(files)), files,
+                         lambda sheet_files, sheet: make_sheet_pillow(sheet_files, sheet.file, layout, width))
+    return "%dx%d+0+0" % sizes[0], layout
+
+
+def make_sheet_pillow(files, sheet_file, layout, width):
+    """resize files (at most one sheet's worth) in memory and paste them into sheet_file; returns the thumb (w, h)"""
+    count, w, h = paste_sheets((load_thumb(file, width) for file in files), sheet_file, layout, 1)
+    return w, h
+
+
+def get_dhash(file):
+    """(64 bit difference hash, mean brightness) of an image: one bit per horizontally adjacent pair of a 9x8 gray
+     thumbnail; the mean tells flat frames apart (a black and a white frame have the same hash)"""
+    img = Image.open(file)
+    img.draft("L", (36, 32))
+    pixels = img.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = bits << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits, sum(pixels) / len(pixels)
+
 
+def is_duplicate(a, b):
+    """True when two get_dhash results are within DEDUP_MAX_DISTANCE and DEDUP_MAX_LUMA_DIFF"""
+    config = get_config()
+    return bin(a[0] ^ b[0]).count("1") <= config.dedup_max_distance and abs(a[1] - b[1]) <= config.dedup_max_luma_diff
 
-def write_vtt(vtt_file, contents):
+
+def dedup_thumbs(files):
+    """
+    delete thumbs that look the same as an earlier one (see DEDUP_SCOPE); returns (kept files in order, cells)
+        where cells[n] is the index in the kept files (the sprite cell) shown by cue n
+    """
+    config = get_config()
+    kept = []
+    hashes = []
+    cells = []
+    for file in sorted(files):
+        dhash = get_dhash(file)
+        if config.dedup_scope == "global":
+            match = next((cell for cell, other in enumerate(hashes) if is_duplicate(dhash, other)), None)
+        else:
+            match = len(hashes) - 1 if hashes and is_duplicate(dhash, hashes[-1]) else None
+        if match is None:
+            kept.append(file)
+            hashes.append(dhash)
+            cells.append(len(kept) - 1)
+        else:
+            os.unlink(file)
+            cells.append(match)
+    logger.info("%d of %d thumbs kept after dedup" % (len(kept), len(cells)))
+    return kept, cells
+
+
+def read_frames(pipe, frame_size):
+    """yield fixed-size raw frames from an ffmpeg rawvideo pipe until it is exhausted"""
+    while True:
+        buf = pipe.read(frame_size)
+        if len(buf) < frame_size:
+            return
+        yield buf
+
+
+def make_sprites_stream(video_file, sprite_file, thumb_rate=None):
+    """
+    have ffmpeg take a snapshot every Nth second, scale it and write it as raw rgb24 to stdout, then paste
+        the frames straight into the sprite sheets: no tv*.jpg files and a single JPEG encode per sheet;
+        returns (num_files, layout, coordinates)
+    """
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    info = probe_video(video_file)
+    w = config.thumb_width
+    h = get_thumb_height(info["width"], info["height"])
+    slots = get_thumb_count(info["duration"], thumb_rate)
+    filters = get_fps_filters(thumb_rate, slots)
+    if config.skip_first:
+        """drop the first snapshot"""
+        filters.append("trim=start_frame=1")
+    filters.append("scale=%d:%d" % (w, h))
+    """passthrough: after trim the rawvideo output's vsync would duplicate a frame to fill the dropped slot"""
+    cmd = "ffmpeg -nostats -loglevel error %s-i %s -an -vf %s -vsync passthrough -f rawvideo -pix_fmt rgb24 -" % (
+        get_decode_args(), pipes.quote(video_file), ",".join(filters))
+    logger.info("START [%s] : %s " % (datetime.datetime.now(), cmd))
+    start = time.monotonic()
+    """stderr goes to a file: a pipe nobody reads until stdout ends would block ffmpeg once it fills up"""
+    errors = tempfile.TemporaryFile()
+    with process_slot() as track:
+        proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=errors)
+        track(proc)
+        frames = (Image.frombuffer("RGB", (w, h), buf, "raw", "RGB", 0, 1)
+                  for buf in read_frames(proc.stdout, w * h * 3))
+        """
+        plan the layout from the expected thumb count like the other engines; read up to one full sheet ahead:
+            if the stream ends within it (e.g. a damaged file), everything fits one (smaller) sheet
+        """
+        layout = plan_layout(slots - 1 if config.skip_first else slots, w, h)
+        head = list(itertools.islice(frames, layout.get_cells() + 1))
+        if len(head) <= layout.get_cells():
+            layout = plan_layout(len(head), w, h)
+            sheets = 1
+        else:
+            sheets = None
+        num_files, w, h = paste_sheets(itertools.chain(head, frames), sprite_file, layout, sheets)
+        proc.stdout.close()
+        returncode, rusage = wait_process(proc)
+    errors.seek(0)
+    error = errors.read()
+    errors.close()
+    record_process(shlex.split(cmd), start, returncode, rusage)
+    if returncode != 0:
+        ret = "ERROR   [%s] An exception occurred\n%s" % (datetime.datetime.now(), error)
+        logger.error(ret)
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=error)
+    logger.info("END   [%s]\n%d frames streamed" % (datetime.datetime.now(), num_files))
+    return num_files, layout, "%dx%d+0+0" % (w, h)
+
+
+def count_vtt_cues(vtt_file):
+    """number of cues in an existing VTT file (0 if there is none yet)"""
+    if not os.path.exists(vtt_file):
+        return 0
+    with open(vtt_file) as f:
+        return sum(1 for line in f if " --> " in line)
+
+
+def append_vtt(vtt_file, sprite_file, first_num, last_num, coords, layout, thumb_rate=None):
+    """append cues first_num..last_num-1 (0 based) to a VTT file written in append mode, creating it if needed;
+     cue n is placed by layout.locate(n). The VTT_INDEX_FORMAT index is rewritten from the whole VTT"""
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    w, h = get_cell_size(coords)
+    cues = [VttCue(start, end, os.path.basename(get_sprite_sheet_file(sprite_file, layout.locate(num)[0], None)),
+                   *get_grid_position(num, layout, w, h), w, h)
+            for num, (start, end) in enumerate(get_cue_times(first_num, last_num, thumb_rate), first_num)]
+
+    """a new file starts with the header, appended cues with the blank line separating them from the last cue"""
+    if first_num:
+        write_vtt(vtt_file, "\n" + format_vtt(cues), mode="a")
+    else:
+        write_vtt(vtt_file, format_vtt(cues, header=True))
+    if config.vtt_index_format:
+        write_vtt_index(vtt_file, SpriteIndex(read_vtt_cues(vtt_file)), config.vtt_index_format)
+
+
+def write_vtt(vtt_file, contents, mode="w"):
     """ output VTT file """
-    with open(vtt_file, mode="w") as file:
+    with open(vtt_file, mode=mode) as file:
         file.write(contents)
     logger.info("Wrote: %s" % vtt_file)
 
@@ -329,71 +1898,445 @@ def remove_old_thumb_files(files):
         os.remove(file)
 
 
+def get_file_hash(file):
+    """sha1 of a file's contents, read in 1MB chunks"""
+    digest = hashlib.sha1()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_cache_key(activity, thumb_rate):
+    """
+    cache key for a task: identity of the source video plus every setting, except the CACHE_KEY_IGNORED ones
+        that only change where or how fast the output is made
+    """
+    config = get_config()
+    video_file = activity.get_video_file()
+    stat = os.stat(video_file)
+    key = {name: value for name, value in config._asdict().items() if name not in CACHE_KEY_IGNORED}
+    key.update({
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "prefix": os.path.basename(activity.get_sprite_file()),
+        "thumb_rate": thumb_rate,
+        "decode": get_decode_settings(),
+    })
+    if config.cache_hash_content:
+        key["sha1"] = get_file_hash(video_file)
+    else:
+        key["path"] = os.path.abspath(video_file)
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+def read_cache_manifest(entry_dir):
+    """file name -> size of a complete cache entry, or None if the entry is missing or damaged"""
+    try:
+        with open(os.path.join(entry_dir, "manifest.json")) as f:
+            files = json.load(f)["files"]
+        for name, size in files.items():
+            if os.path.getsize(os.path.join(entry_dir, name)) != size:
+                return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return files
+
+
+def restore_from_cache(cache_key, out_dir):
+    """copy a cached sprite/VTT set into out_dir; returns False on a cache miss"""
+    config = get_config()
+    entry_dir = os.path.join(config.cache_dir, cache_key)
+    files = read_cache_manifest(entry_dir)
+    if not files:
+        return False
+    try:
+        for name in files:
+            shutil.copyfile(os.path.join(entry_dir, name), os.path.join(out_dir, name))
+        """touch the entry so eviction sees it as recently used"""
+        os.utime(entry_dir)
+    except OSError:
+        """evicted by another job while copying"""
+        return False
+    logger.info("Cache hit %s: restored %d files into %s" % (cache_key, len(files), out_dir))
+    return True
+
+
+def store_in_cache(cache_key, files):
+    """
+    copy a finished sprite/VTT set into the cache (atomically, by renaming a temp dir) and evict old entries; when
+        another job stored the same key first, its complete entry is kept
+    """
+    config = get_config()
+    entry_dir = os.path.join(config.cache_dir, cache_key)
+    tmp_dir = "%s.tmp%d-%d" % (entry_dir, os.getpid(), threading.get_ident())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    manifest = {}
+    for file in files:
+        name = os.path.basename(file)
+        shutil.copyfile(file, os.path.join(tmp_dir, name))
+        manifest[name] = os.path.getsize(file)
+    with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+        json.dump({"files": manifest}, f)
+    if os.path.exists(entry_dir) and read_cache_manifest(entry_dir) is None:
+        discard_cache_entry(entry_dir)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        """the first complete entry wins (rename fails onto a non-empty dir)"""
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict_cache()
+
+
+def discard_cache_entry(entry_dir):
+    """remove a cache entry: renamed out of the way first, so readers never see it half deleted"""
+    trash_dir = "%s.tmp%d-%d.old" % (entry_dir, os.getpid(), threading.get_ident())
+    try:
+        os.rename(entry_dir, trash_dir)
+    except OSError:
+        """already gone, discarded by another job"""
+        return
+    shutil.rmtree(trash_dir, ignore_errors=True)
+
+
+def evict_cache(max_bytes=None):
+    """remove least recently used cache entries until the cache fits in max_bytes"""
+    config = get_config()
+    if max_bytes is None:
+        max_bytes = config.cache_max_bytes
+    entries = []
+    for name in os.listdir(config.cache_dir):
+        entry_dir = os.path.join(config.cache_dir, name)
+        if not os.path.isdir(entry_dir) or ".tmp" in name:
+            continue
+        files = read_cache_manifest(entry_dir) or {}
+        entries.append((os.path.getmtime(entry_dir), sum(files.values()), entry_dir))
+    entries.sort()
+    total = sum(size for mtime, size, entry_dir in entries)
+    for mtime, size, entry_dir in entries:
+        if total <= max_bytes:
+            break
+        logger.info("Evicting cache entry %s" % entry_dir)
+        discard_cache_entry(entry_dir)
+        total -= size
+
+
+def run_append(activity: SpriteTask, thumb_rate=None):
+    """
+    append mode for growing videos: the VTT tells how many snapshots are already covered and the out dir
+        still holds the thumbs of the partly filled last sheet; only snapshots past the last cue are extracted,
+        only the sheets from the partly filled one onward are rebuilt, and only the new cues are appended
+    """
+    config = get_config()
+    if not thumb_rate:
+        thumb_rate = config.thumb_rate_seconds
+    out_dir = activity.get_out_dir()
+    sprite_file = activity.get_sprite_file()
+    vtt_file = activity.get_vtt_file()
+    info = probe_video(activity.get_video_file())
+    """the biggest layout, so the sheets already written never change shape"""
+    layout = get_max_layout(config.thumb_width, get_thumb_height(info["width"], info["height"]))
+    per_sheet = layout.get_cells()
+
+    num_done = count_vtt_cues(vtt_file)
+    first_sheet = num_done // per_sheet
+    kept_files = sorted(get_thumb_images(out_dir))
+    if num_done and (not os.path.exists(get_sprite_sheet_file(sprite_file, 0, None))
+                     or len(kept_files) != num_done - first_sheet * per_sheet):
+        """not written in append mode, or thumbs of the last sheet are missing: start over"""
+        logger.info("Existing output in %s can't be appended to, rebuilding it" % out_dir)
+        for f in os.listdir(out_dir):
+            os.unlink(os.path.join(out_dir, f))
+        num_done = first_sheet = 0
+        kept_files = []
+
+    first = 1 if config.skip_first else 0
+    count = get_thumb_count(info["duration"], thumb_rate) - first
+    if count <= num_done:
+        logger.info("No new snapshots past %d in %s" % (num_done, activity.get_video_file()))
+        return
+    do_cmd(get_snaps_range_cmd(activity.get_video_file(), out_dir, thumb_rate, first + num_done, count - num_done))
+
+    """thumb_files[0] is the first thumb of sheet first_sheet"""
+    thumb_files = sorted(get_thumb_images(out_dir))
+    new_files = thumb_files[len(kept_files):]
+    total = num_done + len(new_files)
+    plan = plan_sheets(sprite_file, layout, total, first_sheet=first_sheet, numbered=True)
+    if config.image_backend == "pillow" and Image is not None:
+        sizes = build_sheets(plan, thumb_files, lambda sheet_files, sheet: make_sheet_pillow(
+            sheet_files, sheet.file, layout, config.thumb_width))
+        coordinates = "%dx%d+0+0" % sizes[0]
+    else:
+        resize(new_files)
+        coordinates = get_geometry(thumb_files[0])
+        jobs = get_sheet_jobs(len(plan))
+        build_sheets(plan, thumb_files, lambda sheet_files, sheet: makesprite_files(sheet_files, sheet.file,
+                                                                                    coordinates, layout, jobs))
+    if not config.single_encode:
+        optimize_sprites_jpegoptim([sheet.file for sheet in plan], False)
+
+    append_vtt(vtt_file, sprite_file, num_done, total, coordinates, layout, thumb_rate=thumb_rate)
+
+    """keep the thumbs of a partly filled last sheet for the next append"""
+    remove_old_thumb_files(thumb_files[:(total // per_sheet - first_sheet) * per_sheet])
+
+
 def run(activity: SpriteTask, thumb_rate=None):
     # add_logging()
+    config = activity.config
     if not thumb_rate:
-        thumb_rate = THUMB_RATE_SECONDS
+        thumb_rate = config.thumb_rate_seconds
+
+    """the whole job is reported as the "run" stage, with the number of thumbs and seconds of video covered"""
+    with use_config(config), stage_timer("run", video=activity.get_video_file(), engine=config.engine,
+                                         append=activity.append) as record:
+        if activity.append:
+            """growing video: only process what is new since the last run"""
+            run_append(activity, thumb_rate=thumb_rate)
+        else:
+            num_files = make_task_sprites(activity, thumb_rate)
+            record["thumbs"] = num_files
+            record["video_seconds"] = (num_files or 0) * thumb_rate
+
 
+def get_rung_file(file, width):
+    """name of a ladder rung's sprite or VTT file: the width goes before the extension"""
+    files_base_name, extension = os.path.splitext(file)
+    return "%s_%d%s" % (files_base_name, width, extension)
+
+
+def make_ladder_sprites(activity: SpriteTask, thumb_rate):
+    """
+    one sprite set and VTT per LADDER_WIDTHS rung from a single decode: the ffmpeg engine splits the frames
+        into a scale + tile branch per rung, the other engines take the snapshots once and tile them per rung;
+        returns (number of thumbs, every sprite and VTT file written)
+    """
+    config = get_config()
+    video_file = activity.get_video_file()
+    widths = sorted(set(config.ladder_widths))
+    cue_times = cells = None
+    rungs = []
+    if get_engine() == "ffmpeg":
+        with stage_timer("probe_video"):
+            info = probe_video(video_file)
+        num_files = num_cells = get_thumb_count(info["duration"], thumb_rate) - (1 if config.skip_first else 0)
+        for width in widths:
+            coordinates = "%dx%d+0+0" % (width, get_thumb_height(info["width"], info["height"], width))
+            layout = plan_layout(num_files, *get_cell_size(coordinates))
+            rungs.append((get_rung_file(activity.get_sprite_file(), width), width, layout, coordinates))
+        thumb_files = []
+        with stage_timer("make_sprites_ffmpeg", rungs=len(rungs)):
+            do_cmd(get_ladder_ffmpeg_cmd(video_file, [rung[:3] for rung in rungs], num_files, thumb_rate))
+    else:
+        num_files, thumb_files, cue_times, cells = take_task_snaps(activity, thumb_rate)
+        num_cells = len(thumb_files)
+        if not (config.image_backend == "pillow" and Image is not None):
+            """montage scales the full size snapshots to the -geometry of each rung"""
+            with stage_timer("get_geometry"):
+                w, h = get_cell_size(get_geometry(thumb_files[0]))
+        for width in widths:
+            sprite_file = get_rung_file(activity.get_sprite_file(), width)
+            if config.image_backend == "pillow" and Image is not None:
+                with stage_timer("make_sprites_pillow", width=width):
+                    coordinates, layout = make_sprites_pillow(thumb_files, sprite_file, width)
+            else:
+                coordinates = "%dx%d+0+0" % (width, max(int(width * h / float(w) + 0.5), 1))
+                layout = plan_layout(len(thumb_files), *get_cell_size(coordinates))
+                with stage_timer("makesprite", width=width):
+                    makesprite(thumb_files, sprite_file, coordinates, layout)
+            rungs.append((sprite_file, width, layout, coordinates))
+
+    files = []
+    for sprite_file, width, layout, coordinates in rungs:
+        sprites_array = [sheet.file for sheet in plan_sheets(sprite_file, layout, num_cells)]
+        if needs_optimize_pass():
+            with stage_timer("optimize_sprites_jpegoptim", width=width):
+                optimize_sprites_jpegoptim(sprites_array, False)
+        if config.sprite_format != "jpeg":
+            with stage_timer("encode_sprites", width=width, format=config.sprite_format):
+                sprites_array = encode_sprites(sprites_array)
+        vtt_file = get_rung_file(activity.get_vtt_file(), width)
+        with stage_timer("make_vtt", width=width):
+            vtt_files = make_vtt(sprites_array, num_files, coordinates, layout, vtt_file, thumb_rate=thumb_rate,
+                                 times=cue_times, cells=cells)
+        files.extend(sprites_array + vtt_files)
+    remove_old_thumb_files(thumb_files)
+    return num_files, files
+
+
+def take_task_snaps(activity: SpriteTask, thumb_rate):
+    """
+    snapshot stages of the imagemagick engine, following SAMPLING, EXTRACT_MODE and DEDUP_TILES; returns
+        (number of cues, thumb files, cue times or None, cue cells or None) for make_vtt
+    """
+    config = get_config()
     out_dir = activity.get_out_dir()
-    sprite_file = activity.get_sprite_file()
+    if config.engine != get_engine():
+        logger.warning("Using the imagemagick engine instead of %s (%s)" % (
+            config.engine, "Pillow is not installed" if Image is None else "not supported with these settings"))
 
     """create snapshots"""
-    num_files, thumb_files = take_snaps(activity.get_video_file(), out_dir, thumb_rate=thumb_rate)
-
-    """resize them to be mini"""
-    resize(thumb_files)
+    cue_times = None
+    with stage_timer("take_snaps", mode=config.extract_mode, sampling=config.sampling):
+        if config.sampling == "scene":
+            num_files, thumb_files, cue_times = take_snaps_scene(activity.get_video_file(), out_dir,
+                                                                 thumb_rate=thumb_rate)
+        elif activity.remote_file and config.remote_range_reads:
+            num_files, thumb_files = take_snaps_remote(activity.get_video_file(), out_dir, thumb_rate=thumb_rate)
+        elif config.extract_mode == "seek":
+            num_files, thumb_files = take_snaps_seek(activity.get_video_file(), out_dir, thumb_rate=thumb_rate)
+        elif config.extract_segments > 1:
+            num_files, thumb_files = take_snaps_segmented(activity.get_video_file(), out_dir, thumb_rate=thumb_rate)
+        else:
+            num_files, thumb_files = take_snaps(activity.get_video_file(), out_dir, thumb_rate=thumb_rate)
+
+    """merge look-alike thumbs into shared sprite cells"""
+    cells = None
+    if config.dedup_tiles and Image is not None:
+        with stage_timer("dedup_thumbs"):
+            thumb_files, cells = dedup_thumbs(thumb_files)
+    elif config.dedup_tiles:
+        logger.warning("Pillow is not installed, tile dedup skipped")
+    return num_files, sorted(thumb_files), cue_times, cells
+
+
+def make_task_sprites(activity: SpriteTask, thumb_rate):
+    """run the pipeline stages for a task; returns the number of thumbs (None when restored from the cache)"""
+    config = get_config()
+    out_dir = activity.get_out_dir()
+    sprite_file = activity.get_sprite_file()
 
-    """get coordinates from a resized file to use in sprite mapping"""
-    if num_files <= MAX_GRID_SIZE ** 2:
-        grid_size = int(math.ceil(math.sqrt(num_files)))
+    """reuse a previous result for the same video and settings"""
+    cache_key = None
+    if config.cache_dir and not activity.remote_file:
+        if not os.path.exists(config.cache_dir):
+            os.makedirs(config.cache_dir)
+        cache_key = get_cache_key(activity, thumb_rate)
+        if restore_from_cache(cache_key, out_dir):
+            return None
+
+    if config.ladder_widths:
+        num_files, files = make_ladder_sprites(activity, thumb_rate)
+        if cache_key:
+            store_in_cache(cache_key, files)
+        return num_files
+
+    engine = get_engine()
+    cue_times = None
+    cells = None
+    if engine == "ffmpeg":
+        """size the grid from the probed duration, then let ffmpeg write the sprite sheets directly"""
+        with stage_timer("probe_video"):
+            info = probe_video(activity.get_video_file())
+        num_files = get_thumb_count(info["duration"], thumb_rate)
+        if config.skip_first:
+            num_files -= 1
+        coordinates = "%dx%d+0+0" % (config.thumb_width, get_thumb_height(info["width"], info["height"]))
+        layout = plan_layout(num_files, *get_cell_size(coordinates))
+        thumb_files = []
+        with stage_timer("make_sprites_ffmpeg"):
+            make_sprites_ffmpeg(activity.get_video_file(), sprite_file, num_files, layout, thumb_rate=thumb_rate)
+    elif engine == "stream":
+        """stream raw frames from ffmpeg straight into the sprite sheets"""
+        with stage_timer("make_sprites_stream"):
+            num_files, layout, coordinates = make_sprites_stream(activity.get_video_file(), sprite_file,
+                                                                    thumb_rate=thumb_rate)
+        thumb_files = []
     else:
-        grid_size = MAX_GRID_SIZE
-
-    """use the first file (since they are all same size) to get geometry settings"""
-    coordinates = get_geometry(thumb_files[0])
-
-    # first_elem = 1
-    # last_elem = MAX_GRID_SIZE ** 2
-    # l = 0
-    #
-    # for i in range(0, num_files, MAX_GRID_SIZE**2):
-    #     l += 1
-    #     if num_files <= last_elem:
-    #         last_elem = num_files
-    #         if last_elem == first_elem:
-    #             # print(first_elem)
-    #             break
-    #         print(first_elem, '->', last_elem)
-    #         grid = last_elem - first_elem + 1
-    #         spritefile2 = os.path.join(out_dir, "%02d%s" % (l, SPRITE_NAME))
-    #         gridsize1 = int(math.ceil(math.sqrt(grid)))
-    #         print(gridsize1)
-    #         makesprite(out_dir, spritefile2, coordinates, gridsize1)
-    #         break
-    #     print(first_elem, '->', last_elem)
-    #     first_elem = last_elem + 1
-    #     last_elem += MAX_GRID_SIZE**2
-    #     grid = last_elem - first_elem + 1
-    #     print(grid)
-    #     spritefile2 = os.path.join(out_dir, "%02d%s" % (l, SPRITE_NAME))
-    #     gridsize1 = int(math.ceil(math.sqrt(grid)))
-    #     makesprite(out_dir, spritefile2, coordinates, gridsize1)
-
-    """convert small files into a single sprite grid"""
-    makesprite(out_dir, sprite_file, coordinates, grid_size)
-
-    sprites_array = get_sprite_images(sprite_file)
-    sprites_array.sort()
+        num_files, thumb_files, cue_times, cells = take_task_snaps(activity, thumb_rate)
+
+        if config.image_backend == "pillow" and Image is not None:
+            """resize and tile in memory; each sprite is encoded once and no identify call is needed"""
+            with stage_timer("make_sprites_pillow"):
+                coordinates, layout = make_sprites_pillow(thumb_files, sprite_file)
+        else:
+            if config.image_backend == "pillow":
+                logger.warning("Pillow is not installed, falling back to ImageMagick")
+
+            """resize them to be mini"""
+            with stage_timer("resize"):
+                resize(thumb_files)
+
+            """use the first file (since they are all same size) to get geometry settings"""
+            with stage_timer("get_geometry"):
+                coordinates = get_geometry(thumb_files[0])
+
+            """get coordinates from a resized file to use in sprite mapping"""
+            layout = plan_layout(len(thumb_files), *get_cell_size(coordinates))
+
+            """convert small files into sprite sheets, built in parallel"""
+            with stage_timer("makesprite"):
+                makesprite(thumb_files, sprite_file, coordinates, layout)
+
+    """the planned sheets (cells = kept thumbs; the single pass engines write no thumb files)"""
+    sprites_array = [sheet.file for sheet in plan_sheets(sprite_file, layout, len(thumb_files) or num_files)]
 
     # optimize_sprites_optipng(sprites_array)         # Just optimize
     # optimize_sprites_jpegoptim(sprites_array, 70)   # Force file compression
-    optimize_sprites_jpegoptim(sprites_array, False)  # Just optimize
+    if needs_optimize_pass():
+        with stage_timer("optimize_sprites_jpegoptim"):
+            optimize_sprites_jpegoptim(sprites_array, False)  # Just optimize
+
+    """webp/avif sprites, or whichever format is smallest at the target quality"""
+    if config.sprite_format != "jpeg":
+        with stage_timer("encode_sprites", format=config.sprite_format):
+            sprites_array = encode_sprites(sprites_array)
 
     """Remove unneeded thumb files"""
     remove_old_thumb_files(thumb_files)
 
     """generate a vtt with coordinates to each image in sprite"""
-    make_vtt(sprites_array, num_files, coordinates, grid_size, activity.get_vtt_file(), thumb_rate=thumb_rate)
+    with stage_timer("make_vtt"):
+        vtt_files = make_vtt(sprites_array, num_files, coordinates, layout, activity.get_vtt_file(),
+                             thumb_rate=thumb_rate, times=cue_times, cells=cells)
+
+    if cache_key:
+        store_in_cache(cache_key, sprites_array + vtt_files)
+    return num_files
+
+
+def read_queue(queue_file):
+    """video paths/urls listed one per line in a .txt queue, skipping blanks and # comments"""
+    with open(queue_file, 'r') as f:
+        lines = [line.strip() for line in f.readlines()]
+    return [line for line in lines if len(line) > 0 and not line.startswith('#')]
+
+
+def run_batch_item(video_file, config=None):
+    """run one queued video; failures (including sys.exit from SpriteTask) are returned, not raised"""
+    try:
+        run(SpriteTask(video_file, config=config))
+    except (Exception, SystemExit) as e:
+        logger.error("FAILED %s: %s" % (video_file, e))
+        return video_file, str(e) or e.__class__.__name__
+    return video_file, None
+
+
+def run_batch(video_files, jobs=1, config=None):
+    """
+    process a queue of videos with one config (default get_config()), up to `jobs` at a time in a process pool,
+        and print a per-file summary; returns a list of (video_file, error) tuples, error is None on success
+    """
+    if config is None:
+        config = get_config()
+    if jobs > 1:
+        """the config travels with each item: module globals are not shared across processes"""
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(run_batch_item, video_files, itertools.repeat(config)))
+    else:
+        results = [run_batch_item(video_file, config) for video_file in video_files]
+    print_batch_summary(results)
+    return results
+
+
+def print_batch_summary(results):
+    """print one OK/FAILED line per (video_file, error) result and the totals"""
+    failed = [(video_file, error) for video_file, error in results if error]
+    for video_file, error in results:
+        print("%s %s%s" % ("FAILED" if error else "OK    ", video_file, ": %s" % error if error else ""))
+    print("Processed %d videos: %d succeeded, %d failed" % (len(results), len(results) - len(failed), len(failed)))
 
 
 def add_logging():
@@ -418,23 +2361,44 @@ def add_logging():
 
 
 if __name__ == "__main__":
-    if not len(sys.argv) > 1:
-        sys.exit("Please pass the full path or url to the video file for which to create thumbnails.")
-    if len(sys.argv) == 3:
-        THUMB_OUT_DIR = sys.argv[2]
-    
+    parser = argparse.ArgumentParser(
+        description="Generate sprite sheets and a WebVTT file for a video, or for every video listed in a .txt file")
+    parser.add_argument("video", help="full path or url to the video file, or a .txt file with one video per line")
+    parser.add_argument("out_dir", nargs="?", help="output directory (default: %s)" % THUMB_OUT_DIR)
+    parser.add_argument("--jobs", type=int, default=1, help="number of queued videos processed in parallel")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="ffmpeg threads per job (default: cores divided by --jobs when --jobs > 1)")
+    parser.add_argument("--append", action="store_true",
+                        help="growing video: keep the existing output and only add sprites/cues for new content")
+    parser.add_argument("--config", help="JSON file of settings (default: $%sCONFIG)" % CONFIG_ENV_PREFIX)
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a setting, e.g. --set thumb_width=160 (repeatable; beats %s* env vars)"
+                             % CONFIG_ENV_PREFIX)
+    args = parser.parse_args()
+    overrides = {}
+    for setting in args.set:
+        name, sep, value = setting.partition("=")
+        if not sep:
+            parser.error("--set expects NAME=VALUE: %s" % setting)
+        overrides[name] = parse_setting(name.lower(), value)
+    if args.append:
+        overrides["append_mode"] = True
+    if args.out_dir:
+        overrides["thumb_out_dir"] = args.out_dir
+    if args.threads is not None:
+        overrides["ffmpeg_threads"] = args.threads
+    elif args.jobs > 1:
+        overrides["ffmpeg_threads"] = max(1, (os.cpu_count() or 1) // args.jobs)
+    try:
+        job_config = load_config(args.config, overrides=overrides)
+    except ValueError as e:
+        parser.error(str(e))
+
     # Check if need to process list of files
-    if sys.argv[1].endswith('.txt'):
-        process_queue = []
-        with open(sys.argv[1], 'r') as f:
-            process_queue = f.readlines()
-        for line in process_queue:
-            line = line.strip()
-            if line.startswith('#'):
-                continue
-            if len(line) > 0:
-                run(SpriteTask(line))
+    if args.video.endswith('.txt'):
+        batch_results = run_batch(read_queue(args.video), jobs=args.jobs, config=job_config)
+        if any(error for video_file, error in batch_results):
+            sys.exit(1)
     else:
-        video_elem = sys.argv[1]
-        task = SpriteTask(video_elem)
+        task = SpriteTask(args.video, config=job_config)
         run(task)
@@ -0,0 +1,399 @@
+import bisect
+import http.client
+import re
+import struct
+import threading
+from urllib.parse import urljoin, urlsplit
+
+###################################################
+"""
+ Remote MP4 input without a full download: the moov atom is located and read with HTTP range requests,
+ the sample tables give the byte ranges of the keyframes closest to the snapshot times, and only those
+ ranges are fetched (over pooled keep-alive connections) and written out as an H.264/HEVC elementary stream
+ that ffmpeg decodes into one image per snapshot.
+
+ Only progressive MP4/MOV files with an H.264 (avc1/avc3) or HEVC (hvc1/hev1) video track are handled;
+ anything else raises RemoteInputError so the caller can fall back to ffmpeg's own reader.
+"""
+###################################################
+
+"""Keyframe byte ranges closer than this are fetched with one request"""
+RANGE_MERGE_GAP = 64 * 1024
+
+"""Socket timeout in seconds for range requests"""
+HTTP_TIMEOUT = 30
+
+ANNEXB_START_CODE = b"\x00\x00\x00\x01"
+CONTAINER_BOXES = (b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts")
+
+connectionPool = {}
+poolLock = threading.Lock()
+
+
+class RemoteInputError(Exception):
+    """the remote file can't be read with range requests (server, container or codec not supported)"""
+
+
+class RangeReader:
+    """reads byte ranges of one URL over a keep-alive connection borrowed from a per-host pool"""
+
+    def __init__(self, url):
+        self.url = url
+        self.size = None
+        self.bytes_transferred = 0
+        self.requests = 0
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_pool_key(self):
+        parts = urlsplit(self.url)
+        return parts.scheme, parts.netloc
+
+    def get_connection(self):
+        if self.connection is None:
+            key = self.get_pool_key()
+            with poolLock:
+                idle = connectionPool.get(key)
+                self.connection = idle.pop() if idle else None
+            if self.connection is None:
+                scheme, netloc = key
+                if scheme == "https":
+                    self.connection = http.client.HTTPSConnection(netloc, timeout=HTTP_TIMEOUT)
+                else:
+                    self.connection = http.client.HTTPConnection(netloc, timeout=HTTP_TIMEOUT)
+        return self.connection
+
+    def drop_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close(self):
+        """return the connection to the pool for the next reader of the same host"""
+        if self.connection is not None:
+            with poolLock:
+                connectionPool.setdefault(self.get_pool_key(), []).append(self.connection)
+            self.connection = None
+
+    def read(self, offset, length):
+        """bytes [offset, offset + length) of the remote file (shorter at the end of the file)"""
+        for attempt in range(5):
+            parts = urlsplit(self.url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            try:
+                conn = self.get_connection()
+                conn.request("GET", path, headers={"Range": "bytes=%d-%d" % (offset, offset + length - 1)})
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                """stale keep-alive connection: retry on a fresh one"""
+                self.drop_connection()
+                continue
+            self.requests += 1
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                self.url = urljoin(self.url, response.getheader("Location"))
+                self.drop_connection()
+                continue
+            if response.status == 416:
+                response.read()
+                return b""
+            if response.status != 206:
+                """a 200 would send the whole file, which is exactly what we are avoiding"""
+                self.drop_connection()
+                raise RemoteInputError("%s: range request answered with HTTP %d" % (self.url, response.status))
+            data = response.read()
+            self.bytes_transferred += len(data)
+            match = re.match(r"bytes \d+-\d+/(\d+)", response.getheader("Content-Range") or "")
+            if match:
+                self.size = int(match.group(1))
+            return data
+        raise RemoteInputError("%s: range request failed" % self.url)
+
+
+class VideoTrack:
+    """the parts of an MP4 video track needed to cut keyframes out of the file"""
+
+    def __init__(self):
+        self.duration = 0.0
+        self.codec = None
+        self.nal_length_size = 4
+        self.parameter_sets = []
+        self.keyframe_times = []
+        self.keyframe_ranges = []
+
+    def get_stream_format(self):
+        """ffmpeg demuxer name of the elementary stream"""
+        return "hevc" if self.codec in (b"hvc1", b"hev1") else "h264"
+
+    def get_keyframe(self, seconds):
+        """index of the keyframe at or before the given presentation time (the first one if none is)"""
+        return max(bisect.bisect_right(self.keyframe_times, seconds) - 1, 0)
+
+
+def read_box_header(data, pos):
+    """(size, type, header length) of the box starting at data[pos]"""
+    size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+    if size == 1:
+        return struct.unpack(">Q", data[pos + 8:pos + 16])[0], box_type, 16
+    return size, box_type, 8
+
+
+def iter_boxes(data, start, end):
+    """yield (type, payload start, payload end) of the boxes in data[start:end]"""
+    pos = start
+    while pos + 8 <= end:
+        size, box_type, header = read_box_header(data, pos)
+        if size == 0:
+            size = end - pos
+        if size < header:
+            raise RemoteInputError("corrupt box %r" % box_type)
+        yield box_type, pos + header, min(pos + size, end)
+        pos += size
+
+
+def find_boxes(data, start, end, path):
+    """payload (start, end) of every box reached by following the list of box types in path"""
+    found = []
+    for box_type, payload_start, payload_end in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                found.append((payload_start, payload_end))
+            elif box_type in CONTAINER_BOXES:
+                found.extend(find_boxes(data, payload_start, payload_end, path[1:]))
+    return found
+
+
+def find_box(data, start, end, path):
+    found = find_boxes(data, start, end, path)
+    return found[0] if found else None
+
+
+def read_moov(reader):
+    """locate the moov box with one small range request per top level box and fetch only moov"""
+    offset = 0
+    while reader.size is None or offset < reader.size:
+        header = reader.read(offset, 16)
+        if len(header) < 8:
+            break
+        size, box_type, header_len = read_box_header(header, 0)
+        if size == 0:
+            size = reader.size - offset
+        if box_type == b"moov":
+            return reader.read(offset, size)
+        if size < header_len:
+            break
+        offset += size
+    raise RemoteInputError("%s: no moov box found" % reader.url)
+
+
+def read_table(data, box, fmt, fields):
+    """entries of a full box sample table (version/flags, entry count, then fixed size entries)"""
+    start, end = box
+    count = struct.unpack(">I", data[start + 4:start + 8])[0]
+    entry = struct.Struct(">" + fmt * fields)
+    return [entry.unpack_from(data, start + 8 + i * entry.size) for i in range(count)]
+
+
+def parse_sample_entry(data, box, track):
+    """codec, NAL length size and parameter sets from the stsd box"""
+    start, end = box
+    """full box header + entry count, then the first sample entry; 78 bytes of VisualSampleEntry fields"""
+    size, codec, header = read_box_header(data, start + 8)
+    entry_start = start + 8
+    track.codec = codec
+    if codec in (b"avc1", b"avc3"):
+        config = find_box(data, entry_start + header + 78, entry_start + size, [b"avcC"])
+        if config is None:
+            raise RemoteInputError("avc sample entry without avcC")
+        pos = config[0]
+        track.nal_length_size = (data[pos + 4] & 3) + 1
+        pos += 5
+        for count_mask in (0x1f, 0xff):
+            count = data[pos] & count_mask
+            pos += 1
+            for i in range(count):
+                length = struct.unpack(">H", data[pos:pos + 2])[0]
+                track.parameter_sets.append(data[pos + 2:pos + 2 + length])
+                pos += 2 + length
+    elif codec in (b"hvc1", b"hev1"):
+        config = find_box(data, entry_start + header + 78, entry_start + size, [b"hvcC"])
+        if config is None:
+            raise RemoteInputError("hevc sample entry without hvcC")
+        pos = config[0]
+        track.nal_length_size = (data[pos + 21] & 3) + 1
+        arrays = data[pos + 22]
+        pos += 23
+        for i in range(arrays):
+            count = struct.unpack(">H", data[pos + 1:pos + 3])[0]
+            pos += 3
+            for j in range(count):
+                length = struct.unpack(">H", data[pos:pos + 2])[0]
+                track.parameter_sets.append(data[pos + 2:pos + 2 + length])
+                pos += 2 + length
+    else:
+        raise RemoteInputError("unsupported video codec %r" % codec)
+
+
+def parse_video_track(moov):
+    """VideoTrack for the first video track of a moov box (without its 8 byte header)"""
+    size, box_type, header = read_box_header(moov, 0)
+    moov_start, moov_end = header, len(moov)
+    mvhd = find_box(moov, moov_start, moov_end, [b"mvhd"])
+    if mvhd is None:
+        raise RemoteInputError("moov without mvhd")
+    if moov[mvhd[0]] == 1:
+        movie_timescale = struct.unpack(">I", moov[mvhd[0] + 20:mvhd[0] + 24])[0]
+    else:
+        movie_timescale = struct.unpack(">I", moov[mvhd[0] + 12:mvhd[0] + 16])[0]
+
+    for trak in find_boxes(moov, moov_start, moov_end, [b"trak"]):
+        hdlr = find_box(moov, trak[0], trak[1], [b"mdia", b"hdlr"])
+        if hdlr is None or moov[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
+            continue
+        track = VideoTrack()
+        """the video track's own media duration: mvhd's is the longest track's (e.g. a longer audio track)"""
+        mdhd = find_box(moov, trak[0], trak[1], [b"mdia", b"mdhd"])
+        if moov[mdhd[0]] == 1:
+            timescale, media_duration = struct.unpack(">IQ", moov[mdhd[0] + 20:mdhd[0] + 32])
+        else:
+            timescale, media_duration = struct.unpack(">II", moov[mdhd[0] + 12:mdhd[0] + 20])
+
+        def stbl(name):
+            return find_box(moov, trak[0], trak[1], [b"mdia", b"minf", b"stbl", name])
+
+        parse_sample_entry(moov, stbl(b"stsd"), track)
+
+        """
+        presentation offset from the edit list: a leading empty edit delays, media_time skips; the track ends
+            after its first media edit (or, without one, after the media less the skipped part)
+        """
+        shift = 0.0
+        track.duration = media_duration / float(timescale)
+        elst = find_box(moov, trak[0], trak[1], [b"edts", b"elst"])
+        if elst:
+            """entries are segment duration, media time, media rate (integer and fraction parts)"""
+            version = moov[elst[0]]
+            entries = read_table(moov, elst, "Qqhh" if version == 1 else "Iihh", 1)
+            for segment_duration, media_time, rate, rate_fraction in entries:
+                if media_time == -1:
+                    shift += segment_duration / float(movie_timescale)
+                else:
+                    track.duration -= media_time / float(timescale)
+                    if segment_duration:
+                        track.duration = segment_duration / float(movie_timescale)
+                    track.duration += shift
+                    shift -= media_time / float(timescale)
+                    break
+
+        """decode time of every sample from stts, composition offsets from ctts"""
+        decode_times = []
+        dts = 0
+        for count, delta in read_table(moov, stbl(b"stts"), "I", 2):
+            for i in range(count):
+                decode_times.append(dts)
+                dts += delta
+        ctts = stbl(b"ctts")
+        offsets = []
+        if ctts:
+            for count, offset in read_table(moov, ctts, "i" if moov[ctts[0]] == 1 else "I", 2):
+                offsets.extend([offset] * count)
+
+        """byte offset of every sample from stsc + stco/co64 + stsz"""
+        stsz = stbl(b"stsz")
+        sample_size, sample_count = struct.unpack(">II", moov[stsz[0] + 4:stsz[0] + 12])
+        if sample_size:
+            sizes = [sample_size] * sample_count
+        else:
+            sizes = list(struct.unpack(">%dI" % sample_count, moov[stsz[0] + 12:stsz[0] + 12 + 4 * sample_count]))
+        co64 = stbl(b"co64")
+        if co64:
+            chunk_offsets = [entry[0] for entry in read_table(moov, co64, "Q", 1)]
+        else:
+            chunk_offsets = [entry[0] for entry in read_table(moov, stbl(b"stco"), "I", 1)]
+        stsc = read_table(moov, stbl(b"stsc"), "I", 3)
+        sample_offsets = []
+        for i, (first_chunk, samples_per_chunk, description) in enumerate(stsc):
+            last_chunk = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunk_offsets)
+            for chunk in range(first_chunk - 1, last_chunk):
+                offset = chunk_offsets[chunk]
+                for j in range(samples_per_chunk):
+                    if len(sample_offsets) == sample_count:
+                        break
+                    sample_offsets.append(offset)
+                    offset += sizes[len(sample_offsets) - 1]
+
+        stss = stbl(b"stss")
+        if stss:
+            keyframes = [entry[0] - 1 for entry in read_table(moov, stss, "I", 1)]
+        else:
+            keyframes = range(sample_count)
+        keyframes = [k for k in keyframes if k < min(len(sample_offsets), len(decode_times))]
+        if not keyframes:
+            raise RemoteInputError("video track without samples (fragmented mp4?)")
+        keyframe_list = sorted(((decode_times[k] + (offsets[k] if k < len(offsets) else 0)) / float(timescale)
+                                + shift, sample_offsets[k], sizes[k]) for k in keyframes)
+        track.keyframe_times = [entry[0] for entry in keyframe_list]
+        track.keyframe_ranges = [(entry[1], entry[2]) for entry in keyframe_list]
+        return track
+    raise RemoteInputError("no video track")
+
+
+def read_video_track(reader):
+    """read and parse the video track of the remote file"""
+    try:
+        return parse_video_track(read_moov(reader))
+    except (struct.error, IndexError, TypeError) as e:
+        raise RemoteInputError("%s: can't parse moov: %s" % (reader.url, e))
+
+
+def fetch_samples(reader, ranges):
+    """bytes of each (offset, size) sample range, merging ranges closer than RANGE_MERGE_GAP into one request"""
+    samples = {}
+    ranges = sorted(set(ranges))
+    i = 0
+    while i < len(ranges):
+        start = ranges[i][0]
+        end = ranges[i][0] + ranges[i][1]
+        j = i + 1
+        while j < len(ranges) and ranges[j][0] - end <= RANGE_MERGE_GAP:
+            end = max(end, ranges[j][0] + ranges[j][1])
+            j += 1
+        data = reader.read(start, end - start)
+        for offset, size in ranges[i:j]:
+            samples[(offset, size)] = data[offset - start:offset - start + size]
+        i = j
+    return samples
+
+
+def to_annexb(sample, nal_length_size):
+    """convert a length prefixed (MP4) sample into start code prefixed (Annex B) NAL units"""
+    out = []
+    pos = 0
+    while pos + nal_length_size <= len(sample):
+        length = int.from_bytes(sample[pos:pos + nal_length_size], "big")
+        pos += nal_length_size
+        out.append(ANNEXB_START_CODE)
+        out.append(sample[pos:pos + length])
+        pos += length
+    return b"".join(out)
+
+
+def write_keyframe_stream(reader, track, times, stream_file):
+    """
+    write an elementary stream holding, for every snapshot time, the keyframe at or before it (repeated when
+        several times share a keyframe), each prefixed with the track's parameter sets so it decodes on its own
+    """
+    keyframes = [track.get_keyframe(seconds) for seconds in times]
+    samples = fetch_samples(reader, [track.keyframe_ranges[k] for k in keyframes])
+    parameter_sets = b"".join(ANNEXB_START_CODE + ps for ps in track.parameter_sets)
+    with open(stream_file, "wb") as f:
+        for k in keyframes:
+            f.write(parameter_sets)
+            f.write(to_annexb(samples[track.keyframe_ranges[k]], track.nal_length_size))
@@ -0,0 +1,438 @@
+import json
+import os
+import re
+
+import pytest
+
+import multiple_sprites as ms
+
+
+def configured(**settings):
+    """use_config block with the given settings over the defaults"""
+    return ms.use_config(ms.SpriteConfig.from_globals()._replace(**settings))
+
+
+def get_probe_output(stream, format_duration="100.000000", prefix=""):
+    info = {"streams": [dict({"width": 640, "height": 360, "codec_name": "h264", "avg_frame_rate": "25/1"}, **stream)],
+            "format": {"duration": format_duration, "start_time": "0.500000"}}
+    return (prefix + json.dumps(info)).encode()
+
+
+def test_parse_probe_stream_duration():
+    """the video stream's duration, not the container's (a longer audio track)"""
+    assert ms.parse_probe(get_probe_output({"duration": "60.000000"})) == {
+        "duration": 60.0, "start_time": 0.5, "width": 640, "height": 360, "codec": "h264", "frame_rate": 25.0,
+    }
+
+
+def test_parse_probe_duration_fallbacks():
+    assert ms.parse_probe(get_probe_output({"nb_frames": "1500"}))["duration"] == 60.0
+    assert ms.parse_probe(get_probe_output({}))["duration"] == 100.0
+    info = ms.parse_probe(get_probe_output({"nb_frames": "1500", "avg_frame_rate": "0/0"}))
+    assert info["duration"] == 100.0 and info["frame_rate"] is None
+
+
+def test_parse_probe_skips_error_lines():
+    """do_cmd merges stderr into stdout: a damaged file's errors come before the json"""
+    output = get_probe_output({"duration": "60.000000"}, prefix="[h264 @ 0x1] error while decoding MB 1 2\n")
+    assert ms.parse_probe(output)["duration"] == 60.0
+
+
+def get_snaps(cmd):
+    """[(seek seconds, [output names]), ...] of a get_times_snaps_cmds command"""
+    times = [float(t) for t in re.findall(r"-ss (\S+)", cmd)]
+    outputs = re.findall(r"-map (\d+):v:0 .*? (\S+/tv\d+\.jpg)", cmd)
+    return [(t, [os.path.basename(name) for i, name in outputs if int(i) == n]) for n, t in enumerate(times)]
+
+
+def test_seek_snaps_times():
+    """the fps slot centres, the last one kept half a second inside the video"""
+    with configured(skip_first=False, seek_batch_size=2, seek_snap_keyframe=False, decode_profile="default"):
+        cmds = ms.get_seek_snaps_cmds("v.mp4", "out", 2, 9)
+    assert [get_snaps(cmd) for cmd in cmds] == [
+        [(1.0, ["tv00001.jpg"]), (3.0, ["tv00002.jpg"])],
+        [(5.0, ["tv00003.jpg"]), (7.0, ["tv00004.jpg"])],
+        [(8.5, ["tv00005.jpg"])],
+    ]
+    assert "-noaccurate_seek" not in cmds[0] and "-vsync" not in cmds[0]
+
+
+def test_seek_snaps_keyframes():
+    """snapped to the keyframe index, slots sharing a keyframe share its input; numbering skips the first slot"""
+    with configured(skip_first=True, seek_batch_size=10, seek_snap_keyframe=True, decode_profile="default"):
+        cmds = ms.get_seek_snaps_cmds("v.mp4", "out", 2, 9, [0.0, 4.0, 8.0])
+    assert [get_snaps(cmd) for cmd in cmds] == [
+        [(0.0, ["tv00002.jpg"]), (4.0, ["tv00003.jpg", "tv00004.jpg"]), (8.0, ["tv00005.jpg"])],
+    ]
+    assert cmds[0].count("-noaccurate_seek") == 3 and cmds[0].count("-vsync 0") == 4
+
+
+def test_seek_snaps_fast_decode():
+    """keyframe-only decoding needs the inaccurate seek even without SEEK_SNAP_KEYFRAME"""
+    with configured(skip_first=False, seek_snap_keyframe=False, decode_profile="fast"):
+        cmd, = ms.get_seek_snaps_cmds("v.mp4", "out", 10, 10)
+    assert "-ss 5.000 -noaccurate_seek -skip_frame nokey" in cmd and "-vsync 0" in cmd
+
+
+def get_ranges(cmds):
+    """[(seek seconds, frames, start number), ...] of get_snaps_range_cmd commands"""
+    return [tuple(int(n) for n in re.search(r"-ss (\d+) .*-frames:v (\d+) -start_number (\d+)", cmd).groups())
+            for cmd in cmds]
+
+
+def test_segmented_snaps_ranges():
+    """slots split evenly between the segments, the last one taking the rest"""
+    with configured(skip_first=False, decode_profile="default"):
+        assert get_ranges(ms.get_segmented_snaps_cmds("v.mp4", "out", 2, 20, 3)) == [(0, 4, 1), (8, 4, 5), (16, 2, 9)]
+        assert get_ranges(ms.get_segmented_snaps_cmds("v.mp4", "out", 2, 20, 20)) == [(2 * k, 1, k + 1)
+                                                                                       for k in range(10)]
+
+
+def test_segmented_snaps_skip_first():
+    with configured(skip_first=True, decode_profile="default"):
+        cmds = ms.get_segmented_snaps_cmds("v.mp4", "out", 2, 20, 3)
+    assert get_ranges(cmds) == [(2, 3, 2), (8, 3, 5), (14, 3, 8)]
+    assert all("-vf fps=1/2 " in cmd and "-noaccurate_seek" not in cmd for cmd in cmds)
+
+
+@pytest.fixture
+def task(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    video_file.write_bytes(b"not really a video")
+    with configured(thumb_out_dir=str(tmp_path / "out"), use_unique_out_dir=False):
+        yield ms.SpriteTask(str(video_file))
+
+
+def get_key(task, thumb_rate=2, **settings):
+    with configured(thumb_out_dir=task.config.thumb_out_dir, use_unique_out_dir=False, **settings):
+        return ms.get_cache_key(task, thumb_rate)
+
+
+@pytest.mark.parametrize("settings", [
+    {"thumb_width": 160},
+    {"skip_first": True},
+    {"sprite_quality": 50},
+    {"vtt_file_name": "other.vtt"},
+    {"use_sips": True},
+    {"sprite_format": "webp"},
+    {"decode_options": {"skip_frame": "nokey"}},
+    {"ladder_widths": [120, 200]},
+])
+def test_cache_key_changes_with_output_settings(task, settings):
+    assert get_key(task, **settings) != get_key(task)
+
+
+@pytest.mark.parametrize("settings", [
+    {"sheet_jobs": 7},
+    {"optimize_jobs": 7},
+    {"metrics_sink": "metrics.jsonl"},
+    {"imagemagick_limits": {"memory": "1GiB"}},
+    {"max_concurrent_procs": 1},
+])
+def test_cache_key_ignores_speed_settings(task, settings):
+    assert get_key(task, **settings) == get_key(task)
+
+
+def test_cache_key_changes_with_the_video(task):
+    key = get_key(task)
+    assert get_key(task, thumb_rate=3) != key
+    stat = os.stat(task.get_video_file())
+    os.utime(task.get_video_file(), (stat.st_atime, stat.st_mtime + 10))
+    assert get_key(task) != key
+
+
+SCENE_OUTPUT = b"""[Parsed_metadata_2 @ 0x1] frame:0    pts:0       pts_time:0
+[Parsed_metadata_2 @ 0x1] lavfi.scene_score=0.000000
+[Parsed_metadata_2 @ 0x1] frame:1    pts:512     pts_time:0.04
+[h264 @ 0x2] error while decoding MB 1 2
+[Parsed_metadata_2 @ 0x1] lavfi.scene_score=0.912500
+[Parsed_metadata_2 @ 0x1] frame:2    pts:1024    pts_time:0.08
+"""
+
+
+def test_parse_scene_scores():
+    """a frame without a score line is skipped"""
+    assert ms.parse_scene_scores(SCENE_OUTPUT) == [(0.0, 0.0), (0.04, 0.9125)]
+    assert ms.parse_scene_scores(SCENE_OUTPUT.decode()) == [(0.0, 0.0), (0.04, 0.9125)]
+
+
+SCORES = [(5, 0.9), (6, 0.8), (12, 0.5), (30, 0.2), (99, 0.95)]
+
+
+def test_pick_scene_times():
+    """cuts over the threshold, min_gap from the others and from the end"""
+    with configured(scene_threshold=0.3):
+        assert ms.pick_scene_times(SCORES, 100, 10, min_gap=2, max_gap=0) == [0.0, 5, 12]
+        assert ms.pick_scene_times(SCORES, 100, 10, min_gap=0.5, max_gap=0) == [0.0, 5, 6, 12, 99]
+        assert ms.pick_scene_times(SCORES, 100, 3, min_gap=0.5, max_gap=0) == [0.0, 5, 99]
+
+
+def test_pick_scene_times_fills_long_gaps():
+    """stretches longer than max_gap get evenly spaced thumbs while max_thumbs allows"""
+    with configured(scene_threshold=0.3):
+        assert ms.pick_scene_times(SCORES[:3], 50, 10, min_gap=2, max_gap=20) == [0.0, 5, 12, 31.0]
+        assert ms.pick_scene_times([], 60, 10, min_gap=2, max_gap=20) == [0.0, 20.0, 40.0]
+        assert ms.pick_scene_times(SCORES[:3], 50, 3, min_gap=2, max_gap=20) == [0.0, 5, 12]
+
+
+def test_is_duplicate():
+    with configured(dedup_max_distance=3, dedup_max_luma_diff=8):
+        assert ms.is_duplicate((0b111, 100), (0, 108))
+        assert not ms.is_duplicate((0b1111, 100), (0, 100))
+        assert not ms.is_duplicate((0, 100), (0, 109))
+
+
+@pytest.mark.parametrize("scope, kept, cells", [
+    ("consecutive", [1, 3, 4], [0, 0, 1, 2]),
+    ("global", [1, 3], [0, 0, 1, 0]),
+])
+def test_dedup_thumbs(tmp_path, scope, kept, cells):
+    """black and white frames hash the same, only their brightness tells them apart"""
+    image = pytest.importorskip("PIL.Image")
+    files = []
+    for n, color in enumerate(["black", "black", "white", "black"], 1):
+        files.append(str(tmp_path / ("tv%05d.jpg" % n)))
+        image.new("RGB", (64, 36), color).save(files[-1])
+    with configured(dedup_scope=scope, dedup_max_distance=3, dedup_max_luma_diff=8):
+        assert ms.dedup_thumbs(reversed(files)) == ([files[n - 1] for n in kept], cells)
+    assert sorted(os.listdir(str(tmp_path))) == [os.path.basename(files[n - 1]) for n in kept]
+
+
+@pytest.mark.parametrize("num_files, layout", [
+    (1, (1, 1)),
+    (10, (2, 5)),
+    (36, (6, 6)),
+    (37, (4, 5)),
+    (72, (6, 6)),
+])
+def test_plan_layout(num_files, layout):
+    with configured(max_grid_size=6):
+        assert ms.plan_layout(num_files, 100, 56) == ms.SheetLayout(*layout)
+
+
+def test_plan_layout_limits():
+    with configured(sheet_columns=8, sheet_rows=2):
+        layout = ms.plan_layout(100, 100, 56)
+        assert layout.columns <= 8 and layout.rows <= 2
+        assert layout.get_sheet_count(100) == 7
+    with configured(max_grid_size=6, max_sheet_pixels=300):
+        assert ms.plan_layout(36, 100, 56).columns <= 3
+        assert ms.get_max_layout(100, 56) == ms.SheetLayout(3, 5)
+
+
+def test_layout_locate():
+    layout = ms.SheetLayout(4, 5)
+    assert layout.locate(0) == (0, 0, 0)
+    assert layout.locate(5) == (0, 1, 1)
+    assert layout.locate(20) == (1, 0, 0)
+    assert ms.get_grid_position(23, layout, 100, 56) == (300, 0)
+
+
+def test_get_decode_args():
+    with configured(ffmpeg_threads=0, decode_profile="default", decode_options={}):
+        assert ms.get_decode_args() == ""
+    with configured(ffmpeg_threads=2, decode_profile="fast", decode_options={}):
+        assert ms.get_decode_args() == "-threads 2 -skip_frame nokey -flags2 fast -an -sn -dn "
+        assert ms.get_decode_args(keyframes=False) == "-threads 2 -flags2 fast -an -sn -dn "
+    with configured(ffmpeg_threads=0, decode_profile="fast", decode_options={"lowres": 1, "skip_frame": None}):
+        assert ms.get_decode_args() == "-lowres 1 -flags2 fast -an -sn -dn "
+
+
+def test_get_fps_filters():
+    """decoding keyframes only, the last keyframe is held and the slots cut to the video's"""
+    with configured(decode_profile="default", decode_options={}):
+        assert ms.get_fps_filters(10, 7) == ["fps=1/10"]
+    with configured(decode_profile="default", decode_options={"skip_frame": "nokey"}):
+        assert ms.get_fps_filters(10, 7) == ["tpad=stop_mode=clone:stop_duration=10", "fps=1/10:start_time=0",
+                                             "trim=end_frame=7"]
+
+
+def test_config_values_are_frozen():
+    config = ms.SpriteConfig.from_globals()._replace(ladder_widths=[120], decode_options={"threads": 1})
+    assert config.ladder_widths == (120,)
+    with pytest.raises(TypeError):
+        config.decode_options["threads"] = 2
+    assert ms.SpriteConfig.from_globals().decode_options is not ms.DECODE_OPTIONS
+
+
+@pytest.mark.parametrize("name, value, parsed", [
+    ("thumb_out_dir", "2024", "2024"),
+    ("vtt_index_format", "null", None),
+    ("thumb_width", "160", 160),
+    ("skip_first", "true", True),
+    ("ladder_widths", "[120, 200]", [120, 200]),
+    ("metrics_sink", "metrics.jsonl", "metrics.jsonl"),
+])
+def test_parse_setting(name, value, parsed):
+    assert ms.parse_setting(name, value) == parsed
+
+
+def test_load_config(tmp_path):
+    """the config file, then the environment, then the overrides"""
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"THUMB_WIDTH": 120, "engine": "ffmpeg"}))
+    environ = {"SPRITES_CONFIG": str(config_file), "SPRITES_THUMB_WIDTH": "160", "SPRITES_THUMB_OUT_DIR": "2024"}
+    config = ms.load_config(environ=environ, overrides={"skip_first": True})
+    assert (config.thumb_width, config.engine, config.thumb_out_dir, config.skip_first) == (160, "ffmpeg", "2024", True)
+    assert ms.load_config(environ={}).thumb_width == ms.THUMB_WIDTH
+
+
+@pytest.mark.parametrize("overrides, message", [
+    ({"thumb_widht": 160}, "Unknown settings: thumb_widht"),
+    ({"thumb_width": "160"}, "expected a number"),
+    ({"skip_first": 1}, "expected bool"),
+    ({"engine": "bogus"}, "'bogus' is not one of"),
+    ({"sprite_auto_formats": ["webp", "gif"]}, "'gif' is not one of"),
+])
+def test_load_config_rejects_bad_settings(overrides, message):
+    with pytest.raises(ValueError, match=message):
+        ms.load_config(environ={}, overrides=overrides)
+
+
+def test_get_cue_times():
+    with configured(skip_first=False, time_sync_adjust=0):
+        assert ms.get_cue_times(0, 3, 2) == [(0, 2000), (2000, 4000), (4000, 6000)]
+        assert ms.get_cue_times(9999, 10000, 0.1) == [(999900, 1000000)]
+
+
+def test_get_cue_times_skip_first():
+    """the first snapshot is dropped, so every cue starts one interval later"""
+    with configured(skip_first=True, time_sync_adjust=0):
+        assert ms.get_cue_times(0, 2, 2) == [(2000, 4000), (4000, 6000)]
+
+
+def test_get_cue_times_sync_adjust():
+    with configured(skip_first=False, time_sync_adjust=-0.25):
+        assert ms.get_cue_times(0, 2, 2) == [(0, 1500), (1500, 3500)]
+    with configured(skip_first=True, time_sync_adjust=-0.25):
+        assert ms.get_cue_times(0, 1, 2) == [(1500, 3500)]
+
+
+@pytest.mark.parametrize("ms_value, text", [
+    (0, "00:00:00.000"),
+    (1500, "00:00:01.500"),
+    (3723004, "01:02:03.004"),
+    (90000000, "25:00:00.000"),
+])
+def test_format_time_ms(ms_value, text):
+    assert ms.format_time_ms(ms_value) == text
+    assert ms.parse_time_ms(text) == ms_value
+
+
+def test_parse_time_ms_short_forms():
+    assert ms.parse_time_ms("02:03.5") == 123500
+    assert ms.parse_time_ms(" 00:00:07 ") == 7000
+
+
+CUES = [
+    ms.VttCue(0, 2000, "v_sprite-0.jpg", 0, 0, 100, 56),
+    ms.VttCue(2000, 4000, "v_sprite-0.jpg", 100, 0, 100, 56),
+    ms.VttCue(4000, 6000, "v_sprite-1.jpg", 0, 0, 100, 56),
+]
+
+
+def test_sprite_index_round_trip():
+    index = ms.SpriteIndex(reversed(CUES))
+    assert index.cues == CUES
+    assert index.get_sprites() == ["v_sprite-0.jpg", "v_sprite-1.jpg"]
+    assert ms.SpriteIndex.from_json(index.to_json()).cues == CUES
+    assert ms.SpriteIndex.from_bytes(index.to_bytes()).cues == CUES
+    with pytest.raises(ValueError):
+        ms.SpriteIndex.from_bytes(b"XXXX" + index.to_bytes()[4:])
+
+
+@pytest.mark.parametrize("index_format", ["json", "binary"])
+def test_sprite_index_files(tmp_path, index_format):
+    vtt_file = str(tmp_path / "v_thumbs.vtt")
+    with open(vtt_file, "w") as f:
+        f.write(ms.format_vtt(CUES, header=True))
+    assert list(ms.read_vtt_cues(vtt_file)) == CUES
+    index_file = ms.write_vtt_index(vtt_file, ms.SpriteIndex(CUES), index_format)
+    assert index_file == str(tmp_path / ("v_thumbs.json" if index_format == "json" else "v_thumbs.idx"))
+    assert ms.SpriteIndex.load(index_file).cues == CUES
+
+
+@pytest.mark.parametrize("seconds, num", [
+    (0, 0), (1.999, 0), (2, 1), (3.5, 1), (4, 2), (5.9994, 2), (5.9996, None), (6, None), (-1, None),
+])
+def test_sprite_index_lookup(seconds, num):
+    assert ms.SpriteIndex(CUES).lookup(seconds) == (None if num is None else CUES[num])
+
+
+@pytest.mark.parametrize("value, jobs, share", [
+    ("256MiB", 4, "67108864"),
+    ("1GB", 3, "333333333"),
+    ("1.5KiB", 2, "768"),
+    (1000, 8, "125"),
+    ("256MiB", 1, "256MiB"),
+    ("unlimited", 4, "unlimited"),
+])
+def test_split_limit(value, jobs, share):
+    assert ms.split_limit(value, jobs) == share
+
+
+def test_get_limit_args():
+    """only the pooled limits are split between the jobs"""
+    with configured(imagemagick_limits={"memory": "256MiB", "map": "512MiB", "thread": 2}):
+        assert ms.get_limit_args() == "-limit map 512MiB -limit memory 256MiB -limit thread 2 "
+        assert ms.get_limit_args(4) == "-limit map 134217728 -limit memory 67108864 -limit thread 2 "
+    with configured(imagemagick_limits={}):
+        assert ms.get_limit_args(4) == ""
+
+
+def test_plan_sheets():
+    layout = ms.SheetLayout(4, 5)
+    assert ms.plan_sheets("/out/v_sprite.jpg", layout, 37) == [
+        ms.SheetPlan(0, 0, 20, "/out/v_sprite-0.jpg"),
+        ms.SheetPlan(1, 20, 37, "/out/v_sprite-1.jpg"),
+    ]
+    assert ms.plan_sheets("/out/v_sprite.jpg", layout, 20) == [ms.SheetPlan(0, 0, 20, "/out/v_sprite.jpg")]
+    assert ms.plan_sheets("/out/v_sprite.jpg", layout, 0) == [ms.SheetPlan(0, 0, 0, "/out/v_sprite.jpg")]
+
+
+def test_plan_sheets_append():
+    """append mode always numbers the sheets and only plans the ones from first_sheet on"""
+    layout = ms.SheetLayout(2, 2)
+    assert ms.plan_sheets("v.jpg", layout, 3, numbered=True) == [ms.SheetPlan(0, 0, 3, "v-0.jpg")]
+    assert ms.plan_sheets("v.jpg", layout, 10, first_sheet=1, numbered=True) == [
+        ms.SheetPlan(1, 4, 8, "v-1.jpg"),
+        ms.SheetPlan(2, 8, 10, "v-2.jpg"),
+    ]
+
+
+def test_build_sheets_passes_each_sheet_its_files():
+    plan = ms.plan_sheets("v.jpg", ms.SheetLayout(2, 2), 10, first_sheet=1)
+    with configured(sheet_jobs=2):
+        built = ms.build_sheets(plan, list(range(4, 10)), lambda files, sheet: (sheet.index, files))
+    assert built == [(1, [4, 5, 6, 7]), (2, [8, 9])]
+
+
+def test_parse_keyframes():
+    """keyframe packets only, sorted and deduplicated, less the start time"""
+    output = b"pts_time=0.500000|flags=K__\npts_time=0.660000|flags=___\npts_time=4.500000|flags=K_D\n" \
+             b"pts_time=2.500000|flags=K__\npts_time=N/A|flags=K__\npts_time=2.500000|flags=K__\n"
+    assert ms.parse_keyframes(output, 0.5) == [0.0, 2.0, 4.0]
+    assert ms.parse_keyframes(b"") == []
+
+
+def test_snap_to_keyframes():
+    """back to the keyframe at or before each time, within half a millisecond"""
+    assert ms.snap_to_keyframes([0, 1.9, 1.9998, 2, 7.5], [0.0, 2.0, 4.0]) == [0.0, 0.0, 2.0, 2.0, 4.0]
+    assert ms.snap_to_keyframes([0.5], [1.0]) == [1.0]
+
+
+def test_probe_cache_round_trip(tmp_path):
+    video_file = tmp_path / "video.mp4"
+    video_file.write_bytes(b"not really a video")
+    with configured(probe_cache_dir=None):
+        ms.write_probe_cache(str(video_file), {"keyframes": [0.0]})
+        assert ms.read_probe_cache(str(video_file)) == {}
+    with configured(probe_cache_dir=str(tmp_path / "probe")):
+        assert ms.read_probe_cache(str(video_file)) == {}
+        ms.write_probe_cache(str(video_file), {"keyframes": [0.0, 2.0]})
+        assert ms.read_probe_cache(str(video_file)) == {"keyframes": [0.0, 2.0], "path": str(video_file)}
+        assert ms.read_probe_cache(str(tmp_path / "missing.mp4")) == {}
+        stat = os.stat(str(video_file))
+        os.utime(str(video_file), (stat.st_atime, stat.st_mtime + 10))
+        assert ms.read_probe_cache(str(video_file)) == {}
+        assert len(os.listdir(str(tmp_path / "probe"))) == 1
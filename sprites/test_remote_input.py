@@ -0,0 +1,224 @@
+import http.server
+import os
+import shutil
+import subprocess
+import threading
+
+import pytest
+
+import benchmark
+import remote_input
+
+pytestmark = pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")),
+                                reason="needs ffmpeg and ffprobe")
+
+"""name -> extra ffmpeg output options of the fixture videos (6s, 25 fps, a keyframe every second)"""
+FIXTURES = {
+    "plain": "-bf 0",
+    "bframes": "-bf 2",
+    "delayed": "-bf 0 -output_ts_offset 0.5",
+    "faststart": "-bf 2 -movflags +faststart",
+}
+
+
+@pytest.fixture(scope="session")
+def video_dir(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("videos")
+    for name, options in FIXTURES.items():
+        subprocess.check_call(
+            "ffmpeg -v error -y -f lavfi -i testsrc=size=160x120:rate=25:duration=6 -c:v libx264 -preset fast "
+            "-g 25 -pix_fmt yuv420p %s %s" % (options, directory / ("%s.mp4" % name)), shell=True)
+    return directory
+
+
+class RedirectHandler(benchmark.RangeRequestHandler):
+    """/old/<name> answers with a redirect to /<name>"""
+
+    def send_head(self):
+        if self.path.startswith("/old/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/old"):])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        return benchmark.RangeRequestHandler.send_head(self)
+
+
+class FlakyHandler(benchmark.RangeRequestHandler):
+    """drops the connection without an answer for the first server.failures requests, like a stale keep-alive"""
+
+    def send_head(self):
+        if self.server.failures:
+            self.server.failures -= 1
+            self.close_connection = True
+            return None
+        return benchmark.RangeRequestHandler.send_head(self)
+
+
+class NoRangeHandler(http.server.SimpleHTTPRequestHandler):
+    """ignores Range headers: every request gets the whole file with a 200"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory, handler_class):
+    handler = lambda *args: handler_class(*args, directory=str(directory))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.bytes_sent = 0
+    server.failures = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def server(video_dir):
+    server = serve(video_dir, RedirectHandler)
+    yield server
+    server.shutdown()
+    remote_input.connectionPool.clear()
+
+
+def get_url(server, path):
+    return "http://127.0.0.1:%d/%s" % (server.server_address[1], path)
+
+
+def probe_keyframes(video_file):
+    """(pts time, byte offset, size) of every keyframe packet, as ffprobe sees them"""
+    output = subprocess.check_output(["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries",
+                                      "packet=pts_time,pos,size,flags", "-of", "compact=p=0", str(video_file)])
+    keyframes = []
+    for line in output.decode().splitlines():
+        fields = dict(field.split("=", 1) for field in line.split("|"))
+        if "K" in fields["flags"]:
+            keyframes.append((float(fields["pts_time"]), int(fields["pos"]), int(fields["size"])))
+    return sorted(keyframes)
+
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_sample_tables_match_ffprobe(server, video_dir, name):
+    with remote_input.RangeReader(get_url(server, "%s.mp4" % name)) as reader:
+        track = remote_input.read_video_track(reader)
+    expected = probe_keyframes(video_dir / ("%s.mp4" % name))
+    assert track.codec == b"avc1"
+    assert track.get_stream_format() == "h264"
+    assert track.duration == pytest.approx(6.5 if name == "delayed" else 6, abs=0.05)
+    assert track.keyframe_times == pytest.approx([time for time, pos, size in expected], abs=1e-3)
+    assert track.keyframe_ranges == [(pos, size) for time, pos, size in expected]
+    assert len(track.parameter_sets) == 2
+
+
+def test_ctts_and_edit_list(video_dir):
+    """b-frames: ctts offsets, and an edit list skipping the reorder delay, must cancel out"""
+    data = (video_dir / "bframes.mp4").read_bytes()
+    moov = data[data.index(b"moov") - 4:]
+    assert b"ctts" in moov and b"elst" in moov
+    track = remote_input.parse_video_track(moov)
+    assert track.keyframe_times == pytest.approx([0, 1, 2, 3, 4, 5], abs=1e-3)
+
+
+def test_empty_edit_delays_the_track(video_dir):
+    data = (video_dir / "delayed.mp4").read_bytes()
+    track = remote_input.parse_video_track(data[data.index(b"moov") - 4:])
+    assert track.keyframe_times == pytest.approx([0.5, 1.5, 2.5, 3.5, 4.5, 5.5], abs=1e-3)
+    assert track.get_keyframe(0.2) == 0
+    assert track.get_keyframe(2.5) == 2
+    assert track.get_keyframe(2.49) == 1
+
+
+def test_duration_is_the_video_tracks(tmp_path):
+    """a longer audio track sets the movie duration, not the video's"""
+    video_file = tmp_path / "audio.mp4"
+    subprocess.check_call(
+        "ffmpeg -v error -y -f lavfi -i testsrc=size=160x120:rate=25:duration=6 -f lavfi -i sine=duration=10 "
+        "-c:v libx264 -preset fast -g 25 -pix_fmt yuv420p -bf 2 -c:a aac %s" % video_file, shell=True)
+    data = video_file.read_bytes()
+    track = remote_input.parse_video_track(data[data.index(b"moov") - 4:])
+    assert track.duration == pytest.approx(6, abs=0.05)
+    assert track.keyframe_times[-1] < track.duration
+
+
+def test_read_ranges(server, video_dir):
+    data = (video_dir / "plain.mp4").read_bytes()
+    with remote_input.RangeReader(get_url(server, "plain.mp4")) as reader:
+        assert reader.read(100, 50) == data[100:150]
+        assert reader.size == len(data)
+        assert reader.read(len(data) - 10, 50) == data[-10:]
+        assert reader.read(len(data) + 10, 5) == b""
+
+
+def test_redirect_is_followed(server, video_dir):
+    data = (video_dir / "plain.mp4").read_bytes()
+    with remote_input.RangeReader(get_url(server, "old/plain.mp4")) as reader:
+        assert reader.read(0, 32) == data[:32]
+        assert reader.url == get_url(server, "plain.mp4")
+        assert reader.requests == 2
+
+
+def test_stale_connection_is_retried(video_dir):
+    server = serve(video_dir, FlakyHandler)
+    server.failures = 2
+    try:
+        with remote_input.RangeReader(get_url(server, "plain.mp4")) as reader:
+            assert reader.read(0, 32) == (video_dir / "plain.mp4").read_bytes()[:32]
+            assert reader.requests == 1
+        server.failures = 5
+        with remote_input.RangeReader(get_url(server, "plain.mp4")) as reader:
+            with pytest.raises(remote_input.RemoteInputError, match="range request failed"):
+                reader.read(0, 32)
+    finally:
+        server.shutdown()
+        remote_input.connectionPool.clear()
+
+
+def test_server_without_ranges_is_refused(video_dir):
+    server = serve(video_dir, NoRangeHandler)
+    try:
+        with remote_input.RangeReader(get_url(server, "plain.mp4")) as reader:
+            with pytest.raises(remote_input.RemoteInputError, match="HTTP 200"):
+                reader.read(0, 32)
+            assert reader.bytes_transferred == 0
+    finally:
+        server.shutdown()
+        remote_input.connectionPool.clear()
+
+
+def test_bytes_transferred(server, video_dir, tmp_path):
+    video_file = video_dir / "plain.mp4"
+    with remote_input.RangeReader(get_url(server, "plain.mp4")) as reader:
+        track = remote_input.read_video_track(reader)
+        moov_bytes = reader.bytes_transferred
+        remote_input.write_keyframe_stream(reader, track, [0.5, 2.5, 2.7, 5.9], str(tmp_path / "keyframes.bin"))
+        assert reader.bytes_transferred == server.bytes_sent
+    """only the moov and the three keyframes used (2.5 and 2.7 share one) were sent, well under the file size"""
+    ranges = [track.keyframe_ranges[k] for k in (0, 2, 5)]
+    assert moov_bytes < os.path.getsize(video_file)
+    fetched = reader.bytes_transferred - moov_bytes
+    assert fetched <= sum(size for offset, size in ranges) + 2 * remote_input.RANGE_MERGE_GAP
+    assert reader.bytes_transferred < os.path.getsize(video_file)
+
+
+def test_fetch_samples_merges_close_ranges(server, video_dir, monkeypatch):
+    data = (video_dir / "plain.mp4").read_bytes()
+    ranges = [(1000, 100), (1200, 50), (5000, 10)]
+    with remote_input.RangeReader(get_url(server, "plain.mp4")) as reader:
+        samples = remote_input.fetch_samples(reader, ranges)
+        assert reader.requests == 1
+        assert reader.bytes_transferred == 4010
+    assert samples == {(offset, size): data[offset:offset + size] for offset, size in ranges}
+    monkeypatch.setattr(remote_input, "RANGE_MERGE_GAP", 0)
+    with remote_input.RangeReader(get_url(server, "plain.mp4")) as reader:
+        assert remote_input.fetch_samples(reader, ranges) == samples
+        assert reader.requests == 3
+        assert reader.bytes_transferred == 160
+
+
+def test_keyframe_stream_decodes(server, tmp_path):
+    """every snapshot time becomes one decodable frame"""
+    stream_file = str(tmp_path / "keyframes.bin")
+    with remote_input.RangeReader(get_url(server, "bframes.mp4")) as reader:
+        track = remote_input.read_video_track(reader)
+        remote_input.write_keyframe_stream(reader, track, [0.5, 1.5, 1.6, 4.2], stream_file)
+    output = subprocess.check_output(["ffprobe", "-v", "error", "-f", "h264", "-count_frames", "-show_entries",
+                                      "stream=nb_read_frames", "-of", "csv=p=0", stream_file])
+    assert int(output) == 4
@@ -0,0 +1,75 @@
+import pytest
+
+import validate_vtt
+
+
+def parse(text):
+    """(cues, problems) of a VTT text"""
+    problems = []
+    return list(validate_vtt.iter_cues(text.splitlines(True), problems)), problems
+
+
+def test_iter_cues():
+    cues, problems = parse("WEBVTT\n\n00:00:00.000 --> 00:00:02.000\nv.jpg#xywh=0,0,100,56\n\n"
+                           "00:00:02.000 --> 00:00:04.000\nv.jpg#xywh=100,0,100,56\n")
+    assert problems == []
+    assert cues == [
+        validate_vtt.Cue(3, 0, 2000, "v.jpg#xywh=0,0,100,56"),
+        validate_vtt.Cue(6, 2000, 4000, "v.jpg#xywh=100,0,100,56"),
+    ]
+
+
+def test_iter_cues_optional_syntax():
+    """BOM, header text, CRLF, cue identifiers, cue settings, short times and NOTE/STYLE blocks"""
+    text = ("\ufeffWEBVTT - thumbnails\r\n\r\nNOTE made by hand\r\n\r\nSTYLE\r\n::cue { color: red }\r\n\r\n"
+            "thumb-1\r\n00:00.000 --> 00:02.000 align:start\r\nv.jpg#xywh=0,0,100,56\r\n\r\n"
+            "00:02.000 --> 00:04.000\r\nv.jpg#xywh=100,0,100,56\r\n\r\n\r\n")
+    cues, problems = parse(text)
+    assert problems == []
+    assert [(cue.line, cue.start_ms, cue.end_ms) for cue in cues] == [(9, 0, 2000), (12, 2000, 4000)]
+
+
+def test_iter_cues_problems():
+    cues, problems = parse("WEBVTTX\n\n00:00:00.000 -> 00:00:02.000\nv.jpg#xywh=0,0,100,56\n\n"
+                           "00:00:0a.000 --> 00:00:04.000\nv.jpg#xywh=0,0,100,56\n\n"
+                           "00:00:04.000 --> 00:00:06.000\nv.jpg#xywh=0,0,100,56\n")
+    assert [cue.start_ms for cue in cues] == [4000]
+    """without "-->" the first line of a block is read as a cue identifier, so the next line lacks the timing"""
+    assert [num for num, message in problems] == [1, 4, 6]
+    assert problems[0][1] == "missing WEBVTT header"
+    assert problems[1][1].startswith("no cue timing")
+    assert problems[2][1].startswith("bad cue timing")
+
+
+@pytest.mark.parametrize("payload, parsed", [
+    ("v.jpg#xywh=0,56,100,56", ("v.jpg", (0, 56, 100, 56))),
+    ("v.jpg#xywh=pixel:0,56,100,56", ("v.jpg", (0, 56, 100, 56))),
+    ("v.jpg#t=1&xywh=0,0,10,10", ("v.jpg", (0, 0, 10, 10))),
+    ("v.jpg", ("v.jpg", None)),
+])
+def test_parse_payload(payload, parsed):
+    assert validate_vtt.parse_payload(payload) == parsed
+
+
+@pytest.mark.parametrize("payload", ["v.jpg#xywh=0,0,100", "v.jpg#xywh=a,0,100,56"])
+def test_parse_payload_errors(payload):
+    with pytest.raises(ValueError):
+        validate_vtt.parse_payload(payload)
+
+
+def test_validate_vtt(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    Image.new("RGB", (200, 56)).save(str(tmp_path / "v.jpg"))
+    vtt_file = tmp_path / "v_thumbs.vtt"
+    vtt_file.write_text("WEBVTT\n\n00:00:00.000 --> 00:00:02.000\nv.jpg#xywh=0,0,100,56\n\n"
+                        "00:00:02.000 --> 00:00:04.000\nv.jpg#xywh=100,0,100,56\n")
+    assert validate_vtt.validate_vtt(str(vtt_file)) == validate_vtt.Result(str(vtt_file), 2, [])
+    vtt_file.write_text("WEBVTT\n\n00:00:01.000 --> 00:00:02.000\nv.jpg#xywh=0,0,100,56\n\n"
+                        "00:00:03.000 --> 00:00:04.000\nv.jpg#xywh=150,0,100,56\n\n"
+                        "00:00:04.000 --> 00:00:06.000\nmissing.jpg#xywh=0,0,100,56\n")
+    assert validate_vtt.validate_vtt(str(vtt_file)).problems == [
+        "line 3: first cue starts at 00:00:01.000",
+        "line 6: gap of 1000 ms after the previous cue",
+        "line 6: xywh=150,0,100,56 outside v.jpg (200x56)",
+        "line 9: sprite missing.jpg: [Errno 2] No such file or directory: '%s'" % (tmp_path / "missing.jpg"),
+    ]
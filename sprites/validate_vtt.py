@@ -0,0 +1,334 @@
+import argparse
+import collections
+import fnmatch
+import json
+import os
+import struct
+import sys
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import multiple_sprites as ms
+
+###################################################
+"""
+ Bulk audit of *_thumbs.vtt files and their sprites: every cue must parse, point at an existing sprite and
+ lie inside the sprite's real width/height, and the cues must run from the start of the video with no gaps or
+ overlaps. Sprite sizes are read from the image headers (JPEG SOF, PNG IHDR, WebP, AVIF ispe): no decode and
+ no subprocess. Directory trees are listed by parallel threads and the VTT files checked by a process pool;
+ broken assets are reported as they are found.
+
+ Sample Usage:
+    python3 validate_vtt.py /path/to/thumbs /other/tree --jobs 16 --json broken.jsonl
+"""
+###################################################
+
+"""Processes checking VTT files, and threads listing directories"""
+VALIDATE_JOBS = os.cpu_count() or 1
+WALK_THREADS = 16
+
+"""VTT files handed to a worker at a time"""
+BATCH_SIZE = 64
+
+"""File name pattern of the VTT files to check"""
+VTT_PATTERN = "*.vtt"
+
+"""Latest start allowed for the first cue, and the largest gap or overlap allowed between cues (milliseconds)"""
+MAX_FIRST_START_MS = 0
+GAP_TOLERANCE_MS = 1
+
+"""Problems kept per VTT file; the rest are only counted"""
+MAX_PROBLEMS = 20
+
+Cue = collections.namedtuple("Cue", "line start_ms end_ms payload")
+Result = collections.namedtuple("Result", "vtt_file cues problems")
+
+"""SOFn markers carrying the frame size (DHT, JPG and DAC share the 0xC_ range but are not frames)"""
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def iter_cues(lines, problems):
+    """
+    stream the cues of WebVTT lines: optional cue identifiers, cue settings after the end time, NOTE/STYLE/REGION
+        blocks and a BOM are handled; syntax errors are appended to problems as (line number, message)
+    """
+    block = []
+    for num, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if num == 1:
+            line = line.lstrip("\ufeff")
+            if not (line == "WEBVTT" or line.startswith(("WEBVTT ", "WEBVTT\t"))):
+                problems.append((num, "missing WEBVTT header"))
+            block = None
+            continue
+        if line.strip():
+            if block is not None:
+                block.append((num, line))
+            continue
+        cue = parse_block(block, problems)
+        if cue:
+            yield cue
+        block = []
+    cue = parse_block(block, problems)
+    if cue:
+        yield cue
+
+
+def parse_block(block, problems):
+    """the Cue of one blank line separated block, None for the header, NOTE/STYLE/REGION or broken blocks"""
+    if not block or block[0][1].startswith(("NOTE", "STYLE", "REGION")):
+        return None
+    timing = 1 if len(block) > 1 and "-->" not in block[0][1] else 0
+    num, line = block[timing]
+    start, sep, end = line.partition("-->")
+    if not sep:
+        problems.append((num, "no cue timing: %s" % line))
+        return None
+    try:
+        start_ms = ms.parse_time_ms(start)
+        end_ms = ms.parse_time_ms(end.split()[0] if end.split() else "")
+    except ValueError:
+        problems.append((num, "bad cue timing: %s" % line))
+        return None
+    return Cue(num, start_ms, end_ms, "\n".join(text for unused, text in block[timing + 1:]).strip())
+
+
+def parse_payload(payload):
+    """(sprite url, (x, y, w, h)) of a thumbnail cue payload like sprite.jpg#xywh=0,0,200,112"""
+    url, sep, fragment = payload.partition("#")
+    xywh = None
+    for part in fragment.split("&"):
+        if part.startswith("xywh="):
+            values = part[len("xywh="):]
+            if values.startswith("pixel:"):
+                values = values[len("pixel:"):]
+            xywh = tuple(int(value) for value in values.split(","))
+            if len(xywh) != 4:
+                raise ValueError("xywh needs 4 values")
+    return url, xywh
+
+
+def read_jpeg_size(f):
+    """(width, height) from the SOFn segment of a JPEG file positioned after its SOI marker"""
+    while True:
+        byte = f.read(1)
+        if not byte:
+            break
+        if byte != b"\xff":
+            raise ValueError("bad JPEG marker")
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            break
+        code = marker[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:
+            """standalone markers have no length"""
+            continue
+        if code in (0xD9, 0xDA):
+            break
+        length = f.read(2)
+        if len(length) < 2:
+            break
+        if code in JPEG_SOF_MARKERS:
+            precision, height, width = struct.unpack(">BHH", f.read(5))
+            return width, height
+        f.seek(struct.unpack(">H", length)[0] - 2, os.SEEK_CUR)
+    raise ValueError("no JPEG frame header")
+
+
+def read_image_size(image_file):
+    """(width, height) of a JPEG, PNG, WebP or AVIF file, read from its header"""
+    with open(image_file, 'rb') as f:
+        head = f.read(32)
+        if head.startswith(b"\xff\xd8"):
+            f.seek(2)
+            return read_jpeg_size(f)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+            chunk = head[12:16]
+            if chunk == b"VP8X":
+                return (int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1)
+            if chunk == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8 ":
+                width, height = struct.unpack("<HH", head[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+        if head[4:8] == b"ftyp" and (b"avif" in head[8:32] or b"avis" in head[8:32]):
+            """the image spatial extents property of the primary item, within the meta box at the start"""
+            data = head + f.read(64 * 1024)
+            pos = data.find(b"ispe")
+            if pos >= 0:
+                return struct.unpack(">II", data[pos + 8:pos + 16])
+    raise ValueError("unknown image format")
+
+
+def validate_vtt(vtt_file, max_first_start_ms=None, gap_tolerance_ms=None):
+    """check one VTT file and the sprites it points at; returns a Result with up to MAX_PROBLEMS problems"""
+    if max_first_start_ms is None:
+        max_first_start_ms = MAX_FIRST_START_MS
+    if gap_tolerance_ms is None:
+        gap_tolerance_ms = GAP_TOLERANCE_MS
+    problems = []
+    sizes = {}
+    base_dir = os.path.dirname(vtt_file)
+    previous = None
+    count = 0
+    try:
+        with open(vtt_file, 'r', encoding="utf-8") as f:
+            for cue in iter_cues(f, problems):
+                count += 1
+                problems.extend(check_cue(cue, previous, base_dir, sizes, max_first_start_ms, gap_tolerance_ms))
+                previous = cue
+    except (OSError, UnicodeDecodeError) as e:
+        problems.append((0, "unreadable: %s" % e))
+    if not count and not problems:
+        problems.append((0, "no cues"))
+    more = len(problems) - MAX_PROBLEMS
+    problems = ["line %d: %s" % problem if problem[0] else problem[1] for problem in problems[:MAX_PROBLEMS]]
+    if more > 0:
+        problems.append("... and %d more" % more)
+    return Result(vtt_file, count, problems)
+
+
+def check_cue(cue, previous, base_dir, sizes, max_first_start_ms, gap_tolerance_ms):
+    """(line, message) problems of a cue: timing, continuity with the previous cue, sprite and xywh bounds"""
+    problems = []
+    if cue.end_ms <= cue.start_ms:
+        problems.append((cue.line, "cue ends at or before its start"))
+    if previous is None:
+        if cue.start_ms > max_first_start_ms:
+            problems.append((cue.line, "first cue starts at %s" % ms.format_time_ms(cue.start_ms)))
+    elif cue.start_ms - previous.end_ms > gap_tolerance_ms:
+        problems.append((cue.line, "gap of %d ms after the previous cue" % (cue.start_ms - previous.end_ms)))
+    elif previous.end_ms - cue.start_ms > gap_tolerance_ms:
+        problems.append((cue.line, "overlaps the previous cue by %d ms" % (previous.end_ms - cue.start_ms)))
+    try:
+        url, xywh = parse_payload(cue.payload)
+    except ValueError:
+        return problems + [(cue.line, "bad xywh: %s" % cue.payload)]
+    if not url or not xywh:
+        return problems + [(cue.line, "no sprite#xywh=x,y,w,h: %s" % cue.payload)]
+    if urllib.parse.urlparse(url).scheme:
+        """absolute urls can't be checked locally"""
+        return problems
+    sprite_file = os.path.join(base_dir, urllib.parse.unquote(url.split("?")[0]))
+    if sprite_file not in sizes:
+        """a missing or unreadable sprite is reported at its first cue only"""
+        try:
+            sizes[sprite_file] = read_image_size(sprite_file)
+        except (OSError, ValueError, struct.error) as e:
+            sizes[sprite_file] = None
+            problems.append((cue.line, "sprite %s: %s" % (url, e)))
+    size = sizes[sprite_file]
+    if size is None:
+        return problems
+    x, y, w, h = xywh
+    if w <= 0 or h <= 0 or x < 0 or y < 0 or x + w > size[0] or y + h > size[1]:
+        problems.append((cue.line, "xywh=%d,%d,%d,%d outside %s (%dx%d)" % (x, y, w, h, url, size[0], size[1])))
+    return problems
+
+
+def scan_dir(directory, pattern):
+    """(subdirectories, matching files) of one directory"""
+    subdirs = []
+    files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif fnmatch.fnmatch(entry.name, pattern):
+                    files.append(entry.path)
+    except OSError as e:
+        ms.logger.error("Can't list %s: %s" % (directory, e))
+    return subdirs, files
+
+
+def find_vtt_files(roots, pattern=None, threads=None):
+    """VTT files under roots (files or directories), yielded as directories are listed by parallel threads"""
+    pattern = pattern or VTT_PATTERN
+    with ThreadPoolExecutor(max_workers=threads or WALK_THREADS) as pool:
+        pending = set()
+        for root in roots:
+            if os.path.isdir(root):
+                pending.add(pool.submit(scan_dir, root, pattern))
+            else:
+                yield root
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, files = future.result()
+                pending.update(pool.submit(scan_dir, subdir, pattern) for subdir in subdirs)
+                yield from files
+
+
+def validate_batch(vtt_files, max_first_start_ms=None, gap_tolerance_ms=None):
+    return [validate_vtt(vtt_file, max_first_start_ms, gap_tolerance_ms) for vtt_file in vtt_files]
+
+
+def get_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def validate_tree(roots, jobs=None, pattern=None, max_first_start_ms=None, gap_tolerance_ms=None):
+    """
+    validate every VTT file under roots, yielding a Result per file as soon as its batch is done;
+        at most 2 batches per process are queued, so memory stays flat over millions of files
+    """
+    jobs = jobs or VALIDATE_JOBS
+    batches = get_batches(find_vtt_files(roots, pattern), BATCH_SIZE)
+    if jobs == 1:
+        for batch in batches:
+            yield from validate_batch(batch, max_first_start_ms, gap_tolerance_ms)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        pending = set()
+        for batch in batches:
+            pending.add(pool.submit(validate_batch, batch, max_first_start_ms, gap_tolerance_ms))
+            if len(pending) >= jobs * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in pending:
+            yield from future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check VTT files and their sprite sheets for broken cues, missing "
+                                                 "sprites, out of bounds xywh and gaps")
+    parser.add_argument("paths", nargs="+", help="VTT files or directories searched recursively")
+    parser.add_argument("--jobs", type=int, default=VALIDATE_JOBS, help="processes checking VTT files")
+    parser.add_argument("--pattern", default=VTT_PATTERN, help="VTT file name pattern (default: %s)" % VTT_PATTERN)
+    parser.add_argument("--max-start", type=float, default=MAX_FIRST_START_MS / 1000.0,
+                        help="latest start in seconds allowed for the first cue (e.g. SKIP_FIRST output)")
+    parser.add_argument("--json", help="also write one JSON line per broken VTT file here")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the summary")
+    args = parser.parse_args()
+    report = open(args.json, "w") if args.json else None
+    checked = cues = broken = 0
+    for result in validate_tree(args.paths, jobs=args.jobs, pattern=args.pattern,
+                                max_first_start_ms=ms.get_time_ms(args.max_start)):
+        checked += 1
+        cues += result.cues
+        if not result.problems:
+            continue
+        broken += 1
+        if not args.quiet:
+            print("BROKEN %s\n    %s" % (result.vtt_file, "\n    ".join(result.problems)))
+        if report:
+            report.write(json.dumps(result._asdict()) + "\n")
+    if report:
+        report.close()
+    print("Checked %d VTT files (%d cues): %d broken" % (checked, cues, broken))
+    if broken:
+        sys.exit(1)